@@ -1,16 +1,21 @@
-from dash import html, dcc, dash_table, Dash
-from dash.dependencies import Input, Output, State
+from dash import html, dcc, dash_table, Dash, Patch, no_update
+from dash.dependencies import Input, Output, State, ALL
+from dash.exceptions import PreventUpdate
 import logging
 import sqlite3
+import threading
 import pandas as pd
 import plotly.graph_objects as go
+from db import TZ, ROW_COLUMNS, DEPTH_KEYS, ms_to_datetime, msk_to_ms
+from df_cache import DataFrameCache, group_index, make_key
+from downsample import downsample
+from archive import load_history
+from rollup import choose_resolution, visible_range, load_spreads_rollup, load_future_spreads_rollup
+from stream import StreamSubscriber
+from metrics import METRICS_HOST, METRICS_PORT, REGISTRY, fetch_summary, instrument_flask, timed_function
+from log_setup import setup_logging
 
 logger = logging.getLogger('app.py')
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',  # Формат сообщения
-                    datefmt='%d.%m.%Y %H:%M:%S',  # Формат даты
-                    level=logging.DEBUG,  # Уровень логируемых событий NOTSET/DEBUG/INFO/WARNING/ERROR/CRITICAL
-                    handlers=[logging.FileHandler('app_logs.log', encoding='utf-8'),
-                              logging.StreamHandler()])  # Лог записываем в файл и выводим на консоль
 
 # Путь до базы данных
 DB_PATH = "data/futures_spreads.db"
@@ -18,122 +23,366 @@ DB_PATH = "data/futures_spreads.db"
 # Список дат экспираций у фьючерсов
 LIST_EXPIRATIONS = ['9.25', '12.25', '3.26', '6.26']  # или None для пустого выбора
 
+# Периоды графиков: {подпись: кол-во дней}, 0 - вся история
+CHART_PERIODS = {'1 день': 1, '1 неделя': 7, '1 месяц': 30, '3 месяца': 90, 'Вся история': 0}
+
+# Кэш загруженных DataFrame в памяти сервера. В dcc.Store передается только ключ
+df_cache = DataFrameCache()
+
+# Прореживание линий графиков перед отправкой в браузер
+MAX_POINTS_PER_TRACE = 1000  # Максимум точек на линию, None - без прореживания
+REBUILD_POINTS = 100  # Через сколько дописанных строк линия сверх MAX_POINTS_PER_TRACE прореживается заново
+DOWNSAMPLE_METHOD = 'lttb'  # lttb - сохраняет форму линии, minmax - все минимумы и максимумы по интервалам
+LINE_SHAPE = 'hv'  # Ступенчатые линии: значение держится до следующей записанной строки (сборщик пишет только изменения)
+
+REFRESH_INTERVAL = 5  # Интервал автообновления таблиц и графиков, с
+
+# Поток спредов от сборщика: пока он подключен, новые точки берутся из него, а не из БД
+STREAM = True  # Подписываться на поток (spread.py --stream)
+STREAM_POLL_INTERVAL = 0.5  # Интервал передачи строк из потока в браузер, с
+stream_subscriber = None  # Подписка создается при первом обращении callback'а, а не при импорте app.py
+stream_lock = threading.Lock()
+
+# Доходности по средневзвешенным ценам стаканов (spread.py --events --sizes), которые показываются в таблицах по объемам
+DEPTH_YIELDS = {
+    'spreads_depth': ('kerry_buy_spread_y', 'kerry_sell_spread_y'),
+    'future_spreads_depth': ('spread_bid_y', 'spread_offer_y'),
+}
+
+# Вкладка Health: задержки по стадиям dash и сборщика (spread.py отдает метрики на METRICS_PORT)
+COLLECTOR_METRICS_URL = f"http://{METRICS_HOST}:{METRICS_PORT}/metrics.json"
+HEALTH_INTERVAL = 5  # Интервал обновления вкладки Health, с
+HEALTH_COLUMNS = ['Процесс', 'Метрика', 'Метки', 'Кол-во', 'p50, мс', 'p99, мс', 'Макс., мс', 'Значение']
+
 # === Подключение к БД и загрузка данных ===
 
 def get_unique_expirations():
-    """Получаем уникальные экспирации из spreads (например, 6.25, 9.25)"""
+    """Получаем уникальные экспирации фьючерсов из spreads (например, 6.25, 9.25) в порядке дат экспирации"""
     conn = sqlite3.connect(DB_PATH)
-    df = pd.read_sql_query("SELECT DISTINCT name_future FROM spreads", conn)
+    df = pd.read_sql_query("""
+        SELECT i.expiration
+        FROM spreads_latest l JOIN instruments i ON i.id = l.future_id
+        WHERE i.expiration IS NOT NULL
+        GROUP BY i.expiration
+        ORDER BY MIN(i.exp_date)
+    """, conn)
     conn.close()
 
-    expirations = df['name_future'].str.extract(r'-(\d+\.\d+)')[0].dropna().unique()
-    return sorted(expirations)
+    return df['expiration'].tolist()
 
 
-def load_data(expiration_list=None):
-    """Загружает данные из таблицы spreads с фильтром по экспирации"""
+def load_data(expiration_list=None, start=None, end=None, futures=None, after_id=None):
+    """
+    Загружает данные из таблицы spreads с фильтром по экспирации и периоду (start, end - время по МСК).
+    futures - если задан, загружаются только эти фьючерсы. after_id - только строки новее уже загруженных
+    """
     conn = sqlite3.connect(DB_PATH)
+    # Горячее окно из SQLite и закрытые дни из архива (archive.py), если период их захватывает
+    df = load_history(conn, 'spreads', ['name_future', 'kerry_buy_spread_y', 'kerry_sell_spread_y'],
+                      period_ms(start), period_ms(end), expiration_list, futures, after_id)
+    conn.close()
+
+    df.insert(0, 'trade_time', ms_to_datetime(df.pop('ts')))
+    return df
+
+
+def load_chart_data(expiration_list=None, futures=None, period_days=0):
+    """
+    История spreads для графиков за последние period_days дней (0 - вся история).
+    Короткий период загружается из сырых данных, длинный - из агрегатов самого мелкого разрешения,
+    при котором на графике не больше rollup.MAX_CHART_POINTS точек
+    """
+    start = period_start(period_days)
+    conn = sqlite3.connect(DB_PATH)
+    start_ms, end_ms = visible_range(conn, 'spreads_rollup', start)
+    resolution = choose_resolution(start_ms, end_ms)
+    if resolution is None:
+        conn.close()
+        return load_data(expiration_list, start, futures=futures)
+    logger.debug(f"Графики spreads строятся по агрегатам {resolution}")
+    df = load_spreads_rollup(conn, resolution, expiration_list, futures, start_ms=start_ms)
+    conn.close()
+    return df
+
+
+def period_start(period_days):
+    """Начало периода графиков по МСК или None для всей истории"""
+    return pd.Timestamp.now(tz=TZ) - pd.Timedelta(days=period_days) if period_days else None
 
-    query = "SELECT trade_time, name_future, kerry_buy_spread_y, kerry_sell_spread_y FROM spreads WHERE 1=1"
+
+def load_latest_spreads(expiration_list=None):
+    """Загружает последние значения по каждому фьючерсу из spreads_latest с фильтром по экспирации"""
+    conn = sqlite3.connect(DB_PATH)
+    query = "SELECT ts, name_future, kerry_buy_spread_y, kerry_sell_spread_y FROM spreads_latest WHERE 1=1"
     params = []
 
-    if expiration_list:
-        placeholders = []
-        for exp in expiration_list:
-            placeholders.append(f"name_future LIKE ?")
-            params.append(f"%-{exp}")
-        query += " AND (" + " OR ".join(placeholders) + ")"
+    query, params = add_expiration_filter(query, params, 'future_id', expiration_list)
 
     df = pd.read_sql_query(query, conn, params=params)
+    df = add_depth_columns(conn, df, 'spreads_depth')
     conn.close()
 
-    if not df.empty:
-        df['trade_time'] = pd.to_datetime(df['trade_time'], format='%d.%m.%Y %H:%M:%S')
+    df.insert(0, 'trade_time', ms_to_datetime(df.pop('ts')))
+    return df
+
+
+def add_depth_columns(conn, df, table_name):
+    """
+    Добавляет доходности по средневзвешенным ценам стаканов для объемов из spreads_depth / future_spreads_depth
+    столбцами <доходность>_<объем>, например kerry_buy_spread_y_10
+    """
+    keys = [key for key in DEPTH_KEYS[table_name] if key != 'size']
+    yields = DEPTH_YIELDS[table_name]
+    df_depth = pd.read_sql_query(f"SELECT {', '.join(keys)}, size, {', '.join(yields)} FROM {table_name}", conn)
+    if df_depth.empty:
+        return df
+    df_wide = df_depth.pivot(index=keys, columns='size', values=list(yields))
+    df_wide.columns = [f"{column}_{size}" for column, size in df_wide.columns]
+    return df.merge(df_wide.reset_index(), how='left', on=keys)
+
+
+def depth_table_columns(df, yields):
+    """Подписи столбцов доходностей по объемам для таблиц текущих спредов: {столбец: подпись}"""
+    labels = {}
+    for column, label in zip(yields, ('Спрос', 'Предложение')):
+        for depth_column in df.columns:
+            size = depth_column[len(column) + 1:]
+            if depth_column.startswith(f"{column}_") and size.isdigit():
+                labels[depth_column] = f"{label} {size} лот (%)"
+    return labels
+
+
+def add_expiration_filter(query, params, id_column, expiration_list=None):
+    """Добавляет к запросу фильтр по экспирации через справочник инструментов (поиск по индексам, без LIKE)"""
+    if expiration_list:
+        query += (f" AND {id_column} IN (SELECT id FROM instruments"
+                  f" WHERE expiration IN ({', '.join('?' * len(expiration_list))}))")
+        params.extend(expiration_list)
+    return query, params
 
-    return df.sort_values('trade_time')
+
+def period_ms(moment):
+    """Граница периода по МСК в миллисекундах или None"""
+    return msk_to_ms(moment) if moment is not None else None
 
 
 def get_unique_future_expirations():
-    """Получаем уникальные экспирации из future_spreads"""
+    """Получаем уникальные экспирации дальних фьючерсов из future_spreads в порядке дат экспирации"""
     conn = sqlite3.connect(DB_PATH)
-    df = pd.read_sql_query("SELECT DISTINCT far_future FROM future_spreads", conn)
+    df = pd.read_sql_query("""
+        SELECT i.expiration
+        FROM future_spreads_latest l JOIN instruments i ON i.id = l.far_id
+        WHERE i.expiration IS NOT NULL
+        GROUP BY i.expiration
+        ORDER BY MIN(i.exp_date)
+    """, conn)
     conn.close()
 
-    expirations = df['far_future'].str.extract(r'-(\d+\.\d+)')[0].dropna().unique()
-    return sorted(expirations)
+    return df['expiration'].tolist()
 
 
 def get_all_futures():
-    """Получаем все уникальные значения name_future из таблицы spreads"""
-    conn = sqlite3.connect("data/futures_spreads.db")
-    df = pd.read_sql_query("SELECT DISTINCT name_future FROM spreads ORDER BY name_future", conn)
+    """Получаем все фьючерсы из таблицы spreads"""
+    conn = sqlite3.connect(DB_PATH)
+    df = pd.read_sql_query("""
+        SELECT i.name AS name_future
+        FROM spreads_latest l JOIN instruments i ON i.id = l.future_id
+        ORDER BY i.name
+    """, conn)
     conn.close()
     return df["name_future"].dropna().tolist()
 
 
-def load_future_spreads(expiration_list=None):
-    """Загружает данные из future_spreads с фильтром по экспирации"""
+def load_future_spreads(expiration_list=None, start=None, end=None, after_id=None):
+    """
+    Загружает данные из future_spreads с фильтром по экспирации и периоду (start, end - время по МСК).
+    after_id - только строки новее уже загруженных
+    """
+    conn = sqlite3.connect(DB_PATH)
+    df = load_history(conn, 'future_spreads', ['near_future', 'far_future', 'spread_bid_y', 'spread_offer_y'],
+                      period_ms(start), period_ms(end), expiration_list, after_id=after_id)
+    conn.close()
+
+    df.insert(1, 'trade_time', ms_to_datetime(df.pop('ts')))
+    return df
+
+
+def load_future_chart_data(expiration_list=None, period_days=0):
+    """История future_spreads для графиков: сырые данные или агрегаты, как в load_chart_data"""
+    start = period_start(period_days)
+    conn = sqlite3.connect(DB_PATH)
+    start_ms, end_ms = visible_range(conn, 'future_spreads_rollup', start)
+    resolution = choose_resolution(start_ms, end_ms)
+    if resolution is None:
+        conn.close()
+        return load_future_spreads(expiration_list, start)
+    logger.debug(f"Графики future_spreads строятся по агрегатам {resolution}")
+    df = load_future_spreads_rollup(conn, resolution, expiration_list, start_ms=start_ms)
+    conn.close()
+    return df
+
+
+def append_tail(key, load_tail, keys):
+    """
+    Дочитывает в закэшированную историю строки с id больше последнего прочитанного из БД.
+    load_tail(after_id) загружает новые строки, keys - столбцы инструмента. Возвращает дописанные строки или None,
+    если данных в кэше нет или они загружены из агрегатов (без id)
+    """
+    df = df_cache.get(key)
+    if df is None or 'id' not in df.columns:
+        return None
+    after_id = df.attrs.get('last_id', df['id'].max() if not df.empty else None)  # Строки из потока без id
+    df_tail = load_tail(None if pd.isna(after_id) else after_id)
+    # Отметка сдвигается по всем прочитанным строкам, в том числе уже пришедшим из потока
+    last_id = df_tail['id'].max() if not df_tail.empty else after_id
+    return extend_cached(key, df, df_tail, keys, last_id)
+
+
+def append_rows(key, df_rows, keys):
+    """Дописывает в закэшированную историю строки из потока сборщика. None, если история из агрегатов или ее нет"""
+    df = df_cache.get(key)
+    if df is None or 'id' not in df.columns:
+        return None
+    return extend_cached(key, df, df_rows[[column for column in df.columns if column in df_rows.columns]], keys)
+
+
+def extend_cached(key, df, df_new, keys, last_id=None):
+    """
+    Дописывает строки, которых еще нет в кэше. Одни и те же строки могут прийти из потока и из БД или от нескольких
+    сессий, а строки одного прохода сборщика с одним временем - частями (разными транзакциями записи, из потока
+    раньше, чем из БД), поэтому дубли отсекаются по инструменту (keys) и времени.
+    В df.attrs хранятся последний прочитанный из БД id (last_id) и кол-во строк по инструментам (counts)
+    """
+    columns = [*keys, 'trade_time']
+    df_new = df_new.drop_duplicates(columns)
+    if not df.empty and not df_new.empty:
+        recent = df.loc[df['trade_time'] >= df_new['trade_time'].min(), columns]
+        if not recent.empty:
+            df_new = df_new[~pd.MultiIndex.from_frame(df_new[columns]).isin(pd.MultiIndex.from_frame(recent))]
+    counts = df.attrs.get('counts')
+    if counts is None:
+        counts = df.groupby(keys).size().to_dict() if not df.empty else {}
+    if not df_new.empty:
+        counts = counts.copy()
+        for instrument, count in df_new.groupby(keys).size().items():
+            counts[instrument] = counts.get(instrument, 0) + count
+        attrs = df.attrs
+        df = pd.concat([df, df_new], ignore_index=True)
+        df.attrs = dict(attrs)
+    df.attrs['counts'] = counts
+    if last_id is not None and not pd.isna(last_id):
+        df.attrs['last_id'] = last_id
+    if not df_new.empty:
+        df_cache.put(key, df)
+    return df_new
+
+
+def extend_traces(figure, df_full, df_group, instrument, mask, columns):
+    """
+    Дописывает в линии графика (по одной на столбец columns) новые строки инструмента df_group.
+    Пока в истории инструмента не больше MAX_POINTS_PER_TRACE строк, точки дописываются как есть. Дальше линии
+    раз в REBUILD_POINTS строк строятся заново из истории в кэше (mask - ее строки инструмента) через downsample:
+    на графике остается не больше MAX_POINTS_PER_TRACE + REBUILD_POINTS точек
+    """
+    count = df_full.attrs.get('counts', {}).get(instrument, 0)
+    if (MAX_POINTS_PER_TRACE is not None and count > MAX_POINTS_PER_TRACE
+            and (count - len(df_group)) // REBUILD_POINTS != count // REBUILD_POINTS):
+        group = df_full[mask(df_full)]
+        for trace, column in enumerate(columns):
+            x, y = downsample(group['trade_time'], group[column], MAX_POINTS_PER_TRACE, DOWNSAMPLE_METHOD)
+            figure['data'][trace]['x'] = list(x)
+            figure['data'][trace]['y'] = y.tolist()
+        return
+    for trace, column in enumerate(columns):
+        figure['data'][trace]['x'].extend(list(df_group['trade_time']))
+        figure['data'][trace]['y'].extend(df_group[column].tolist())
+
+
+# === Поток спредов от сборщика (spread.py --stream) ===
+
+def stream_connected():
+    """Подключен ли поток. При первом вызове запускает подписку: импорт app.py (benchmark.py, тесты) не подключается"""
+    global stream_subscriber
+    if STREAM and stream_subscriber is None:
+        with stream_lock:
+            if stream_subscriber is None:
+                stream_subscriber = StreamSubscriber().start()
+    return stream_subscriber is not None and stream_subscriber.connected.is_set()
+
+
+def stream_rows_df(table_name, rows):
+    """Строки из потока в DataFrame со столбцами как при загрузке из БД"""
+    df = pd.DataFrame(rows, columns=ROW_COLUMNS[table_name])
+    df.insert(0, 'trade_time', ms_to_datetime(df.pop('ts')))
+    return df
+
+
+def update_latest(df_last, df_rows, keys):
+    """Последние значения из новых строк в таблице текущих спредов, порядок строк таблицы сохраняется"""
+    latest = df_rows.drop_duplicates(keys, keep='last').set_index(keys)
+    df = df_last.set_index(keys)
+    common = df.index.intersection(latest.index)
+    columns = [column for column in df.columns if column in latest.columns]
+    df.loc[common, columns] = latest.loc[common, columns]
+    return df.reset_index()[df_last.columns]
+
+
+def load_latest_future_spreads(expiration_list=None):
+    """Загружает последние значения по каждой паре фьючерсов из future_spreads_latest с фильтром по экспирации"""
     conn = sqlite3.connect(DB_PATH)
-    query = "SELECT * FROM future_spreads WHERE 1=1"
+    query = "SELECT ts, near_future, far_future, spread_bid_y, spread_offer_y FROM future_spreads_latest WHERE 1=1"
     params = []
 
-    if expiration_list:
-        placeholders = []
-        for exp in expiration_list:
-            placeholders.append(f"far_future LIKE ?")
-            params.append(f"%-{exp}")
-        query += " AND (" + " OR ".join(placeholders) + ")"
+    query, params = add_expiration_filter(query, params, 'far_id', expiration_list)
 
     df = pd.read_sql_query(query, conn, params=params)
+    df = add_depth_columns(conn, df, 'future_spreads_depth')
     conn.close()
 
-    if not df.empty:
-        df['trade_time'] = pd.to_datetime(df['trade_time'], format='%d.%m.%Y %H:%M:%S')
-
-    return df.sort_values('trade_time')
+    df.insert(0, 'trade_time', ms_to_datetime(df.pop('ts')))
+    return df
 
 
 # === Визуализация графиков и таблиц для spreads ===
 
-def create_spread_graphs(df_full, futures_on_page):
-    """Создаем графики только для указанных фьючерсов"""
+@timed_function('dash_figure_seconds', 'builder')
+def create_spread_graphs(df_full, df_page, groups=None):
+    """
+    Создаем графики только для фьючерсов текущей страницы.
+    df_page: последние значения фьючерсов страницы в порядке таблицы
+    groups: индекс {фьючерс: позиции строк в df_full} (df_cache.groups), если не задан - строится здесь
+    """
     graphs = []
+    if groups is None:
+        groups = group_index(df_full, ['name_future'])
 
-    # Получаем последние значения только для фьючерсов на текущей странице
-    df_last_page = df_full[
-        df_full['name_future'].isin(futures_on_page)
-    ].sort_values('trade_time').drop_duplicates('name_future', keep='last')
-
-    # Сортируем в том же порядке, что и в таблице
-    df_last_page = df_last_page.set_index('name_future').reindex(futures_on_page).reset_index()
-
-    for _, row in df_last_page.iterrows():
+    for _, row in df_page.iterrows():
         future_name = row['name_future']
-        # Получаем все данные для этого фьючерса
-        group = df_full[df_full['name_future'] == future_name]
-        buy = row['kerry_buy_spread_y']
-        sell = row['kerry_sell_spread_y']
+        # Получаем все данные для этого фьючерса по индексу групп, без просмотра всего DataFrame
+        group = df_full.iloc[groups.get(future_name, [])]
     
         fig = go.Figure()
+        x, y = downsample(group['trade_time'], group['kerry_buy_spread_y'], MAX_POINTS_PER_TRACE, DOWNSAMPLE_METHOD)
         fig.add_trace(go.Scatter(
-            x=group['trade_time'],
-            y=group['kerry_buy_spread_y'],
+            x=list(x),  # Списки, а не массивы: к ним дописываются новые точки при автообновлении
+            y=y.tolist(),
             mode='lines+markers',
             name='Спрос',
-            line=dict(color='green'),
+            line=dict(color='green', shape=LINE_SHAPE),
             hovertemplate="Дата: %{x}<br>Продать спред: %{y:.2f}%<extra></extra>"
         ))
+        x, y = downsample(group['trade_time'], group['kerry_sell_spread_y'], MAX_POINTS_PER_TRACE, DOWNSAMPLE_METHOD)
         fig.add_trace(go.Scatter(
-            x=group['trade_time'],
-            y=group['kerry_sell_spread_y'],
+            x=list(x),
+            y=y.tolist(),
             mode='lines+markers',
             name='Предложение',
-            line=dict(color='red'),
+            line=dict(color='red', shape=LINE_SHAPE),
             hovertemplate="Дата: %{x}<br>Купить спред: %{y:.2f}%<extra></extra>"
         ))
     
         fig.update_layout(
-            title_text=f"{future_name} | Buy: {buy:.2f}% | Sell: {sell:.2f}%",
+            title_text=spread_graph_title(row),
             height=300,
             showlegend=True,
             template="plotly_white",
@@ -144,21 +393,18 @@ def create_spread_graphs(df_full, futures_on_page):
         fig.update_xaxes(title_text="Дата")
     
         graphs.append(html.Div([
-            dcc.Graph(figure=fig)
+            dcc.Graph(id={'type': 'spread-graph', 'index': future_name}, figure=fig)
         ]))
 
     return graphs
 
 
+def spread_graph_title(row):
+    return f"{row['name_future']} | Buy: {row['kerry_buy_spread_y']:.2f}% | Sell: {row['kerry_sell_spread_y']:.2f}%"
+
+
 def create_current_spreads_table(df_last):
-    current_df = df_last[['name_future', 'kerry_buy_spread_y', 'kerry_sell_spread_y', 'trade_time']]
-    current_df['trade_time'] = current_df['trade_time'].dt.strftime('%d.%m.%Y')
-    current_df = current_df.rename(columns={
-        'name_future': 'Фьючерс',
-        'kerry_buy_spread_y': 'Спрос (%)',
-        'kerry_sell_spread_y': 'Предложение (%)',
-        'trade_time': 'Обновлено'
-    }).round(2)
+    current_df = spreads_table_df(df_last)
 
     table = dash_table.DataTable(
         id='spreads-data-table',  # ID для отслеживания страниц
@@ -178,31 +424,44 @@ def create_current_spreads_table(df_last):
     ])
 
 
+def spreads_table_df(df_last):
+    """Строки таблицы текущих спредов"""
+    depth_columns = depth_table_columns(df_last, DEPTH_YIELDS['spreads_depth'])
+    current_df = df_last[['name_future', 'kerry_buy_spread_y', 'kerry_sell_spread_y', *depth_columns, 'trade_time']].copy()
+    current_df['trade_time'] = current_df['trade_time'].dt.strftime('%d.%m.%Y')
+    return current_df.rename(columns={
+        'name_future': 'Фьючерс',
+        'kerry_buy_spread_y': 'Спрос (%)',
+        'kerry_sell_spread_y': 'Предложение (%)',
+        **depth_columns,
+        'trade_time': 'Обновлено'
+    }).round(2)
+
+
 # === Вспомогательная функция для Future Spreads ===
-def get_sorted_future_data(df_full, sort_by='spread_bid_y'):
+def get_sorted_future_data(df_last, sort_by='spread_bid_y'):
     """
-    Получает отсортированные последние значения из данных future spreads
+    Сортирует последние значения future spreads (из future_spreads_latest)
     """
-    if df_full.empty:
-        return df_full
+    if df_last.empty:
+        return df_last
 
-    # Самые свежие записи
-    df_last = df_full.sort_values('trade_time').drop_duplicates(['near_future', 'far_future'], keep='last')
-    
-    df_last_sorted = df_last.sort_values(by=sort_by, ascending=False)
-    
-    return df_last_sorted
+    return df_last.sort_values(by=sort_by, ascending=False)
 
 
 # === Визуализация графиков и таблиц для future_spreads ===
 
-def create_future_spread_graphs(df_full, df_page):
+@timed_function('dash_figure_seconds', 'builder')
+def create_future_spread_graphs(df_full, df_page, groups=None):
     """
     Создаем графики для фьючерсов на текущей странице таблицы.
     df_full: полный отфильтрованный DataFrame
     df_page: DataFrame с фьючерсами для текущей страницы (из таблицы)
+    groups: индекс {(ближний, дальний): позиции строк в df_full}, если не задан - строится здесь
     """
     graphs = []
+    if groups is None:
+        groups = group_index(df_full, ['near_future', 'far_future'])
     
     # Убедимся, что df_page это DataFrame, а не Series
     if df_page.empty:
@@ -212,40 +471,37 @@ def create_future_spread_graphs(df_full, df_page):
         near = row['near_future']
         far = row['far_future']
     
-        # Выбираем все записи этой пары из полного датафрейма
-        pair_df = df_full[(df_full['near_future'] == near) & (df_full['far_future'] == far)]
+        # Выбираем все записи этой пары из полного датафрейма по индексу групп
+        pair_df = df_full.iloc[groups.get((near, far), [])]
         
         if pair_df.empty:
             continue
             
-        # Последние актуальные данные для подписи в заголовке
-        # Используем последнюю запись из pair_df для подписи
-        last_row = pair_df.iloc[-1]
-        buy = last_row.get('spread_bid_y', 0)
-        sell = last_row.get('spread_offer_y', 0)
     
         fig = go.Figure()
         # Добавляем линии для spread_bid_y и spread_offer_y
+        x, y = downsample(pair_df['trade_time'], pair_df['spread_bid_y'], MAX_POINTS_PER_TRACE, DOWNSAMPLE_METHOD)
         fig.add_trace(go.Scatter(
-            x=pair_df['trade_time'],
-            y=pair_df['spread_bid_y'],
+            x=list(x),  # Списки, а не массивы: к ним дописываются новые точки при автообновлении
+            y=y.tolist(),
             mode='lines+markers',
             name='Спрос',
-            line=dict(color='green'),
+            line=dict(color='green', shape=LINE_SHAPE),
             hovertemplate="Дата: %{x}<br>Продать спред: %{y:.2f}%<extra></extra>"
         ))
         
+        x, y = downsample(pair_df['trade_time'], pair_df['spread_offer_y'], MAX_POINTS_PER_TRACE, DOWNSAMPLE_METHOD)
         fig.add_trace(go.Scatter(
-            x=pair_df['trade_time'],
-            y=pair_df['spread_offer_y'],
+            x=list(x),
+            y=y.tolist(),
             mode='lines+markers',
             name='Предложение',
-            line=dict(color='red'),
+            line=dict(color='red', shape=LINE_SHAPE),
             hovertemplate="Дата: %{x}<br>Купить спред:  %{y:.2f}%<extra></extra>"
         ))
     
         fig.update_layout(
-            title_text=f"{near} - {far} |  Buy: {buy:.2f}% | Sell: {sell:.2f}%",
+            title_text=future_spread_graph_title(row),
             height=300,
             showlegend=True,
             template="plotly_white",
@@ -255,7 +511,7 @@ def create_future_spread_graphs(df_full, df_page):
         fig.update_yaxes(title_text="% годовых")
         fig.update_xaxes(title_text="Дата")
     
-        graphs.append(html.Div([dcc.Graph(figure=fig)]))
+        graphs.append(html.Div([dcc.Graph(id={'type': 'future-spread-graph', 'index': f"{near}|{far}"}, figure=fig)]))
         
     if not graphs:
         return html.Div("Нет графиков для отображения", style={"textAlign": "center"})
@@ -263,6 +519,12 @@ def create_future_spread_graphs(df_full, df_page):
     return graphs
 
 
+def future_spread_graph_title(row):
+    """Последние актуальные данные для подписи берем из таблицы: на графике могут быть средние по интервалам"""
+    return (f"{row['near_future']} - {row['far_future']} |  "
+            f"Buy: {row.get('spread_bid_y', 0):.2f}% | Sell: {row.get('spread_offer_y', 0):.2f}%")
+
+
 def create_current_future_spreads_table(df_last_sorted):
     """
     Создает таблицу future spreads с пагинацией.
@@ -270,15 +532,7 @@ def create_current_future_spreads_table(df_last_sorted):
     if df_last_sorted.empty:
         return html.Div("Нет данных для отображения таблицы", style={"textAlign": "center"})
     
-    current_df = df_last_sorted[['near_future', 'far_future', 'spread_bid_y', 'spread_offer_y', 'trade_time']].copy(deep=True)
-    current_df['trade_time'] = current_df['trade_time'].dt.strftime('%d.%m.%Y')
-    current_df = current_df.rename(columns={
-        'near_future': 'Ближний фьючерс',
-        'far_future': 'Дальний фьючерс',
-        'spread_bid_y': 'Спрос (%)',
-        'spread_offer_y': 'Предложение (%)',
-        'trade_time': 'Обновлено'
-    }).round(2)
+    current_df = future_spreads_table_df(df_last_sorted)
 
     table = dash_table.DataTable(
         id='future-spreads-data-table',  # Уникальный ID для таблицы future spreads
@@ -298,16 +552,34 @@ def create_current_future_spreads_table(df_last_sorted):
     ])
 
 
+def future_spreads_table_df(df_last_sorted):
+    """Строки таблицы текущих спредов между фьючерсами"""
+    depth_columns = depth_table_columns(df_last_sorted, DEPTH_YIELDS['future_spreads_depth'])
+    current_df = df_last_sorted[['near_future', 'far_future', 'spread_bid_y', 'spread_offer_y', *depth_columns,
+                                 'trade_time']].copy(deep=True)
+    current_df['trade_time'] = current_df['trade_time'].dt.strftime('%d.%m.%Y')
+    return current_df.rename(columns={
+        'near_future': 'Ближний фьючерс',
+        'far_future': 'Дальний фьючерс',
+        'spread_bid_y': 'Спрос (%)',
+        'spread_offer_y': 'Предложение (%)',
+        **depth_columns,
+        'trade_time': 'Обновлено'
+    }).round(2)
+
+
 # === Основной интерфейс Dash ===
 
 app = Dash(__name__, suppress_callback_exceptions=True)
+instrument_flask(app.server)  # /metrics и время запросов callback'ов вместе с сериализацией ответа
 
 app.layout = html.Div([
     html.H2("Мониторинг спредов", style={"textAlign": "center"}),
 
     dcc.Tabs(id='tabs', value='tab-spreads', children=[
         dcc.Tab(label='Спред между фьючерсом и акцией', value='tab-spreads'),
-        dcc.Tab(label='Спред между фьючерсами', value='tab-future-spreads')
+        dcc.Tab(label='Спред между фьючерсами', value='tab-future-spreads'),
+        dcc.Tab(label='Health', value='tab-health')
     ]),
 
     html.Div(id='content')
@@ -320,6 +592,7 @@ app.layout = html.Div([
     Output('content', 'children'),
     Input('tabs', 'value')
 )
+@timed_function('dash_callback_seconds', 'callback')
 def render_content(tab):
     if tab == 'tab-spreads':
         return html.Div([
@@ -355,6 +628,15 @@ def render_content(tab):
                     clearable=False,
                     style={'width': '100%', 'maxWidth': '310px', 'whiteSpace': 'nowrap'}
                 ),
+
+                html.Label("Период", className="input-label"),
+                dcc.Dropdown(
+                    id='dropdown-period',
+                    options=[{'label': label, 'value': days} for label, days in CHART_PERIODS.items()],
+                    value=0,
+                    clearable=False,
+                    style={'width': '100%', 'maxWidth': '160px'}
+                ),
                 
                 html.Label("Мин. Спрос (%)", className="input-label"),
                 dcc.Input(
@@ -372,10 +654,14 @@ def render_content(tab):
                 )
             ], style={'display': 'flex', 'flex-wrap': 'wrap', 'gap': '20px', 'margin-bottom': '20px'}),
     
-            # Хранилище для кэширования данных
+            # Ключи данных в кэше сервера (df_cache)
             dcc.Store(id='stored-filtered-data'),
             dcc.Store(id='stored-sorted-data'),
             
+            dcc.Interval(id='refresh-interval', interval=REFRESH_INTERVAL * 1000),  # Автообновление
+            dcc.Interval(id='stream-interval', interval=STREAM_POLL_INTERVAL * 1000),  # Строки из потока
+            dcc.Store(id='stream-seq'),  # Номер последнего полученного из потока пакета
+
             html.Div(id='table-container'),
             html.Div(id='graphs-container')
         ])
@@ -402,17 +688,37 @@ def render_content(tab):
                     ],
                     value='spread_bid_y',
                     clearable=False,
+                ),
+
+                html.Label("Период", className="input-label"),
+                dcc.Dropdown(
+                    id='dropdown-period-futures',
+                    options=[{'label': label, 'value': days} for label, days in CHART_PERIODS.items()],
+                    value=0,
+                    clearable=False,
+                    style={'width': '100%', 'maxWidth': '160px'}
                 )
             ], style={'display': 'flex', 'flex-wrap': 'wrap', 'gap': '20px', 'margin-bottom': '20px'}),
 
-            # Хранилище для кэширования данных future spreads
+            # Ключи данных future spreads в кэше сервера (df_cache)
             dcc.Store(id='stored-future-filtered-data'),
             dcc.Store(id='stored-future-sorted-data'),
             
+            dcc.Interval(id='future-refresh-interval', interval=REFRESH_INTERVAL * 1000),  # Автообновление
+            dcc.Interval(id='future-stream-interval', interval=STREAM_POLL_INTERVAL * 1000),  # Строки из потока
+            dcc.Store(id='future-stream-seq'),
+
             html.Div(id='future-table-container'),
             html.Div(id='future-graphs-container')
         ])
 
+    elif tab == 'tab-health':
+        return html.Div([
+            html.H3("Задержки по стадиям", className="header-title"),
+            dcc.Interval(id='health-interval', interval=HEALTH_INTERVAL * 1000),
+            html.Div(id='health-container')
+        ])
+
     return html.Div("Неизвестная вкладка")
 
 
@@ -420,34 +726,35 @@ def render_content(tab):
 # --- Первый Callback: Обновление Таблицы ---
 @app.callback(
     [Output('table-container', 'children'),
-     Output('stored-filtered-data', 'data'),  # Кэшируем отфильтрованные данные
-     Output('stored-sorted-data', 'data')],  # Кэшируем отсортированные данные
+     Output('stored-filtered-data', 'data'),  # Ключ отфильтрованных данных в кэше
+     Output('stored-sorted-data', 'data')],  # Ключ отсортированных данных в кэше
     [Input('dropdown-future', 'value'),
      Input('dropdown-expiration', 'value'),
      Input('dropdown-sort-by', 'value'),
      Input('input-min-buy-spread', 'value'),
-     Input('input-max-buy-spread', 'value')]
+     Input('input-max-buy-spread', 'value'),
+     Input('dropdown-period', 'value')]
 )
+@timed_function('dash_callback_seconds', 'callback')
 def update_table(selected_futures,
                  expiration_list,
                  sort_by,
                  min_buy_spread,
-                 max_buy_spread):
+                 max_buy_spread,
+                 period_days=0):
     logger.debug("Update_table called")
     
     # --- Начало логики фильтрации ---
-    df_full = load_data(expiration_list)
+    # Последние значения по каждому фьючерсу берем из таблицы последних значений, без просмотра истории
+    df_last = load_latest_spreads(expiration_list)
 
-    if df_full.empty:
+    if df_last.empty:
         empty_result = html.Div("Нет данных для отображения таблицы", style={"textAlign": "center"})
         return empty_result, None, None
     
     # Фильтр по конкретным фьючерсам (если выбраны)
     if selected_futures:
-        df_full = df_full[df_full['name_future'].isin(selected_futures)]
-
-        # Сначала получаем последние значения для каждого фьючерса
-    df_last = df_full.sort_values('trade_time').drop_duplicates('name_future', keep='last')
+        df_last = df_last[df_last['name_future'].isin(selected_futures)]
 
     # Затем применяем фильтр по диапазону kerry_buy_spread_y к ПОСЛЕДНИМ значениям
     try:
@@ -469,9 +776,9 @@ def update_table(selected_futures,
     # Получаем список фьючерсов, которые прошли фильтр по последним значениям
     valid_futures = df_last_filtered['name_future'].tolist()
 
-    # Фильтруем полный датафрейм, оставляя только данные по этим фьючерсам
+    # Загружаем историю только по этим фьючерсам: за длинный период - из агрегатов
     if valid_futures:
-        df_filtered = df_full[df_full['name_future'].isin(valid_futures)]
+        df_filtered = load_chart_data(expiration_list, valid_futures, period_days)
     else:
         df_filtered = pd.DataFrame()  # Пустой датафрейм если нет подходящих фьючерсов
 
@@ -480,21 +787,21 @@ def update_table(selected_futures,
         return empty_result, None, None
     # --- Конец логики фильтрации ---
     
-    # --- Получение последних значений и сортировка для таблицы ---
-    df_last = df_filtered.sort_values('trade_time').drop_duplicates('name_future', keep='last')
-    df_last_sorted = df_last.sort_values(by=sort_by, ascending=False)
-    # --- Конец получения и сортировки ---
+    # --- Сортировка последних значений для таблицы ---
+    df_last_sorted = df_last_filtered.sort_values(by=sort_by, ascending=False)
+    # --- Конец сортировки ---
     
     # --- Создание таблицы (всегда передаем полные отсортированные данные) ---
     table = create_current_spreads_table(df_last_sorted)
     # --- Конец создания таблицы ---
     logger.debug(f"Table component created and returned by {sort_by}")
     
-    # Конвертируем DataFrame в JSON для хранения
-    filtered_json = df_filtered.to_json(date_format='iso', orient='split')
-    sorted_json = df_last_sorted.to_json(date_format='iso', orient='split')
+    # Сохраняем DataFrame в кэше сервера, в браузер уходят только ключи
+    filtered_key = df_cache.put(make_key('spreads', expiration_list, valid_futures, period_days), df_filtered)
+    sorted_key = df_cache.put(make_key('spreads_latest', selected_futures, expiration_list, sort_by,
+                                       min_buy_spread, max_buy_spread), df_last_sorted)
 
-    return table, filtered_json, sorted_json
+    return table, filtered_key, sorted_key
 
 
 # --- Второй Callback: Обновление Графиков ---
@@ -502,23 +809,23 @@ def update_table(selected_futures,
     Output('graphs-container', 'children'),
     [Input('spreads-data-table', 'page_current'),
      Input('spreads-data-table', 'page_size')],
-    [State('stored-filtered-data', 'data'),   # Получаем закэшированные данные
+    [State('stored-filtered-data', 'data'),   # Ключи закэшированных данных
      State('stored-sorted-data', 'data')]
 )
-def update_graphs(page_current, page_size, filtered_json, sorted_json):
-    logger.debug(f"Update_graphs called with page_current={page_current}, page_size={page_size}")
+@timed_function('dash_callback_seconds', 'callback')
+def update_graphs(page_current, page_size, filtered_key, sorted_key):
+    logger.debug("Update_graphs called with page_current=%s, page_size=%s", page_current, page_size)
 
     # Проверяем, есть ли закэшированные данные
-    if filtered_json is None or sorted_json is None:
+    if filtered_key is None or sorted_key is None:
         return html.Div("Нет данных для графиков", style={"textAlign": "center"})
 
-    # Восстанавливаем DataFrame из JSON
-    try:
-        df_filtered = pd.read_json(filtered_json, orient='split')
-        df_last_sorted = pd.read_json(sorted_json, orient='split')
-    except Exception as e:
-        logger.error(f"Failed to restore data from JSON: {e}")
-        return html.Div("Ошибка при загрузке данных", style={"textAlign": "center"})
+    # Берем DataFrame из кэша сервера без разбора JSON
+    df_filtered = df_cache.get(filtered_key)
+    df_last_sorted = df_cache.get(sorted_key)
+    if df_filtered is None or df_last_sorted is None:
+        logger.warning("Data for graphs evicted from cache")
+        return html.Div("Данные устарели, обновите фильтры", style={"textAlign": "center"})
     
     # Обработка значений по умолчанию для пагинации
     page_current = page_current if page_current is not None else 0
@@ -529,62 +836,153 @@ def update_graphs(page_current, page_size, filtered_json, sorted_json):
     end_idx = start_idx + page_size
     df_page = df_last_sorted.iloc[start_idx:end_idx]
     futures_on_page = df_page['name_future'].tolist()
-    logger.debug(f"Futures for graphs on page {page_current}: {futures_on_page}")
+    logger.debug("Futures for graphs on page %s: %s", page_current, futures_on_page)
 
     # Создаем графики
     if not futures_on_page:
         return html.Div("Нет данных для отображения на этой странице", style={"textAlign": "center"})
 
-    graphs = create_spread_graphs(df_filtered, futures_on_page)
+    graphs = create_spread_graphs(df_filtered, df_page, df_cache.groups(filtered_key, ['name_future']))
     logger.debug(f"Graphs created and returned")
     return graphs
     # --- Конец создания графиков ---
 
+
+# --- Третий Callback: Автообновление таблицы и графиков ---
+@app.callback(
+    [Output('table-container', 'children', allow_duplicate=True),
+     Output({'type': 'spread-graph', 'index': ALL}, 'figure')],
+    Input('refresh-interval', 'n_intervals'),
+    [State('stored-filtered-data', 'data'),
+     State('stored-sorted-data', 'data'),
+     State('dropdown-expiration', 'value'),
+     State({'type': 'spread-graph', 'index': ALL}, 'id')],
+    prevent_initial_call=True
+)
+@timed_function('dash_callback_seconds', 'callback')
+def refresh_spreads(n_intervals, filtered_key, sorted_key, expiration_list, graph_ids):
+    """
+    Дописывает в таблицу и графики только новые данные: последние значения из spreads_latest
+    и строки истории с id больше уже загруженных. Таблица и графики не перестраиваются (Patch).
+    Пока работает поток от сборщика, БД не опрашивается: данные приходят в stream_spreads
+    """
+    df_last_sorted = df_cache.get(sorted_key) if sorted_key else None
+    if df_last_sorted is None or stream_connected():
+        raise PreventUpdate
+
+    # Новые последние значения в прежнем порядке строк таблицы
+    df_latest = load_latest_spreads(expiration_list).set_index('name_future')
+    df_last_sorted = df_latest.reindex(df_last_sorted['name_future']).reset_index().dropna(subset=['trade_time'])
+    df_cache.put(sorted_key, df_last_sorted)
+
+    futures = df_last_sorted['name_future'].tolist()
+    df_tail = append_tail(filtered_key, lambda after_id: load_data(expiration_list, futures=futures, after_id=after_id),
+                          ['name_future'])
+    logger.debug("Refresh_spreads: %d new rows", 0 if df_tail is None else len(df_tail))
+    return spreads_patches(df_last_sorted, df_tail, graph_ids, df_cache.get(filtered_key))
+
+
+# --- Четвертый Callback: Данные из потока сборщика ---
+@app.callback(
+    [Output('table-container', 'children', allow_duplicate=True),
+     Output({'type': 'spread-graph', 'index': ALL}, 'figure', allow_duplicate=True),
+     Output('stream-seq', 'data')],
+    Input('stream-interval', 'n_intervals'),
+    [State('stored-filtered-data', 'data'),
+     State('stored-sorted-data', 'data'),
+     State('stream-seq', 'data'),
+     State({'type': 'spread-graph', 'index': ALL}, 'id')],
+    prevent_initial_call=True
+)
+@timed_function('dash_callback_seconds', 'callback')
+def stream_spreads(n_intervals, filtered_key, sorted_key, seq, graph_ids):
+    """Дописывает в таблицу и графики строки, пришедшие из потока после прошлого вызова этой сессии"""
+    df_last_sorted = df_cache.get(sorted_key) if sorted_key else None
+    if df_last_sorted is None or not stream_connected():
+        raise PreventUpdate
+    if seq is None:  # Первый вызов: данные уже загружены из БД, дальше берем только новые строки
+        return no_update, [no_update] * len(graph_ids), stream_subscriber.last_seq
+
+    seq, rows = stream_subscriber.since(seq, 'spreads')
+    df_rows = stream_rows_df('spreads', rows)
+    df_rows = df_rows[df_rows['name_future'].isin(df_last_sorted['name_future'])]
+    if df_rows.empty:
+        return no_update, [no_update] * len(graph_ids), seq
+
+    df_last_sorted = update_latest(df_last_sorted, df_rows, ['name_future'])
+    df_cache.put(sorted_key, df_last_sorted)
+    df_new = append_rows(filtered_key, df_rows, ['name_future'])
+    return (*spreads_patches(df_last_sorted, df_new, graph_ids, df_cache.get(filtered_key)), seq)
+
+
+def spreads_patches(df_last_sorted, df_new, graph_ids, df_full=None):
+    """
+    Изменения таблицы и графиков страницы без перестроения: новые данные таблицы, заголовки и точки графиков.
+    df_new - новые строки истории или None, если графики построены по агрегатам и точки не дописываются,
+    df_full - закэшированная история, по которой линии прореживаются заново (extend_traces)
+    """
+    table = Patch()
+    table['props']['children'][1]['props']['data'] = spreads_table_df(df_last_sorted).to_dict('records')
+
+    last_rows = df_last_sorted.set_index('name_future', drop=False)
+    figures = []
+    for graph_id in graph_ids:
+        future_name = graph_id['index']
+        if future_name not in last_rows.index:
+            figures.append(no_update)
+            continue
+        figure = Patch()
+        figure['layout']['title']['text'] = spread_graph_title(last_rows.loc[future_name])
+        group = df_new[df_new['name_future'] == future_name] if df_new is not None else None
+        if group is not None and not group.empty and df_full is not None:
+            extend_traces(figure, df_full, group, future_name, lambda df: df['name_future'] == future_name,
+                          ('kerry_buy_spread_y', 'kerry_sell_spread_y'))
+        figures.append(figure)
+    return table, figures
+
 # === Callback'и для второй вкладки (future_spreads) ===
 
 # --- Первый Callback: Обновление Таблицы Future Spreads ---
 @app.callback(
     [Output('future-table-container', 'children'),
-     Output('stored-future-filtered-data', 'data'),  # Кэшируем отфильтрованные данные
+     Output('stored-future-filtered-data', 'data'),  # Ключ отфильтрованных данных в кэше
      Output('stored-future-sorted-data', 'data')],
     [Input('dropdown-expiration-futures', 'value'),
-     Input('dropdown-sort-by', 'value')]
+     Input('dropdown-sort-by', 'value'),
+     Input('dropdown-period-futures', 'value')]
 )
-def update_future_table(expiration_list, sort_by):
+@timed_function('dash_callback_seconds', 'callback')
+def update_future_table(expiration_list, sort_by, period_days=0):
     logger.debug(f"Update_future_table called with exp={expiration_list}, sort={sort_by}")
 
-    # Загружаем данные
-    df_full = load_future_spreads(expiration_list)
+    # Последние значения по каждой паре берем из таблицы последних значений
+    df_last = load_latest_future_spreads(expiration_list)
 
-    if df_full.empty:
+    if df_last.empty:
         empty_result = html.Div("Нет данных для отображения таблицы Future Spreads", style={"textAlign": "center"})
         return empty_result, None, None
-    
-    # Применяем фильтры (в данном случае только по экспирации, которая уже в load_future_spreads)
+
+    # История для графиков (фильтр по экспирации уже в load_future_chart_data)
     # Если понадобятся дополнительные фильтры, добавить их здесь
-    df_filtered = df_full.copy() # В данном случае df_full уже отфильтрован по expiration
+    df_filtered = load_future_chart_data(expiration_list, period_days)
 
     if df_filtered.empty:
         empty_result = html.Div("Нет данных, удовлетворяющих фильтру Future Spreads", style={"textAlign": "center"})
         return empty_result, None, None
     
     # Получаем отсортированные последние значения
-    df_last_sorted = get_sorted_future_data(df_filtered, sort_by)
+    df_last_sorted = get_sorted_future_data(df_last, sort_by)
     logger.debug(f"Got {len(df_last_sorted)} unique future pairs after sorting")
 
     # Создаем таблицу
     table = create_current_future_spreads_table(df_last_sorted)
     logger.debug("Future table component created and returned")
 
-    # Конвертируем DataFrame в JSON для хранения
-    try:
-        filtered_json = df_filtered.to_json(date_format='iso', orient='split')
-        sorted_json = df_last_sorted.to_json(date_format='iso', orient='split')
-    except Exception as e:
-        logger.error(f"Failed to serialize data to JSON: {e}")
-        return html.Div("Ошибка при сериализации данных", style={"textAlign": "center"}), None, None
+    # Сохраняем DataFrame в кэше сервера, в браузер уходят только ключи
+    filtered_key = df_cache.put(make_key('future_spreads', expiration_list, period_days), df_filtered)
+    sorted_key = df_cache.put(make_key('future_spreads_latest', expiration_list, sort_by), df_last_sorted)
 
-    return table, filtered_json, sorted_json
+    return table, filtered_key, sorted_key
 
 
 # --- Второй Callback: Обновление Графиков Future Spreads ---
@@ -592,23 +990,23 @@ def update_future_table(expiration_list, sort_by):
     Output('future-graphs-container', 'children'),
     [Input('future-spreads-data-table', 'page_current'),  # Input от таблицы future spreads
      Input('future-spreads-data-table', 'page_size')],
-    [State('stored-future-filtered-data', 'data'),   # Получаем закэшированные данные
+    [State('stored-future-filtered-data', 'data'),   # Ключи закэшированных данных
      State('stored-future-sorted-data', 'data')]
 )
-def update_future_graphs(page_current, page_size, filtered_json, sorted_json):
-    logger.debug(f"Update_future_graphs called with page_current={page_current}, page_size={page_size}")
+@timed_function('dash_callback_seconds', 'callback')
+def update_future_graphs(page_current, page_size, filtered_key, sorted_key):
+    logger.debug("Update_future_graphs called with page_current=%s, page_size=%s", page_current, page_size)
 
     # Проверяем, есть ли закэшированные данные
-    if filtered_json is None or sorted_json is None:
+    if filtered_key is None or sorted_key is None:
         return html.Div("Нет данных для графиков Future Spreads. Обновите фильтры.", style={"textAlign": "center"})
 
-    # Восстанавливаем DataFrame из JSON
-    try:
-        df_filtered = pd.read_json(filtered_json, orient='split')
-        df_last_sorted = pd.read_json(sorted_json, orient='split')
-    except Exception as e:
-        logger.error(f"[ERROR] Failed to restore future data from JSON: {e}")
-        return html.Div("Ошибка при загрузке данных для графиков", style={"textAlign": "center"})
+    # Берем DataFrame из кэша сервера без разбора JSON
+    df_filtered = df_cache.get(filtered_key)
+    df_last_sorted = df_cache.get(sorted_key)
+    if df_filtered is None or df_last_sorted is None:
+        logger.warning("Future data for graphs evicted from cache")
+        return html.Div("Данные устарели, обновите фильтры", style={"textAlign": "center"})
 
     # Обработка значений по умолчанию для пагинации
     page_current = page_current if page_current is not None else 0
@@ -624,12 +1022,147 @@ def update_future_graphs(page_current, page_size, filtered_json, sorted_json):
     if df_page.empty:
         return html.Div("Нет данных для отображения на этой странице", style={"textAlign": "center"})
 
-    graphs = create_future_spread_graphs(df_filtered, df_page)
+    graphs = create_future_spread_graphs(df_filtered, df_page,
+                                         df_cache.groups(filtered_key, ['near_future', 'far_future']))
     logger.debug(f"Future graphs created and returned")
     return graphs
 
 
+# --- Третий Callback: Автообновление таблицы и графиков Future Spreads ---
+@app.callback(
+    [Output('future-table-container', 'children', allow_duplicate=True),
+     Output({'type': 'future-spread-graph', 'index': ALL}, 'figure')],
+    Input('future-refresh-interval', 'n_intervals'),
+    [State('stored-future-filtered-data', 'data'),
+     State('stored-future-sorted-data', 'data'),
+     State('dropdown-expiration-futures', 'value'),
+     State({'type': 'future-spread-graph', 'index': ALL}, 'id')],
+    prevent_initial_call=True
+)
+@timed_function('dash_callback_seconds', 'callback')
+def refresh_future_spreads(n_intervals, filtered_key, sorted_key, expiration_list, graph_ids):
+    """Дописывает в таблицу и графики Future Spreads только новые данные, как refresh_spreads"""
+    df_last_sorted = df_cache.get(sorted_key) if sorted_key else None
+    if df_last_sorted is None or stream_connected():
+        raise PreventUpdate
+
+    pair = ['near_future', 'far_future']
+    df_latest = load_latest_future_spreads(expiration_list).set_index(pair)
+    df_last_sorted = df_latest.reindex(pd.MultiIndex.from_frame(df_last_sorted[pair])).reset_index()
+    df_last_sorted = df_last_sorted.dropna(subset=['trade_time'])
+    df_cache.put(sorted_key, df_last_sorted)
+
+    df_tail = append_tail(filtered_key, lambda after_id: load_future_spreads(expiration_list, after_id=after_id), pair)
+    logger.debug("Refresh_future_spreads: %d new rows", 0 if df_tail is None else len(df_tail))
+    return future_spreads_patches(df_last_sorted, df_tail, graph_ids, df_cache.get(filtered_key))
+
+
+# --- Четвертый Callback: Данные Future Spreads из потока сборщика ---
+@app.callback(
+    [Output('future-table-container', 'children', allow_duplicate=True),
+     Output({'type': 'future-spread-graph', 'index': ALL}, 'figure', allow_duplicate=True),
+     Output('future-stream-seq', 'data')],
+    Input('future-stream-interval', 'n_intervals'),
+    [State('stored-future-filtered-data', 'data'),
+     State('stored-future-sorted-data', 'data'),
+     State('future-stream-seq', 'data'),
+     State({'type': 'future-spread-graph', 'index': ALL}, 'id')],
+    prevent_initial_call=True
+)
+@timed_function('dash_callback_seconds', 'callback')
+def stream_future_spreads(n_intervals, filtered_key, sorted_key, seq, graph_ids):
+    """Дописывает в таблицу и графики Future Spreads строки из потока, как stream_spreads"""
+    df_last_sorted = df_cache.get(sorted_key) if sorted_key else None
+    if df_last_sorted is None or not stream_connected():
+        raise PreventUpdate
+    if seq is None:
+        return no_update, [no_update] * len(graph_ids), stream_subscriber.last_seq
+
+    pair = ['near_future', 'far_future']
+    seq, rows = stream_subscriber.since(seq, 'future_spreads')
+    df_rows = stream_rows_df('future_spreads', rows)
+    pairs = pd.MultiIndex.from_frame(df_last_sorted[pair])
+    df_rows = df_rows[pd.MultiIndex.from_frame(df_rows[pair]).isin(pairs)]
+    if df_rows.empty:
+        return no_update, [no_update] * len(graph_ids), seq
+
+    df_last_sorted = update_latest(df_last_sorted, df_rows, pair)
+    df_cache.put(sorted_key, df_last_sorted)
+    df_new = append_rows(filtered_key, df_rows, pair)
+    return (*future_spreads_patches(df_last_sorted, df_new, graph_ids, df_cache.get(filtered_key)), seq)
+
+
+def future_spreads_patches(df_last_sorted, df_new, graph_ids, df_full=None):
+    """Изменения таблицы и графиков Future Spreads без перестроения, как spreads_patches"""
+    table = Patch()
+    table['props']['children'][1]['props']['data'] = future_spreads_table_df(df_last_sorted).to_dict('records')
+
+    last_rows = df_last_sorted.set_index(['near_future', 'far_future'], drop=False)
+    figures = []
+    for graph_id in graph_ids:
+        near, far = graph_id['index'].split('|')
+        if (near, far) not in last_rows.index:
+            figures.append(no_update)
+            continue
+        figure = Patch()
+        figure['layout']['title']['text'] = future_spread_graph_title(last_rows.loc[(near, far)])
+        pair_df = df_new[(df_new['near_future'] == near) & (df_new['far_future'] == far)] if df_new is not None else None
+        if pair_df is not None and not pair_df.empty and df_full is not None:
+            extend_traces(figure, df_full, pair_df, (near, far),
+                          lambda df: (df['near_future'] == near) & (df['far_future'] == far),
+                          ('spread_bid_y', 'spread_offer_y'))
+        figures.append(figure)
+    return table, figures
+
+
+# === Callback вкладки Health ===
+@app.callback(
+    Output('health-container', 'children'),
+    Input('health-interval', 'n_intervals')
+)
+@timed_function('dash_callback_seconds', 'callback')
+def update_health(n_intervals):
+    collector = fetch_summary(COLLECTOR_METRICS_URL)
+    rows = metrics_rows('app.py', REGISTRY.summary()) + metrics_rows('spread.py', collector or [])
+
+    if collector is None:
+        status = f"Метрики сборщика недоступны ({COLLECTOR_METRICS_URL})"
+    else:
+        lag = next((row['value'] for row in collector if row['name'] == 'spread_cycle_lag_seconds'), None)
+        status = f"Отставание сборщика: {lag:.3f} с" if lag is not None else "Сборщик еще не выполнил ни одного прохода"
+
+    return html.Div([
+        html.H4(status),
+        dash_table.DataTable(
+            id='health-table',
+            data=rows,
+            columns=[{'name': col, 'id': col} for col in HEALTH_COLUMNS],
+            sort_action='native',
+            style_cell={'textAlign': 'center'},
+            page_size=50
+        )
+    ])
+
+
+def metrics_rows(process, summary):
+    """Строки таблицы Health: время в мс, для счетчиков и текущих значений - значение. Пустые гистограммы пропускаются"""
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return [{
+        'Процесс': process,
+        'Метрика': row['name'],
+        'Метки': ', '.join(f"{key}={value}" for key, value in row['labels'].items()),
+        'Кол-во': row.get('count'),
+        'p50, мс': ms(row.get('p50')),
+        'p99, мс': ms(row.get('p99')),
+        'Макс., мс': ms(row.get('max')),
+        'Значение': row.get('value'),
+    } for row in summary if row.get('count') != 0]
+
+
 # === Запуск сервера ===
 
 if __name__ == '__main__':
+    setup_logging('app_logs.log')  # Лог записываем в файл и выводим на консоль
     app.run(debug=True)
@@ -0,0 +1,270 @@
+import argparse
+import logging
+import os
+import shutil
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from db import DB_PATH, connect, init_db, now_ms
+from log_setup import setup_logging
+from rollup import MSK_OFFSET, update_rollups
+
+ARCHIVE_DIR = 'data/archive'  # Каталог архива: <таблица>/<день по МСК>/<столбец>.npy
+HOT_DAYS = 1  # Дней истории, которые остаются в SQLite (1 - только текущий день)
+DAY_MS = 86_400_000
+DAY_FORMAT = '%Y-%m-%d'
+
+# Столбцы архива по таблицам: {столбец: тип}. Имена инструментов не хранятся, они берутся из справочника по id.
+# Строки упорядочены по столбцу фильтра (FILTER_COLUMN) и времени, по нему ищутся нужные участки без чтения всего дня
+ARCHIVE_COLUMNS = {
+    'spreads': {'id': 'int64', 'ts': 'int64', 'share_id': 'int64', 'future_id': 'int64',
+                'bid_share': 'float64', 'offer_share': 'float64', 'bid_future': 'float64', 'offer_future': 'float64',
+                'lot_size_future': 'float64', 'exp_days': 'float64',
+                'kerry_buy_spread_y': 'float64', 'kerry_sell_spread_y': 'float64'},
+    'future_spreads': {'id': 'int64', 'ts': 'int64', 'near_id': 'int64', 'far_id': 'int64',
+                       'spread_bid': 'float64', 'spread_offer': 'float64',
+                       'spread_bid_y': 'float64', 'spread_offer_y': 'float64', 'far_exp_days': 'float64'},
+}
+FILTER_COLUMN = {'spreads': 'future_id', 'future_spreads': 'far_id'}  # Фильтр по экспирации и имени фьючерса
+NAME_IDS = {'name_share': 'share_id', 'name_future': 'future_id', 'near_future': 'near_id', 'far_future': 'far_id'}
+
+logger = logging.getLogger('archive.py')
+
+
+# === Перенос закрытых дней из SQLite в архив ===
+
+def day_start(ts):
+    """Начало дня по МСК, мс"""
+    return (ts + MSK_OFFSET) // DAY_MS * DAY_MS - MSK_OFFSET
+
+
+def day_name(day_ms):
+    return datetime.fromtimestamp((day_ms + MSK_OFFSET) / 1000, timezone.utc).strftime(DAY_FORMAT)
+
+
+def name_day(name):
+    return int(datetime.strptime(name, DAY_FORMAT).replace(tzinfo=timezone.utc).timestamp() * 1000) - MSK_OFFSET
+
+
+def archived_condition(table_name):
+    """Переносятся только строки со ссылками на справочник: имена в архиве восстанавливаются по id"""
+    return ' AND '.join(f"{column} IS NOT NULL" for column, dtype in ARCHIVE_COLUMNS[table_name].items()
+                        if column.endswith('_id'))
+
+
+def recover_partition(path, old_path):
+    """
+    Восстановление после сбоя при подмене раздела: если процесс завершился между переименованиями,
+    раздела нет, а прежние данные лежат в .old (из SQLite они уже удалены) - возвращаем их на место.
+    Если подмена завершилась, а .old не удален - удаляем его, иначе следующая подмена не выполнится
+    """
+    if not os.path.isdir(old_path):
+        return
+    if os.path.isdir(path):
+        shutil.rmtree(old_path)
+    else:
+        os.replace(old_path, path)
+        logger.warning(f"Раздел архива {path} восстановлен из {old_path} после прерванной записи")
+
+
+def archive_day(conn, table_name, day_ms, max_id, archive_dir=ARCHIVE_DIR):
+    """
+    Переносит строки одного дня с id не больше max_id в раздел архива и удаляет их из SQLite.
+    Существующий раздел дополняется. Раздел пишется во временный каталог и подменяется целиком,
+    строки удаляются после подмены: при сбое между ними повтор не создаст дублей (строки объединяются по id),
+    а load_history до повтора не вернет строки дважды
+    """
+    columns = ARCHIVE_COLUMNS[table_name]
+    condition = f"ts >= ? AND ts < ? AND id <= ? AND {archived_condition(table_name)}"
+    params = [day_ms, day_ms + DAY_MS, max_id]
+    df = pd.read_sql_query(f"SELECT {', '.join(columns)} FROM {table_name} WHERE {condition}", conn, params=params)
+    if df.empty:
+        return 0
+
+    path = os.path.join(archive_dir, table_name, day_name(day_ms))
+    tmp_path, old_path = f"{path}.tmp", f"{path}.old"
+    recover_partition(path, old_path)
+    if os.path.isdir(path):
+        df = pd.concat([read_partition(path, list(columns)), df], ignore_index=True).drop_duplicates('id')
+    df = df.sort_values([FILTER_COLUMN[table_name], 'ts', 'id'], kind='stable')
+
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for column, dtype in columns.items():
+        np.save(os.path.join(tmp_path, f"{column}.npy"), df[column].to_numpy(dtype=dtype))
+    if os.path.isdir(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+    with conn:
+        deleted = conn.execute(f"DELETE FROM {table_name} WHERE {condition}", params).rowcount
+    logger.info(f"{table_name}: день {day_name(day_ms)} перенесен в архив, строк: {deleted}")
+    return deleted
+
+
+def archive_closed_days(conn, hot_days=HOT_DAYS, archive_dir=ARCHIVE_DIR):
+    """
+    Переносит в архив все дни старше hot_days. Перед переносом досчитываются агрегаты:
+    в архив уходят только строки, уже учтенные в агрегатах (id не больше rollup_state.last_id).
+    Возвращает кол-во перенесенных строк
+    """
+    update_rollups(conn)
+    cutoff = day_start(now_ms()) - (hot_days - 1) * DAY_MS
+    total = 0
+    for table_name in ARCHIVE_COLUMNS:
+        row = conn.execute("SELECT last_id FROM rollup_state WHERE table_name = ?", (table_name,)).fetchone()
+        max_id = row[0] if row else 0
+        ts = conn.execute(f"SELECT MIN(ts) FROM {table_name} WHERE ts < ?", (cutoff,)).fetchone()[0]
+        while ts is not None:
+            day_ms = day_start(ts)
+            total += archive_day(conn, table_name, day_ms, max_id, archive_dir)
+            # Следующий день с данными, пустые дни пропускаются
+            ts = conn.execute(f"SELECT MIN(ts) FROM {table_name} WHERE ts >= ? AND ts < ?",
+                              (day_ms + DAY_MS, cutoff)).fetchone()[0]
+    return total
+
+
+# === Чтение архива ===
+
+def read_partition(path, columns, ids=None, filter_column=None, start_ms=None, end_ms=None):
+    """
+    Столбцы одного раздела, отображенные в память. ids - значения filter_column: читаются только их участки,
+    найденные двоичным поиском по упорядоченному столбцу фильтра
+    """
+    arrays = {column: np.load(os.path.join(path, f"{column}.npy"), mmap_mode='r') for column in {*columns, 'ts'}}
+    if ids is not None:
+        keys = np.load(os.path.join(path, f"{filter_column}.npy"), mmap_mode='r')
+        wanted = np.array(sorted(ids), dtype=keys.dtype)
+        bounds = zip(np.searchsorted(keys, wanted, 'left'), np.searchsorted(keys, wanted, 'right'))
+        index = np.concatenate([np.arange(left, right) for left, right in bounds if right > left] or [np.empty(0, int)])
+    else:
+        index = np.arange(len(arrays['ts']))
+    if start_ms is not None or end_ms is not None:
+        ts = arrays['ts'][index]
+        mask = np.ones(len(index), dtype=bool)
+        if start_ms is not None:
+            mask &= ts >= start_ms
+        if end_ms is not None:
+            mask &= ts <= end_ms
+        index = index[mask]
+    return pd.DataFrame({column: arrays[column][index] for column in columns})
+
+
+def partitions(table_name, start_ms=None, end_ms=None, archive_dir=ARCHIVE_DIR):
+    """Разделы таблицы, пересекающиеся с периодом, по возрастанию дней"""
+    table_dir = os.path.join(archive_dir, table_name)
+    if not os.path.isdir(table_dir):
+        return []
+    result = []
+    for name in sorted(os.listdir(table_dir)):
+        if name.endswith(('.tmp', '.old')):
+            continue
+        day_ms = name_day(name)
+        if (start_ms is None or day_ms + DAY_MS > start_ms) and (end_ms is None or day_ms <= end_ms):
+            result.append(os.path.join(table_dir, name))
+    return result
+
+
+def read_archive(conn, table_name, columns, start_ms=None, end_ms=None, ids=None, archive_dir=ARCHIVE_DIR):
+    """
+    Строки архива за период со столбцами id, ts и columns. Имена инструментов (NAME_IDS) восстанавливаются
+    по справочнику instruments. ids - множество id для FILTER_COLUMN или None без фильтра
+    """
+    paths = partitions(table_name, start_ms, end_ms, archive_dir)
+    stored = ['id', 'ts', *dict.fromkeys(NAME_IDS.get(column, column) for column in columns)]
+    frames = [read_partition(path, stored, ids, FILTER_COLUMN[table_name], start_ms, end_ms) for path in paths]
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return pd.DataFrame(columns=['id', 'ts', *columns])
+    df = pd.concat(frames, ignore_index=True).sort_values(['ts', 'id'], kind='stable', ignore_index=True)
+    names = [column for column in columns if column in NAME_IDS]
+    if names:
+        instruments = dict(conn.execute("SELECT id, name FROM instruments").fetchall())
+        for column in names:
+            df[column] = df[NAME_IDS[column]].map(instruments)
+    return df[['id', 'ts', *columns]]
+
+
+# === Единый запрос к истории: горячее окно в SQLite и архив ===
+
+def filter_ids(conn, expiration_list=None, names=None):
+    """id инструментов по экспирациям и именам или None, если фильтра нет"""
+    if not expiration_list and not names:
+        return None
+    query, params = "SELECT id FROM instruments WHERE 1=1", []
+    if expiration_list:
+        query += f" AND expiration IN ({', '.join('?' * len(expiration_list))})"
+        params.extend(expiration_list)
+    if names:
+        query += f" AND name IN ({', '.join('?' * len(names))})"
+        params.extend(names)
+    return {row[0] for row in conn.execute(query, params)}
+
+
+def load_history(conn, table_name, columns, start_ms=None, end_ms=None, expiration_list=None, names=None,
+                 after_id=None, archive_dir=ARCHIVE_DIR):
+    """
+    История таблицы spreads / future_spreads по возрастанию времени со столбцами id, ts и columns.
+    expiration_list и names фильтруют по FILTER_COLUMN через справочник инструментов.
+    Горячее окно читается из SQLite, более старые дни - из разделов архива, попадающих в период.
+    after_id - дочитывание строк новее загруженных: они всегда в SQLite, архив не читается
+    """
+    filter_column = FILTER_COLUMN[table_name]
+    query = f"SELECT id, ts, {', '.join(columns)} FROM {table_name} WHERE 1=1"
+    params = []
+    if after_id is not None:
+        query += " AND id > ?"
+        params.append(int(after_id))
+    if expiration_list:
+        query += (f" AND {filter_column} IN (SELECT id FROM instruments"
+                  f" WHERE expiration IN ({', '.join('?' * len(expiration_list))}))")
+        params.extend(expiration_list)
+    if names:
+        query += f" AND {filter_column} IN (SELECT id FROM instruments WHERE name IN ({', '.join('?' * len(names))}))"
+        params.extend(names)
+    if start_ms is not None:
+        query += " AND ts >= ?"
+        params.append(start_ms)
+    if end_ms is not None:
+        query += " AND ts <= ?"
+        params.append(end_ms)
+    df = pd.read_sql_query(query + " ORDER BY ts", conn, params=params)
+    if after_id is not None:
+        return df
+
+    df_archive = read_archive(conn, table_name, columns, start_ms, end_ms,
+                              filter_ids(conn, expiration_list, names), archive_dir)
+    if df_archive.empty:
+        return df
+    # Сбой archive_day между подменой раздела и удалением из SQLite оставляет строки дня в обоих местах
+    # до следующего переноса: копии из SQLite отбрасываются по id, строки архива уже стоят на своих местах
+    df = df[~df['id'].isin(df_archive['id'])]
+    if df.empty:
+        return df_archive
+    return pd.concat([df_archive, df], ignore_index=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Перенос закрытых дней истории спредов из SQLite в архив по дням')
+    parser.add_argument('db_path', nargs='?', default=DB_PATH, help=f'Путь к БД (по умолчанию {DB_PATH})')
+    parser.add_argument('--archive-dir', default=ARCHIVE_DIR, help=f'Каталог архива (по умолчанию {ARCHIVE_DIR})')
+    parser.add_argument('--hot-days', type=int, default=HOT_DAYS,
+                        help=f'Дней, которые остаются в SQLite (по умолчанию {HOT_DAYS} - только текущий)')
+    parser.add_argument('--loop', type=float, default=None, help='Переносить постоянно с заданным интервалом, с')
+    args = parser.parse_args()
+
+    setup_logging('logs.log', level=logging.INFO)  # Лог записываем в файл и выводим на консоль
+    init_db(args.db_path)
+    conn = connect(args.db_path)
+    try:
+        while True:
+            logger.info(f"Перенесено в архив строк: {archive_closed_days(conn, args.hot_days, args.archive_dir)}")
+            if args.loop is None:
+                break
+            time.sleep(args.loop)
+    finally:
+        conn.close()
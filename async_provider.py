@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from quote_pool import fetch_quote
+
+logger = logging.getLogger('async_provider.py')
+
+
+class AsyncProvider:
+    """
+    Асинхронный интерфейс к синхронным подключениям QuikPy.
+    Запросы выполняются в потоках, по одному запросу на подключение одновременно (сокет QuikPy не допускает
+    параллельных запросов): с N подключениями в работе N запросов, остальные ждут свободное подключение,
+    не блокируя цикл событий
+    """
+
+    def __init__(self, providers, own_from=0):
+        self.providers = list(providers)
+        self.own_from = own_from  # Подключения начиная с этого номера закрываются в close
+        self.executor = ThreadPoolExecutor(max_workers=len(self.providers), thread_name_prefix='AsyncProvider')
+        self.free = None  # Очередь свободных подключений, создается в цикле событий
+
+    async def run(self, func, *args):
+        """Выполняет func(provider, *args) на свободном подключении"""
+        if self.free is None:
+            self.free = asyncio.Queue()
+            for provider in self.providers:
+                self.free.put_nowait(provider)
+        provider = await self.free.get()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, provider, *args)
+        finally:
+            self.free.put_nowait(provider)
+
+    async def dataname_to_class_sec_codes(self, dataname):
+        return await self.run(lambda provider: provider.dataname_to_class_sec_codes(dataname))
+
+    async def get_symbol_info(self, class_code, sec_code):
+        return await self.run(lambda provider: provider.get_symbol_info(class_code, sec_code))
+
+    async def get_param_ex(self, class_code, sec_code, param_name):
+        return await self.run(lambda provider: provider.get_param_ex(class_code, sec_code, param_name))
+
+    async def get_quote_level2(self, class_code, sec_code):
+        return await self.run(lambda provider: provider.get_quote_level2(class_code, sec_code))
+
+    async def get_quote(self, class_code, sec_code):
+        return await self.run(fetch_quote, class_code, sec_code)
+
+    async def get_quotes(self, specs):
+        """specs - {dataname: спецификация}. Все запросы ставятся сразу, возвращает {dataname: (bid, offer)}"""
+        datanames = list(specs)
+        results = await asyncio.gather(*(self.get_quote(specs[dataname]['class_code'], specs[dataname]['sec_code'])
+                                         for dataname in datanames), return_exceptions=True)
+        quotes = {}
+        for dataname, result in zip(datanames, results):
+            if isinstance(result, Exception):
+                logger.error(f"Не удалось получить котировки по {dataname}. Ошибка: {result}")
+            else:
+                quotes[dataname] = result
+        return quotes
+
+    def close(self):
+        self.executor.shutdown()
+        for provider in self.providers[self.own_from:]:
+            provider.close_connection_and_thread()
+
+
+class SyncProvider:
+    """
+    Синхронный адаптер к AsyncProvider с методами QuikPy, которые использует spread.py.
+    Позволяет вызывать get_info и SpecCache.get_or_load, не зная об asyncio: корутины выполняются в цикле событий
+    loop (по умолчанию - собственном, в фоновом потоке)
+    """
+
+    def __init__(self, async_provider, loop=None):
+        self.async_provider = async_provider
+        self.loop = loop
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, name='SyncProvider', daemon=True).start()
+
+    def call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def dataname_to_class_sec_codes(self, dataname):
+        return self.call(self.async_provider.dataname_to_class_sec_codes(dataname))
+
+    def get_symbol_info(self, class_code, sec_code):
+        return self.call(self.async_provider.get_symbol_info(class_code, sec_code))
+
+    def get_param_ex(self, class_code, sec_code, param_name):
+        return self.call(self.async_provider.get_param_ex(class_code, sec_code, param_name))
+
+    def get_quote_level2(self, class_code, sec_code):
+        return self.call(self.async_provider.get_quote_level2(class_code, sec_code))
+
+    @property
+    def tz_msk(self):
+        return self.async_provider.providers[0].tz_msk
+
+    def close_connection_and_thread(self):
+        self.async_provider.close()
+
+
+# Кладет элемент в ограниченную очередь, вытесняя самый старый: потребителю нужен последний снимок, а не все подряд
+def put_latest(queue, item):
+    """Возвращает True, если пришлось выбросить необработанный элемент"""
+    dropped = False
+    while True:
+        try:
+            queue.put_nowait(item)
+            return dropped
+        except asyncio.QueueFull:
+            queue.get_nowait()
+            dropped = True
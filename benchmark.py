@@ -0,0 +1,296 @@
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+from db import ROW_COLUMNS, connect, fill_latest, init_db, now_ms, register_instruments
+from db_writer import BatchWriter
+from log_setup import setup_logging
+from quik_sim import SEED, SimMarket, QuikSim, future_exp_date, quarterly_expirations
+from rollup import update_rollups
+from spec_cache import SpecCache
+
+SIZES = {'100k': 100_000, '1M': 1_000_000, '10M': 10_000_000}  # Строк spreads в синтетической БД
+SHARES = 100  # Акций в синтетических данных
+FUTURES_PER_SHARE = 2  # Фьючерсов на акцию
+INTERVAL_MS = 5000  # Шаг времени между снимками, мс
+LOT_SIZE = 100
+CHUNK_ROWS = 200_000  # Строк в одной транзакции заполнения
+REPEAT = 5  # Повторов каждого замера
+CYCLES = 20  # Проходов сборщика
+PERIODS = (1, 7, 0)  # Периоды графиков для замера callback'ов, дней (0 - вся история)
+DB_DIR = "data/benchmark"
+RESULTS_PATH = "data/benchmark_results.jsonl"  # Результаты запусков, по строке JSON на запуск
+
+logger = logging.getLogger('benchmark.py')
+
+
+# Вставка с готовыми id инструментов, без поиска по справочнику на каждую строку
+def fill_sql(table_name, id_columns):
+    columns = [*ROW_COLUMNS[table_name], *id_columns]
+    return f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+
+
+# Синтетическая история спредов: rows строк spreads и по строке future_spreads на пару соседних фьючерсов акции
+def fill_db(db_path, rows, shares=SHARES, futures_per_share=FUTURES_PER_SHARE, seed=SEED):
+    """
+    Цены акций - случайное блуждание, керри каждого фьючерса блуждает около 10-20% годовых.
+    Имена инструментов как в quik_sim.write_watchlist, поэтому сборщик на модели QUIK пишет в те же инструменты.
+    Возвращает время заполнения и построения агрегатов, с
+    """
+    rng = np.random.default_rng(seed)
+    share_names = [f"S{i:04d}" for i in range(shares)]
+    expirations = quarterly_expirations(futures_per_share)
+    future_names = [f"{share}-{expiration}" for share in share_names for expiration in expirations]
+    future_share = np.repeat(np.arange(shares), futures_per_share)  # Номер акции каждого фьючерса
+    exp_ms = np.array([datetime.strptime(str(future_exp_date(name)), '%Y%m%d').timestamp() * 1000 for name in future_names])
+    near = np.arange(len(future_names)).reshape(shares, futures_per_share)[:, :-1].ravel()  # Пары соседних фьючерсов
+    far = near + 1
+
+    init_db(db_path)
+    conn = connect(db_path)
+    try:
+        with conn:
+            register_instruments(conn, [{'name': name, 'kind': 'share', 'underlying': name, 'exp_date': None,
+                                         'lot_size': 1, 'class_code': 'TQBR', 'sec_code': name} for name in share_names] +
+                                 [{'name': name, 'kind': 'future', 'underlying': share_names[future_share[i]],
+                                   'exp_date': future_exp_date(name), 'lot_size': LOT_SIZE, 'class_code': 'SPBFUT',
+                                   'sec_code': name} for i, name in enumerate(future_names)])
+        ids = dict(conn.execute("SELECT name, id FROM instruments"))
+        share_ids = np.array([ids[name] for name in share_names])[future_share].tolist()
+        future_ids = [ids[name] for name in future_names]
+        spreads_sql = fill_sql('spreads', ('share_id', 'future_id'))
+        future_spreads_sql = fill_sql('future_spreads', ('near_id', 'far_id'))
+
+        ticks = math.ceil(rows / len(future_names))
+        end_ms = now_ms() // INTERVAL_MS * INTERVAL_MS
+        start_ms = end_ms - (ticks - 1) * INTERVAL_MS
+        share_price = rng.uniform(50, 500, shares)
+        kerry = rng.uniform(10, 20, len(future_names))
+        chunk_ticks = max(1, CHUNK_ROWS // len(future_names))
+        written = 0
+        start = time.perf_counter()
+        for first_tick in range(0, ticks, chunk_ticks):
+            n = min(chunk_ticks, ticks - first_tick)
+            ts = start_ms + (first_tick + np.arange(n)) * INTERVAL_MS
+            prices = share_price * np.exp(np.cumsum(rng.normal(0, 0.0005, (n, shares)), axis=0))
+            kerries = np.clip(kerry + np.cumsum(rng.normal(0, 0.05, (n, len(future_names))), axis=0), -50, 50)
+            share_price, kerry = prices[-1], kerries[-1]
+
+            bid_share = np.round(prices[:, future_share], 2)
+            offer_share = bid_share + 0.01
+            exp_days = np.maximum(np.ceil((exp_ms - ts[:, None]) / 86_400_000), 1)
+            bid_future = np.round(offer_share * LOT_SIZE * (1 + kerries / 100 * exp_days / 365))
+            offer_future = bid_future + 1
+            buy = (bid_future - offer_share * LOT_SIZE) / (offer_share * LOT_SIZE) / exp_days * 365 * 100
+            sell = (offer_future - bid_share * LOT_SIZE) / (bid_share * LOT_SIZE) / exp_days * 365 * 100
+
+            spread_bid = bid_future[:, far] - offer_future[:, near]
+            spread_offer = offer_future[:, far] - bid_future[:, near]
+            spread_bid_y = spread_bid / (offer_share[:, far] * LOT_SIZE) / exp_days[:, far] * 365 * 100
+            spread_offer_y = spread_offer / (bid_share[:, far] * LOT_SIZE) / exp_days[:, far] * 365 * 100
+
+            take = min(n * len(future_names), rows - written)
+            spread_rows = zip(np.repeat(ts, len(future_names)).tolist(),
+                              [share_names[i] for i in future_share] * n, bid_share.ravel().tolist(),
+                              offer_share.ravel().tolist(), future_names * n, bid_future.ravel().tolist(),
+                              offer_future.ravel().tolist(), [LOT_SIZE] * (n * len(future_names)),
+                              exp_days.astype(int).ravel().tolist(), np.round(buy, 2).ravel().tolist(),
+                              np.round(sell, 2).ravel().tolist(), share_ids * n, future_ids * n)
+            future_spread_rows = zip(np.repeat(ts, len(near)).tolist(), [future_names[i] for i in near] * n,
+                                     [future_names[i] for i in far] * n, spread_bid.ravel().tolist(),
+                                     spread_offer.ravel().tolist(), np.round(spread_bid_y, 2).ravel().tolist(),
+                                     np.round(spread_offer_y, 2).ravel().tolist(),
+                                     exp_days[:, far].astype(int).ravel().tolist(),
+                                     [future_ids[i] for i in near] * n, [future_ids[i] for i in far] * n)
+            with conn:
+                conn.executemany(spreads_sql, (row for _, row in zip(range(take), spread_rows)))
+                conn.executemany(future_spreads_sql, future_spread_rows)
+            written += take
+        with conn:
+            fill_latest(conn.cursor())
+        fill_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        update_rollups(conn)
+        rollup_seconds = time.perf_counter() - start
+    finally:
+        conn.close()
+    logger.info(f"БД {db_path} заполнена: {written} строк за {fill_seconds:.1f} с, агрегаты за {rollup_seconds:.1f} с")
+    return {'rows': written, 'fill_seconds': round(fill_seconds, 3), 'rows_per_sec': round(written / fill_seconds),
+            'rollup_seconds': round(rollup_seconds, 3)}
+
+
+# Кол-во строк в уже заполненной БД или 0, если ее нет
+def db_rows(db_path):
+    if not os.path.exists(db_path):
+        return 0
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM spreads").fetchone()[0]
+    except sqlite3.Error:
+        return 0
+    finally:
+        conn.close()
+
+
+# Статистика времени выполнения в мс
+def timings(values):
+    values = sorted(value * 1000 for value in values)
+    return {'repeat': len(values), 'min_ms': round(values[0], 3), 'median_ms': round(statistics.median(values), 3),
+            'p95_ms': round(values[min(len(values) - 1, math.ceil(len(values) * 0.95) - 1)], 3),
+            'max_ms': round(values[-1], 3)}
+
+
+def measure(func, repeat=REPEAT):
+    values = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        values.append(time.perf_counter() - start)
+    return timings(values)
+
+
+# Проходы сборщика spread.run_cycle на модели QUIK с записью в БД через BatchWriter
+def bench_collector(db_path, cycles=CYCLES, shares=SHARES, futures_per_share=FUTURES_PER_SHARE, seed=SEED):
+    import spread  # Модуль сборщика с глобальным подключением к QUIK, которое задается здесь, а не в __main__
+
+    expirations = quarterly_expirations(futures_per_share)
+    list_datanames = [{f"S{i:04d}": [f"S{i:04d}-{expiration}" for expiration in expirations]} for i in range(shares)]
+    market = SimMarket(seed=seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        spread.logger = logging.getLogger('spread.py')
+        spread.spec_cache = SpecCache(os.path.join(tmp_dir, 'specs_cache.json'))
+        spread.qp_provider = QuikSim(market)
+        try:
+            market.link(list_datanames)
+            spread.register_watchlist(db_path, list_datanames)
+            spread.load_specs([name for datanames in list_datanames for share, futures in datanames.items()
+                               for name in [share, *futures]])  # Спецификации загружаются до замера
+
+            writer = BatchWriter(db_path)
+            values = []
+            start = time.perf_counter()
+            with writer:
+                for _ in range(cycles):
+                    cycle_start = time.perf_counter()
+                    spread.run_cycle(writer, list_datanames)
+                    values.append(time.perf_counter() - cycle_start)
+            elapsed = time.perf_counter() - start  # Вместе с записью всех строк в БД
+        finally:
+            spread.qp_provider.close_connection_and_thread()
+    return {'cycles': cycles, 'instruments': shares * (1 + futures_per_share),
+            'cycles_per_sec': round(cycles / sum(values), 3), 'cycle': timings(values),
+            'rows_written': writer.rows_written, 'rows_per_sec': round(writer.rows_written / elapsed),
+            'writer_rows_per_sec': round(writer.rows_per_sec())}
+
+
+# Запросы сборщика и request_bd.py
+def bench_queries(db_path, repeat=REPEAT):
+    import request_bd
+    from spread import get_top_by_kerry_sell
+
+    conn = sqlite3.connect(db_path)
+    try:
+        cursor = conn.cursor()
+        return {
+            'get_top_by_kerry_sell': measure(lambda: get_top_by_kerry_sell(db_path), repeat),
+            'request_bd.get_top_spreads': measure(lambda: request_bd.get_top_spreads(cursor), repeat),
+            'request_bd.get_top_future_spreads': measure(lambda: request_bd.get_top_future_spreads(cursor), repeat),
+        }
+    finally:
+        conn.close()
+
+
+# Callback'и app.py, вызванные напрямую: таблица, затем графики первой страницы по ее ключам кэша
+def bench_callbacks(db_path, repeat=REPEAT, periods=PERIODS):
+    import app
+
+    app.DB_PATH = db_path
+    results = {}
+    for period_days in periods:
+        for name, update_table, update_graphs, table_args in (
+                ('spreads', app.update_table, app.update_graphs, (None, None, 'kerry_buy_spread_y', None, None)),
+                ('future_spreads', app.update_future_table, app.update_future_graphs, (None, 'spread_bid_y'))):
+            app.df_cache.clear()
+            table_values, graph_values = [], []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                _, filtered_key, sorted_key = update_table(*table_args, period_days)
+                table_values.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                update_graphs(0, 10, filtered_key, sorted_key)
+                graph_values.append(time.perf_counter() - start)
+            results[f"{update_table.__name__}[period={period_days}]"] = timings(table_values)
+            results[f"{update_graphs.__name__}[period={period_days}]"] = timings(graph_values)
+    app.df_cache.clear()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Полный замер для одного размера БД
+def run_benchmark(size, db_dir=DB_DIR, refill=False, repeat=REPEAT, cycles=CYCLES, shares=SHARES,
+                  futures_per_share=FUTURES_PER_SHARE):
+    rows = SIZES[size]
+    os.makedirs(db_dir, exist_ok=True)
+    db_path = os.path.join(db_dir, f"bench_{size}.db")
+    result = {'size': size, 'rows': rows}
+    if refill or db_rows(db_path) < rows:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+        result['fill'] = fill_db(db_path, rows, shares, futures_per_share)
+    else:
+        init_db(db_path)  # Таблицы, добавленные после заполнения БД
+        logger.info(f"Используется заполненная БД {db_path}")
+    # Запросы и callback'и - до сборщика, чтобы его строки не попали в последние значения
+    result['queries'] = bench_queries(db_path, repeat)
+    result['callbacks'] = bench_callbacks(db_path, repeat)
+    result['collector'] = bench_collector(db_path, cycles, shares, futures_per_share)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Замер производительности сборщика, БД и callback\'ов dash')
+    parser.add_argument('--sizes', nargs='+', choices=SIZES, default=list(SIZES), help='Размеры синтетической БД')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='Повторов каждого замера')
+    parser.add_argument('--cycles', type=int, default=CYCLES, help='Проходов сборщика')
+    parser.add_argument('--shares', type=int, default=SHARES, help='Акций в синтетических данных')
+    parser.add_argument('--futures', type=int, default=FUTURES_PER_SHARE, help='Фьючерсов на акцию')
+    parser.add_argument('--db-dir', default=DB_DIR, help='Папка синтетических БД (переиспользуются между запусками)')
+    parser.add_argument('--refill', action='store_true', help='Заполнить БД заново')
+    parser.add_argument('--output', default=RESULTS_PATH, help='Файл результатов, строка JSON дописывается в конец')
+    args = parser.parse_args()
+
+    setup_logging(level=logging.WARNING)  # Подробный лог сборщика и dash искажает замеры
+    logger.setLevel(logging.INFO)
+
+    report = {'timestamp': datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(),
+              'python': platform.python_version(), 'platform': platform.platform(), 'results': []}
+    for size in args.sizes:
+        logger.info(f"Замер на {size} строк")
+        result = run_benchmark(size, args.db_dir, args.refill, args.repeat, args.cycles, args.shares, args.futures)
+        report['results'].append(result)
+        logger.info(json.dumps(result, ensure_ascii=False))
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, mode='a', encoding='utf-8') as f:
+        f.write(json.dumps(report, ensure_ascii=False) + '\n')
+    logger.info(f"Результаты записаны в {args.output}")
@@ -0,0 +1,101 @@
+from datetime import datetime
+
+import numpy as np
+
+DAYS_YEAR = 365  # дней в году
+
+
+# Кол-во дней до экспирации по дате в формате "20250620"
+def calc_exp_days(exp_date, now=None):
+    converted_date = datetime.strptime(str(exp_date), "%Y%m%d")
+    return (converted_date - (now or datetime.now())).days + 1
+
+
+# Годовой керри между акцией и фьючерсом
+def calc_kerry(bid_share, offer_share, bid_future, offer_future, lot_size_future, exp_days):
+    """Возвращает (kerry_buy_spread_y, kerry_sell_spread_y) в % годовых"""
+    # Продажа спреда: покупка акции по предложению и продажа фьючерса по спросу
+    diff_buy_spread = bid_future - offer_share * lot_size_future
+    kerry_buy_spread_y = round(diff_buy_spread / (offer_share * lot_size_future) / exp_days * DAYS_YEAR * 100, 2)
+
+    # Покупка спреда: продажа акции по спросу и покупка фьючерса по предложению
+    diff_sell_spread = offer_future - bid_share * lot_size_future
+    kerry_sell_spread_y = round(diff_sell_spread / (bid_share * lot_size_future) / exp_days * DAYS_YEAR * 100, 2)
+    return kerry_buy_spread_y, kerry_sell_spread_y
+
+
+# Календарный спред между ближним и дальним фьючерсом
+def calc_calendar_spread(near_bid, near_offer, far_bid, far_offer, far_bid_share, far_offer_share, far_exp_days):
+    """
+    far_bid_share, far_offer_share - цены акции с учетом лота дальнего фьючерса.
+    Возвращает (spread_bid, spread_offer, spread_bid_y, spread_offer_y)
+    """
+    # Расчет спроса для спреда (по какой "цене" продать КС)
+    spread_bid = far_bid - near_offer
+    # Доходность годовых = (спред / предложение акции с учетом лота) / кол-во дней до эксп дальнего фчс * кол-во дней * 100%
+    spread_bid_y = (spread_bid / far_offer_share) / far_exp_days * DAYS_YEAR * 100
+
+    # Расчет предложения для спреда (по какой "цене" купить КС)
+    spread_offer = far_offer - near_bid
+    # Доходность годовых = (спред / спрос акции с учетом лота) / кол-во дней до эксп дальнего фчс * кол-во дней * 100%
+    spread_offer_y = (spread_offer / far_bid_share) / far_exp_days * DAYS_YEAR * 100
+    return spread_bid, spread_offer, round(spread_bid_y, 2), round(spread_offer_y, 2)
+
+
+# === Пакетный расчет по массивам ===
+# Формулы и порядок операций совпадают с calc_kerry и calc_calendar_spread, поэтому результаты совпадают до бита.
+# Округление не выполняется: его делает вызывающий код при формировании строк через round, как и в скалярном расчете.
+
+# Годовой керри между акцией и фьючерсом для всех фьючерсов сразу
+def calc_kerry_batch(bid_share, offer_share, bid_future, offer_future, lot_size_future, exp_days):
+    """
+    Все аргументы - массивы одной длины (по одному элементу на фьючерс), цены акции - без учета лота.
+    Возвращает массивы (kerry_buy_spread_y, kerry_sell_spread_y) в % годовых
+    """
+    offer_share_lot = offer_share * lot_size_future
+    bid_share_lot = bid_share * lot_size_future
+    kerry_buy_spread_y = (bid_future - offer_share_lot) / offer_share_lot / exp_days * DAYS_YEAR * 100
+    kerry_sell_spread_y = (offer_future - bid_share_lot) / bid_share_lot / exp_days * DAYS_YEAR * 100
+    return kerry_buy_spread_y, kerry_sell_spread_y
+
+
+# Индексы всех календарных пар ближний/дальний внутри каждой акции
+def calendar_pair_indices(share_ids, exp_days):
+    """
+    share_ids - номер акции для каждого фьючерса, exp_days - дней до экспирации.
+    Возвращает массивы (near_idx, far_idx) индексов фьючерсов. Внутри акции фьючерсы упорядочены по exp_days
+    (при равенстве - в исходном порядке), пары перечисляются так же, как во вложенном цикле for i / for j
+    """
+    share_ids = np.asarray(share_ids)
+    order = np.lexsort((exp_days, share_ids))  # Сортировка по акции, затем по дням до экспирации (устойчивая)
+    sorted_ids = share_ids[order]
+    bounds = np.flatnonzero(np.diff(sorted_ids)) + 1
+    starts = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [len(order)]))
+
+    near_idx, far_idx = [], []
+    for start, end in zip(starts, ends):
+        if end - start < 2:
+            continue
+        i, j = np.triu_indices(end - start, k=1)
+        near_idx.append(order[start + i])
+        far_idx.append(order[start + j])
+    if not near_idx:
+        empty = np.empty(0, dtype=np.intp)
+        return empty, empty
+    return np.concatenate(near_idx), np.concatenate(far_idx)
+
+
+# Календарные спреды для всех пар сразу
+def calc_calendar_spreads_batch(bid_future, offer_future, bid_share_lot, offer_share_lot, exp_days, near_idx, far_idx):
+    """
+    Массивы по фьючерсам: цены фьючерса, цены акции с учетом лота фьючерса, дней до экспирации.
+    near_idx, far_idx - индексы пар из calendar_pair_indices.
+    Возвращает массивы (spread_bid, spread_offer, spread_bid_y, spread_offer_y) по парам
+    """
+    far_exp_days = exp_days[far_idx]
+    spread_bid = bid_future[far_idx] - offer_future[near_idx]
+    spread_bid_y = (spread_bid / offer_share_lot[far_idx]) / far_exp_days * DAYS_YEAR * 100
+    spread_offer = offer_future[far_idx] - bid_future[near_idx]
+    spread_offer_y = (spread_offer / bid_share_lot[far_idx]) / far_exp_days * DAYS_YEAR * 100
+    return spread_bid, spread_offer, spread_bid_y, spread_offer_y
@@ -0,0 +1,59 @@
+from db import ROW_COLUMNS
+
+EPSILON = 0.0  # Относительное изменение цены, ниже которого строка считается неизменной (0 - любое изменение)
+HEARTBEAT = 60  # Строка без изменений все равно записывается раз в столько секунд, 0 - записывать все строки
+
+# Ключ строки (фьючерс или пара фьючерсов) и столбцы, изменение которых требует записи, по таблицам
+KEY_COLUMNS = {
+    'spreads': ('name_future',),
+    'future_spreads': ('near_future', 'far_future'),
+}
+VALUE_COLUMNS = {
+    'spreads': ('bid_share', 'offer_share', 'bid_future', 'offer_future', 'exp_days'),
+    'future_spreads': ('spread_bid', 'spread_offer', 'far_exp_days'),
+}
+
+
+class ChangeFilter:
+    """
+    Последнее записанное состояние по каждому фьючерсу и паре фьючерсов. Пропускает на запись строку,
+    только если котировки изменились больше чем на epsilon или с прошлой записи прошло heartbeat секунд.
+    Неликвидные дальние фьючерсы не раздувают БД одинаковыми строками, пропуски на графиках заполняет
+    последнее значение (ступенчатая линия в app.py)
+    """
+
+    def __init__(self, epsilon=EPSILON, heartbeat=HEARTBEAT):
+        self.epsilon = epsilon
+        self.heartbeat_ms = heartbeat * 1000
+        self.state = {}  # {(таблица, ключ): (ts, значения)}
+        self.indices = {table: ([columns.index(column) for column in KEY_COLUMNS[table]],
+                                [columns.index(column) for column in VALUE_COLUMNS[table]])
+                        for table, columns in ROW_COLUMNS.items()}
+        self.passed = 0
+        self.skipped = 0
+
+    def filter(self, table_name, rows):
+        """Строки из rows, которые нужно записать. Ts строки - первый столбец, в мс"""
+        if not self.heartbeat_ms:
+            return rows
+        key_indices, value_indices = self.indices[table_name]
+        result = []
+        for row in rows:
+            key = (table_name, *(row[i] for i in key_indices))
+            values = [row[i] for i in value_indices]
+            last = self.state.get(key)
+            if last is None or row[0] - last[0] >= self.heartbeat_ms or self.changed(last[1], values):
+                self.state[key] = (row[0], values)
+                result.append(row)
+        self.passed += len(result)
+        self.skipped += len(rows) - len(result)
+        return result
+
+    def changed(self, old_values, new_values):
+        for old, new in zip(old_values, new_values):
+            if old is None or new is None:
+                if old is not new:
+                    return True
+            elif abs(new - old) > self.epsilon * abs(old):
+                return True
+        return False
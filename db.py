@@ -0,0 +1,398 @@
+import re
+import sqlite3
+import time
+
+import pandas as pd
+
+DB_PATH = "data/futures_spreads.db"
+TZ = 'Europe/Moscow'  # Часовой пояс для отображения времени
+EXPIRATION_RE = re.compile(r'-(\d+\.\d+)$')  # Код экспирации в имени фьючерса
+
+# Настройки подключения: журнал WAL позволяет читать БД (app.py) во время записи сборщиком,
+# synchronous=NORMAL в режиме WAL не теряет целостность, но не делает fsync на каждую транзакцию
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-65536",  # Кэш страниц 64 МБ
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",  # Ожидание блокировки до 5 с вместо немедленной ошибки
+)
+
+# Столбцы строк, которые сборщик передает на запись, по таблицам (порядок параметров ?1..?N в INSERT_SQL)
+ROW_COLUMNS = {
+    'spreads': ('ts', 'name_share', 'bid_share', 'offer_share', 'name_future', 'bid_future', 'offer_future',
+                'lot_size_future', 'exp_days', 'kerry_buy_spread_y', 'kerry_sell_spread_y'),
+    'future_spreads': ('ts', 'near_future', 'far_future', 'spread_bid', 'spread_offer',
+                       'spread_bid_y', 'spread_offer_y', 'far_exp_days'),
+}
+
+# id инструмента по имени из n-го параметра вставки. Поиск по уникальному индексу instruments.name
+INSTRUMENT_ID = {n: f"(SELECT id FROM instruments WHERE name = ?{n})" for n in (2, 3, 5)}
+
+# SQL вставки по таблицам, собирается один раз.
+# Строки передаются с именами инструментов, id подставляются из справочника instruments
+INSERT_SQL = {
+    'spreads': f'''
+        INSERT INTO spreads (
+            ts, name_share, bid_share, offer_share,
+            name_future, bid_future, offer_future,
+            lot_size_future, exp_days, kerry_buy_spread_y, kerry_sell_spread_y,
+            share_id, future_id
+        ) VALUES (?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8, ?9, ?10, ?11, {INSTRUMENT_ID[2]}, {INSTRUMENT_ID[5]})
+    ''',
+    'future_spreads': f'''
+        INSERT INTO future_spreads (
+            ts, near_future, far_future, spread_bid,
+            spread_offer, spread_bid_y, spread_offer_y, far_exp_days,
+            near_id, far_id
+        ) VALUES (?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8, {INSTRUMENT_ID[2]}, {INSTRUMENT_ID[3]})
+    ''',
+}
+
+# Обновление таблиц последних значений: одна строка на фьючерс / пару фьючерсов.
+# Более старая строка не затирает более новую
+UPSERT_LATEST_SQL = {
+    'spreads': f'''
+        INSERT INTO spreads_latest (
+            ts, name_share, bid_share, offer_share,
+            name_future, bid_future, offer_future,
+            lot_size_future, exp_days, kerry_buy_spread_y, kerry_sell_spread_y,
+            future_id
+        ) VALUES (?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8, ?9, ?10, ?11, {INSTRUMENT_ID[5]})
+        ON CONFLICT (name_future) DO UPDATE SET
+            ts = excluded.ts, name_share = excluded.name_share, future_id = excluded.future_id,
+            bid_share = excluded.bid_share, offer_share = excluded.offer_share,
+            bid_future = excluded.bid_future, offer_future = excluded.offer_future,
+            lot_size_future = excluded.lot_size_future, exp_days = excluded.exp_days,
+            kerry_buy_spread_y = excluded.kerry_buy_spread_y, kerry_sell_spread_y = excluded.kerry_sell_spread_y
+        WHERE excluded.ts >= spreads_latest.ts
+    ''',
+    'future_spreads': f'''
+        INSERT INTO future_spreads_latest (
+            ts, near_future, far_future, spread_bid,
+            spread_offer, spread_bid_y, spread_offer_y, far_exp_days,
+            near_id, far_id
+        ) VALUES (?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8, {INSTRUMENT_ID[2]}, {INSTRUMENT_ID[3]})
+        ON CONFLICT (near_future, far_future) DO UPDATE SET
+            ts = excluded.ts, near_id = excluded.near_id, far_id = excluded.far_id,
+            spread_bid = excluded.spread_bid, spread_offer = excluded.spread_offer,
+            spread_bid_y = excluded.spread_bid_y, spread_offer_y = excluded.spread_offer_y,
+            far_exp_days = excluded.far_exp_days
+        WHERE excluded.ts >= future_spreads_latest.ts
+    ''',
+}
+
+
+# Керри и календарные спреды по средневзвешенным ценам стаканов для заданных объемов (order_book.py).
+# Хранятся только последние значения: одна строка на фьючерс (пару) и объем
+DEPTH_COLUMNS = {
+    'spreads_depth': ('ts', 'name_share', 'name_future', 'size', 'bid_share', 'offer_share', 'bid_future', 'offer_future',
+                      'kerry_buy_spread_y', 'kerry_sell_spread_y'),
+    'future_spreads_depth': ('ts', 'near_future', 'far_future', 'size', 'spread_bid', 'spread_offer',
+                             'spread_bid_y', 'spread_offer_y'),
+}
+DEPTH_KEYS = {'spreads_depth': ('name_future', 'size'), 'future_spreads_depth': ('near_future', 'far_future', 'size')}
+UPSERT_DEPTH_SQL = {
+    table_name: f'''
+        INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})
+        ON CONFLICT ({', '.join(DEPTH_KEYS[table_name])}) DO UPDATE SET
+            {', '.join(f"{column} = excluded.{column}" for column in columns if column not in DEPTH_KEYS[table_name])}
+        WHERE excluded.ts >= {table_name}.ts
+    '''
+    for table_name, columns in DEPTH_COLUMNS.items()
+}
+
+# SQL записи строк сборщика по таблицам (BatchWriter): история с таблицей последних значений или только последние значения
+WRITE_SQL = {
+    **{table_name: (INSERT_SQL[table_name], UPSERT_LATEST_SQL[table_name]) for table_name in INSERT_SQL},
+    **{table_name: (sql,) for table_name, sql in UPSERT_DEPTH_SQL.items()},
+}
+
+
+# Подключение к БД с настройками для постоянной записи
+def connect(db_path=DB_PATH, **kwargs):
+    conn = sqlite3.connect(db_path, **kwargs)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+# Описание таблиц
+SCHEMA = {
+    # Справочник инструментов. Заполняется сборщиком из спецификаций QUIK
+    'instruments': '''
+        CREATE TABLE IF NOT EXISTS instruments (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,  -- Короткое имя, как в таблицах спредов
+            kind TEXT NOT NULL,  -- share / future
+            underlying TEXT,  -- Акция, на которую торгуется фьючерс
+            expiration TEXT,  -- Код экспирации из имени фьючерса, например 9.25
+            exp_date INTEGER,  -- Дата экспирации в формате 20250918
+            lot_size REAL,
+            class_code TEXT,
+            sec_code TEXT
+        )
+    ''',
+    'spreads': '''
+        CREATE TABLE IF NOT EXISTS spreads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts INTEGER NOT NULL,  -- Время в миллисекундах от начала эпохи (UTC)
+            name_share TEXT,
+            bid_share REAL,
+            offer_share REAL,
+            name_future TEXT,
+            bid_future REAL,
+            offer_future REAL,
+            lot_size_future REAL,
+            exp_days INTEGER,
+            kerry_buy_spread_y REAL,
+            kerry_sell_spread_y REAL,
+            share_id INTEGER REFERENCES instruments (id),
+            future_id INTEGER REFERENCES instruments (id)
+        )
+    ''',
+    'future_spreads': '''
+        CREATE TABLE IF NOT EXISTS future_spreads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts INTEGER NOT NULL,  -- Время в миллисекундах от начала эпохи (UTC)
+            near_future TEXT,
+            far_future TEXT,
+            spread_bid REAL,
+            spread_offer REAL,
+            spread_bid_y REAL,
+            spread_offer_y REAL,
+            far_exp_days INTEGER,
+            near_id INTEGER REFERENCES instruments (id),
+            far_id INTEGER REFERENCES instruments (id)
+        )
+    ''',
+    # Последние значения по каждому фьючерсу, обновляются сборщиком при каждой записи
+    'spreads_latest': '''
+        CREATE TABLE IF NOT EXISTS spreads_latest (
+            name_future TEXT PRIMARY KEY,
+            ts INTEGER NOT NULL,
+            name_share TEXT,
+            bid_share REAL,
+            offer_share REAL,
+            bid_future REAL,
+            offer_future REAL,
+            lot_size_future REAL,
+            exp_days INTEGER,
+            kerry_buy_spread_y REAL,
+            kerry_sell_spread_y REAL,
+            future_id INTEGER REFERENCES instruments (id)
+        )
+    ''',
+    # Последние значения по каждой паре фьючерсов
+    'future_spreads_latest': '''
+        CREATE TABLE IF NOT EXISTS future_spreads_latest (
+            near_future TEXT NOT NULL,
+            far_future TEXT NOT NULL,
+            ts INTEGER NOT NULL,
+            spread_bid REAL,
+            spread_offer REAL,
+            spread_bid_y REAL,
+            spread_offer_y REAL,
+            far_exp_days INTEGER,
+            near_id INTEGER REFERENCES instruments (id),
+            far_id INTEGER REFERENCES instruments (id),
+            PRIMARY KEY (near_future, far_future)
+        )
+    ''',
+    # Последние значения по средневзвешенным ценам стаканов для каждого объема
+    'spreads_depth': '''
+        CREATE TABLE IF NOT EXISTS spreads_depth (
+            name_future TEXT NOT NULL,
+            size INTEGER NOT NULL,  -- Объем в лотах фьючерса
+            ts INTEGER NOT NULL,
+            name_share TEXT,
+            bid_share REAL,  -- Средневзвешенные цены объема, NULL - объема в стакане не хватает
+            offer_share REAL,
+            bid_future REAL,
+            offer_future REAL,
+            kerry_buy_spread_y REAL,
+            kerry_sell_spread_y REAL,
+            PRIMARY KEY (name_future, size)
+        ) WITHOUT ROWID
+    ''',
+    'future_spreads_depth': '''
+        CREATE TABLE IF NOT EXISTS future_spreads_depth (
+            near_future TEXT NOT NULL,
+            far_future TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            spread_bid REAL,
+            spread_offer REAL,
+            spread_bid_y REAL,
+            spread_offer_y REAL,
+            PRIMARY KEY (near_future, far_future, size)
+        ) WITHOUT ROWID
+    ''',
+    # Агрегаты по интервалам времени: open/high/low/close и сумма со счетчиком для среднего.
+    # Хранится сумма, а не среднее, чтобы новые строки можно было досчитывать в уже существующий интервал
+    'spreads_rollup': '''
+        CREATE TABLE IF NOT EXISTS spreads_rollup (
+            resolution TEXT NOT NULL,
+            future_id INTEGER NOT NULL,
+            bucket_ts INTEGER NOT NULL,  -- Начало интервала, мс
+            buy_open REAL, buy_high REAL, buy_low REAL, buy_close REAL, buy_sum REAL,
+            sell_open REAL, sell_high REAL, sell_low REAL, sell_close REAL, sell_sum REAL,
+            count INTEGER NOT NULL,
+            close_ts INTEGER NOT NULL,  -- Время последней строки в интервале
+            PRIMARY KEY (resolution, future_id, bucket_ts)
+        ) WITHOUT ROWID
+    ''',
+    'future_spreads_rollup': '''
+        CREATE TABLE IF NOT EXISTS future_spreads_rollup (
+            resolution TEXT NOT NULL,
+            near_id INTEGER NOT NULL,
+            far_id INTEGER NOT NULL,
+            bucket_ts INTEGER NOT NULL,
+            bid_open REAL, bid_high REAL, bid_low REAL, bid_close REAL, bid_sum REAL,
+            offer_open REAL, offer_high REAL, offer_low REAL, offer_close REAL, offer_sum REAL,
+            count INTEGER NOT NULL,
+            close_ts INTEGER NOT NULL,
+            PRIMARY KEY (resolution, near_id, far_id, bucket_ts)
+        ) WITHOUT ROWID
+    ''',
+    # Последний агрегированный id по каждой таблице истории
+    'rollup_state': '''
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            table_name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL
+        )
+    ''',
+}
+
+
+# функция для создания бд
+def init_db(db_path):
+    with sqlite3.connect(db_path) as conn:
+        cursor = conn.cursor()
+        if needs_migration(cursor):
+            raise RuntimeError(f"БД {db_path} в старом формате. Выполните: python migrate_db.py {db_path}")
+        # Для новой БД: освободившиеся страницы возвращаются по частям через PRAGMA incremental_vacuum (retention.py).
+        # В существующей БД режим меняется только после полного VACUUM (retention.py --enable-incremental-vacuum)
+        cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        latest_exists = table_exists(cursor, 'spreads_latest')
+        for create_sql in SCHEMA.values():
+            cursor.execute(create_sql)
+        create_indexes(cursor)
+        if not latest_exists:
+            fill_latest(cursor)
+        conn.commit()
+
+
+def table_exists(cursor, table_name):
+    return cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                          (table_name,)).fetchone() is not None
+
+
+# Заполнение таблиц последних значений из истории (для БД, созданных до их появления)
+def fill_latest(cursor):
+    cursor.execute('''
+        INSERT OR REPLACE INTO spreads_latest (
+            name_future, ts, name_share, bid_share, offer_share, bid_future, offer_future,
+            lot_size_future, exp_days, kerry_buy_spread_y, kerry_sell_spread_y, future_id
+        )
+        SELECT s.name_future, s.ts, s.name_share, s.bid_share, s.offer_share, s.bid_future, s.offer_future,
+               s.lot_size_future, s.exp_days, s.kerry_buy_spread_y, s.kerry_sell_spread_y, s.future_id
+        FROM spreads s
+        JOIN (SELECT name_future, MAX(ts) AS ts FROM spreads GROUP BY name_future) m
+            ON s.name_future = m.name_future AND s.ts = m.ts
+        ORDER BY s.id
+    ''')
+    cursor.execute('''
+        INSERT OR REPLACE INTO future_spreads_latest (
+            near_future, far_future, ts, spread_bid, spread_offer, spread_bid_y, spread_offer_y, far_exp_days,
+            near_id, far_id
+        )
+        SELECT f.near_future, f.far_future, f.ts, f.spread_bid, f.spread_offer,
+               f.spread_bid_y, f.spread_offer_y, f.far_exp_days, f.near_id, f.far_id
+        FROM future_spreads f
+        JOIN (SELECT near_future, far_future, MAX(ts) AS ts FROM future_spreads GROUP BY near_future, far_future) m
+            ON f.near_future = m.near_future AND f.far_future = m.far_future AND f.ts = m.ts
+        ORDER BY f.id
+    ''')
+
+
+# Столбцы таблицы
+def table_columns(cursor, table_name):
+    return [row[1] for row in cursor.execute(f"PRAGMA table_info({table_name})")]
+
+
+# Старый формат БД: время хранится строкой в trade_time или нет ссылок на справочник инструментов
+def needs_migration(cursor):
+    columns = table_columns(cursor, 'spreads')
+    return bool(columns) and ('trade_time' in columns or 'future_id' not in columns)
+
+
+# Индексы для выборок по времени и по инструменту за период
+def create_indexes(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_instruments_expiration ON instruments (expiration)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_spreads_ts ON spreads (ts)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_spreads_future_id_ts ON spreads (future_id, ts)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_spreads_share_id_ts ON spreads (share_id, ts)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_future_spreads_ts ON future_spreads (ts)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_future_spreads_far_id_ts ON future_spreads (far_id, ts)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_future_spreads_pair_ts ON future_spreads (near_id, far_id, ts)")
+    # Индексы по именам заменены индексами по id инструментов
+    for index_name in ('idx_spreads_future_ts', 'idx_spreads_share_ts', 'idx_future_spreads_far_ts'):
+        cursor.execute(f"DROP INDEX IF EXISTS {index_name}")
+
+
+# Код экспирации из имени фьючерса: GAZR-9.25 -> 9.25
+def expiration_code(name):
+    match = EXPIRATION_RE.search(name or '')
+    return match.group(1) if match else None
+
+
+# Запись инструментов в справочник
+def register_instruments(cursor, instruments):
+    """
+    instruments - список словарей с ключами name, kind, underlying, exp_date, lot_size, class_code, sec_code.
+    Существующие инструменты обновляются, id сохраняются
+    """
+    cursor.executemany('''
+        INSERT INTO instruments (name, kind, underlying, expiration, exp_date, lot_size, class_code, sec_code)
+        VALUES (:name, :kind, :underlying, :expiration, :exp_date, :lot_size, :class_code, :sec_code)
+        ON CONFLICT (name) DO UPDATE SET
+            kind = excluded.kind, underlying = excluded.underlying, expiration = excluded.expiration,
+            exp_date = excluded.exp_date, lot_size = excluded.lot_size,
+            class_code = excluded.class_code, sec_code = excluded.sec_code
+    ''', [dict(instrument, expiration=expiration_code(instrument['name']) if instrument['kind'] == 'future' else None)
+          for instrument in instruments])
+
+
+# Функция для сохранения данных в БД
+def save_to_db(cursor, table_name, data):
+    if table_name not in INSERT_SQL:
+        raise ValueError(f"Неизвестная таблица: {table_name}")
+    cursor.execute(INSERT_SQL[table_name], data)
+    cursor.execute(UPSERT_LATEST_SQL[table_name], data)
+
+
+# === Время ===
+# В БД время хранится целым числом миллисекунд от начала эпохи: сортируется и сравнивается как число и индексируется
+
+# Текущее время в миллисекундах
+def now_ms():
+    return time.time_ns() // 1_000_000
+
+
+# datetime в миллисекунды. Наивное время считается локальным
+def datetime_to_ms(dt):
+    return int(dt.timestamp() * 1000)
+
+
+# Столбец миллисекунд в datetime по МСК без часового пояса для отображения
+def ms_to_datetime(ts):
+    return pd.to_datetime(ts, unit='ms', utc=True).dt.tz_convert(TZ).dt.tz_localize(None)
+
+
+# datetime по МСК (наивное или с часовым поясом) в миллисекунды для условий WHERE
+def msk_to_ms(dt):
+    dt = pd.Timestamp(dt)
+    if dt.tzinfo is None:
+        dt = dt.tz_localize(TZ)
+    return int(dt.value // 1_000_000)
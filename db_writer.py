@@ -0,0 +1,179 @@
+import argparse
+import logging
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+
+from db import DB_PATH, WRITE_SQL, connect, init_db, now_ms
+from log_setup import setup_logging
+from metrics import inc, observe, set_gauge
+
+BATCH_SIZE = 2000  # Максимум строк в одной транзакции
+FLUSH_INTERVAL = 1.0  # Максимальная задержка записи, с
+QUEUE_SIZE = 100000  # Максимум строк в очереди. При переполнении write ждет освобождения места
+RETRY_DELAY = 0.1  # Первая пауза перед повтором записи, если БД занята (rollup, retention, app.py), с
+RETRY_MAX_DELAY = 5.0  # Максимальная пауза между повторами, с. При остановке после нее строки отбрасываются
+
+logger = logging.getLogger('db_writer.py')
+
+
+class BatchWriter:
+    """
+    Отложенная пакетная запись в БД в фоновом потоке.
+    Строки копятся в очереди и сбрасываются через executemany транзакциями не больше batch_size строк
+    не реже, чем раз в flush_interval секунд. В той же транзакции обновляются таблицы последних значений. Сборщик котировок не ждет диска, а при сбое теряется
+    не больше одного интервала данных.
+    """
+
+    def __init__(self, db_path=DB_PATH, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, queue_size=QUEUE_SIZE):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.flush_requested = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='BatchWriter', daemon=True)
+
+        # Статистика для оценки пропускной способности
+        self.rows_written = 0
+        self.flushes = 0
+        self.write_seconds = 0.0  # Время, затраченное на запись в БД
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def write(self, table_name, rows):
+        """Ставит строки в очередь на запись"""
+        if table_name not in WRITE_SQL:
+            raise ValueError(f"Неизвестная таблица: {table_name}")
+        for row in rows:
+            self.queue.put((table_name, row))
+
+    def flush(self):
+        """Просит фоновый поток записать накопленное, не дожидаясь интервала"""
+        self.flush_requested.set()
+
+    def close(self):
+        """Записывает все оставшиеся строки и останавливает поток"""
+        self.stopping.set()
+        self.flush_requested.set()
+        self.thread.join()
+        logger.info(f"Запись в БД остановлена. {self.stats()}")
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def run(self):
+        conn = connect(self.db_path)  # Подключение создается в потоке, который его использует
+        pending = {table_name: [] for table_name in WRITE_SQL}
+        pending_count = 0
+        retry_delay = 0.0  # Пауза перед повтором неудавшейся записи, 0 - последняя запись удалась
+        next_flush = time.monotonic() + self.flush_interval
+        try:
+            while True:
+                timeout = max(0.0, next_flush - time.monotonic())
+                if pending_count < self.batch_size:
+                    try:
+                        table_name, row = self.queue.get(timeout=min(timeout, 0.1))
+                        pending[table_name].append(row)
+                        pending_count += 1
+                        while pending_count < self.batch_size:  # Забираем все, что уже есть в очереди
+                            table_name, row = self.queue.get_nowait()
+                            pending[table_name].append(row)
+                            pending_count += 1
+                    except queue.Empty:
+                        pass
+                else:  # Ждем повтора записи. Очередь ограничена, при переполнении сборщик ждет в write
+                    time.sleep(min(timeout, 0.1))
+
+                # При остановке строки, которые не удается записать после всех повторов, отбрасываются
+                stopping = self.stopping.is_set() and (self.queue.empty() or retry_delay >= RETRY_MAX_DELAY)
+                due = time.monotonic() >= next_flush
+                if not retry_delay:  # Во время повторов пишем только по истечении паузы
+                    due = due or pending_count >= self.batch_size or self.flush_requested.is_set() or stopping
+                if due:
+                    if pending_count:
+                        if self.write_batch(conn, pending):
+                            pending = {table_name: [] for table_name in WRITE_SQL}
+                            pending_count = 0
+                            retry_delay = 0.0
+                        else:  # Строки остаются до следующей попытки
+                            retry_delay = min(retry_delay * 2 or RETRY_DELAY, RETRY_MAX_DELAY)
+                    if self.queue.empty():
+                        self.flush_requested.clear()
+                    next_flush = time.monotonic() + (retry_delay or self.flush_interval)
+                if stopping and (not pending_count or retry_delay >= RETRY_MAX_DELAY):
+                    if pending_count or not self.queue.empty():
+                        logger.error(f"БД недоступна, при остановке не записано строк: {pending_count + self.queue.qsize()}")
+                    break
+        finally:
+            conn.close()
+
+    def write_batch(self, conn, pending):
+        """
+        Записывает накопленные строки одной транзакцией. False - БД занята или временно недоступна,
+        транзакция откачена и строки нужно записать позже
+        """
+        start = time.perf_counter()
+        count = 0
+        try:
+            with conn:  # Транзакция: commit при успехе, rollback при ошибке
+                for table_name, rows in pending.items():
+                    if rows:
+                        for sql in WRITE_SQL[table_name]:  # История и таблица последних значений
+                            conn.executemany(sql, rows)
+                        count += len(rows)
+        except sqlite3.OperationalError as e:  # database is locked и другие временные ошибки
+            inc('db_write_retries_total')
+            logger.warning(f"Не удалось записать {sum(map(len, pending.values()))} строк в БД, запись будет повторена. "
+                           f"Ошибка: {e}")
+            return False
+        except Exception as e:  # Ошибка в самих строках: повтор не поможет
+            logger.error(f"Не удалось записать {sum(map(len, pending.values()))} строк в БД. Ошибка: {e}", exc_info=True)
+            return True
+        self.write_seconds += time.perf_counter() - start
+        self.rows_written += count
+        self.flushes += 1
+        observe('db_flush_seconds', time.perf_counter() - start)
+        inc('db_rows_written_total', count)
+        set_gauge('db_queue_size', self.queue.qsize())
+        logger.debug("Записано %d строк за %.4f с", count, time.perf_counter() - start)
+        return True
+
+    def rows_per_sec(self):
+        return self.rows_written / self.write_seconds if self.write_seconds else 0.0
+
+    def stats(self):
+        return (f"Записано строк: {self.rows_written}, транзакций: {self.flushes}, "
+                f"время записи: {self.write_seconds:.3f} с, скорость: {self.rows_per_sec():.0f} строк/с")
+
+
+# Замер скорости вставки на синтетических строках
+def measure_throughput(rows=100000, db_path=None, batch_size=BATCH_SIZE):
+    """Возвращает скорость записи в строках в секунду, считая от первой постановки в очередь до записи последней строки"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = db_path or os.path.join(tmp_dir, 'throughput.db')
+        init_db(db_path)
+        row = (now_ms(), 'GAZP', 120.5, 120.6, 'GAZR-9.25', 12500.0, 12510.0, 100, 90, 15.1, 16.2)
+        writer = BatchWriter(db_path, batch_size=batch_size)
+        start = time.perf_counter()
+        with writer:
+            writer.write('spreads', (row for _ in range(rows)))
+        return rows / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Замер скорости пакетной записи в БД')
+    parser.add_argument('--rows', type=int, default=100000, help='Кол-во строк')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Строк в транзакции')
+    args = parser.parse_args()
+
+    setup_logging(level=logging.INFO)
+    print(f"{measure_throughput(args.rows, batch_size=args.batch_size):.0f} строк/с")
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+MAX_ENTRIES = 32  # Максимум DataFrame в кэше
+MAX_BYTES = 512 * 1024 * 1024  # Максимальный суммарный объем DataFrame в памяти
+
+logger = logging.getLogger('df_cache.py')
+
+
+# Ключ кэша по параметрам фильтра
+def make_key(*params):
+    """Хэш параметров: одинаковые фильтры дают одинаковый ключ. Порядок значений в списках учитывается"""
+    data = json.dumps(params, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class DataFrameCache:
+    """
+    Кэш DataFrame в памяти процесса dash с вытеснением давно не использованных (LRU) по кол-ву записей и объему.
+    В dcc.Store хранится только ключ, сами данные не сериализуются в JSON и не передаются в браузер
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # {ключ: (DataFrame, объем в байтах)}
+        self.group_indexes = {}  # {(ключ, столбцы): {значение: позиции строк}} по закэшированным DataFrame
+        self.total_bytes = 0
+        self.lock = threading.Lock()  # Callback'и dash могут выполняться в разных потоках
+
+    def put(self, key, df):
+        """Сохраняет DataFrame под ключом и возвращает ключ"""
+        size = int(df.memory_usage(deep=True).sum())
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+                self.drop_group_indexes(key)
+            self.entries[key] = (df, size)
+            self.total_bytes += size
+            while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+                evicted_key, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.drop_group_indexes(evicted_key)
+                if evicted_key == key:  # Один DataFrame больше всего кэша
+                    logger.warning(f"DataFrame размером {size} байт не помещается в кэш")
+        return key
+
+    def get(self, key):
+        """DataFrame по ключу или None, если его нет или он вытеснен"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def groups(self, key, columns):
+        """
+        Индекс групп закэшированного DataFrame: {значение столбцов: позиции строк по порядку}.
+        Строится один раз на набор данных и переиспользуется при переключении страниц, пока DataFrame не заменен.
+        Для нескольких столбцов значение - кортеж. None, если DataFrame нет в кэше
+        """
+        columns = tuple(columns)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            index = self.group_indexes.get((key, columns))
+        if index is None:
+            index = group_index(entry[0], columns)
+            with self.lock:
+                if self.entries.get(key) is entry:  # DataFrame не заменили, пока строился индекс
+                    self.group_indexes[(key, columns)] = index
+        return index
+
+    def drop_group_indexes(self, key):
+        for index_key in [index_key for index_key in self.group_indexes if index_key[0] == key]:
+            del self.group_indexes[index_key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.group_indexes.clear()
+            self.total_bytes = 0
+
+
+# Позиции строк по группам за один проход groupby вместо фильтра по маске на каждую группу
+def group_index(df, columns):
+    columns = list(columns)
+    if df.empty:
+        return {}
+    return df.groupby(columns[0] if len(columns) == 1 else columns, sort=False).indices
@@ -0,0 +1,75 @@
+import numpy as np
+
+MAX_POINTS = 1000  # Точек на линию графика по умолчанию
+
+
+# Индексы точек по алгоритму Largest-Triangle-Three-Buckets
+def lttb_indices(x, y, n_out):
+    """
+    x, y - массивы одной длины, x возрастает. Первая и последняя точки сохраняются, остальные делятся на n_out - 2 интервала,
+    из каждого берется точка, образующая наибольший треугольник с предыдущей выбранной и средней точкой следующего интервала.
+    Форма линии и выбросы сохраняются лучше, чем при прореживании через шаг
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)  # Границы интервалов между первой и последней точками
+    edges = np.append(edges, n)
+    indices = np.empty(n_out, dtype=np.intp)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0  # Последняя выбранная точка
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = edges[i + 1], edges[i + 2]
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        # Удвоенная площадь треугольника (a, точка интервала, среднее следующего интервала)
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+
+# Индексы минимума и максимума в каждом интервале
+def minmax_indices(y, n_out):
+    """Делит ряд на n_out // 2 интервалов и оставляет в каждом минимум и максимум. Все выбросы сохраняются точно"""
+    n = len(y)
+    if n_out >= n or n_out < 2:
+        return np.arange(n)
+    y = np.asarray(y, dtype=float)
+    edges = np.linspace(0, n, n_out // 2 + 1).astype(int)
+    indices = [0, n - 1]
+    for start, end in zip(edges[:-1], edges[1:]):
+        if end > start:
+            indices += [start + int(np.argmin(y[start:end])), start + int(np.argmax(y[start:end]))]
+    return np.unique(indices)
+
+
+# Прореживание ряда для графика
+def downsample(x, y, max_points=MAX_POINTS, method='lttb'):
+    """
+    x, y - pandas Series одной длины (x - время или число по возрастанию).
+    Возвращает (x, y) не больше чем из max_points + 2 точек, max_points=None - без прореживания.
+    Глобальные минимум и максимум сохраняются всегда: по ним видны крайние значения керри
+    """
+    mask = y.notna().to_numpy()
+    x, y = x[mask], y[mask]
+    if max_points is None or len(y) <= max_points:
+        return x, y
+
+    x_values = np.asarray(x)
+    if x_values.dtype.kind == 'M':
+        x_values = x_values.astype('datetime64[ns]').view(np.int64)
+    y_values = y.to_numpy(dtype=float)
+
+    if method == 'minmax':
+        indices = minmax_indices(y_values, max_points)
+    elif method == 'lttb':
+        indices = lttb_indices(x_values, y_values, max_points)
+        indices = np.union1d(indices, [np.argmin(y_values), np.argmax(y_values)])
+    else:
+        raise ValueError(f"Неизвестный метод прореживания: {method}")
+    return x.iloc[indices], y.iloc[indices]
@@ -0,0 +1,131 @@
+import math
+from datetime import datetime
+
+from carry import calc_kerry, calc_calendar_spread
+from db import datetime_to_ms
+
+
+class IncrementalSpreads:
+    """
+    Последние котировки по инструментам в памяти и пересчет только тех строк, которые зависят от изменившегося инструмента.
+    Тик по фьючерсу пересчитывает его строку акция/фьючерс и календарные пары с его участием,
+    тик по акции - все ее строки акция/фьючерс и все ее календарные пары.
+    """
+
+    def __init__(self, list_datanames, specs):
+        """
+        list_datanames - список из read_stock_futures_csv: [{акция: [фьючерсы]}, ...]
+        specs - спецификации инструментов {dataname: spec} из SpecCache
+        """
+        self.specs = specs
+        self.quotes = {}  # {dataname: (bid, offer)}
+        self.share_futures = {}  # {акция: [фьючерсы по возрастанию даты экспирации]}
+        self.future_share = {}  # {фьючерс: акция}
+        self.exp_dates = {}  # {фьючерс: дата экспирации}
+        for datanames in list_datanames:
+            for share, futures in datanames.items():
+                futures = [future for future in futures if future in specs]
+                for future in futures:
+                    self.exp_dates[future] = datetime.strptime(str(specs[future]['exp_date']), "%Y%m%d")
+                    self.future_share[future] = share
+                self.share_futures[share] = sorted(futures, key=lambda future: self.exp_dates[future])
+
+        # Индекс зависимостей: {инструмент: (пары акция/фьючерс, календарные пары)}
+        self.dependencies = {}
+        for share, futures in self.share_futures.items():
+            calendar_pairs = [(share, futures[i], futures[j])
+                              for i in range(len(futures)) for j in range(i + 1, len(futures))]
+            self.dependencies[share] = ([(share, future) for future in futures], calendar_pairs)
+            for future in futures:
+                self.dependencies[future] = ([(share, future)],
+                                             [pair for pair in calendar_pairs if future in pair[1:]])
+
+    def update_quote(self, dataname, bid, offer):
+        """Обновляет котировку. Возвращает True, если лучшие цены изменились"""
+        quote = (bid, offer)
+        if self.quotes.get(dataname) == quote:
+            return False
+        self.quotes[dataname] = quote
+        return True
+
+    def exp_days(self, future, now):
+        return (self.exp_dates[future] - now).days + 1
+
+    def carry_row(self, share, future, ts, now):
+        """Строка для таблицы spreads или None, если котировок недостаточно или фьючерс экспирируется"""
+        if share not in self.quotes or future not in self.quotes:
+            return None
+        bid_share, offer_share = self.quotes[share]
+        bid_future, offer_future = self.quotes[future]
+        if not bid_share or not offer_share:
+            return None
+        lot_size_future = self.specs[future]['lot_size']
+        exp_days = self.exp_days(future, now)
+        if exp_days <= 0:  # День экспирации или фьючерс уже истек, доходность не определена
+            return None
+        kerry_buy_spread_y, kerry_sell_spread_y = calc_kerry(bid_share, offer_share, bid_future, offer_future,
+                                                             lot_size_future, exp_days)
+        if not (math.isfinite(kerry_buy_spread_y) and math.isfinite(kerry_sell_spread_y)):
+            return None
+        return (ts, self.specs[share]['short_name'], bid_share, offer_share,
+                self.specs[future]['short_name'], bid_future, offer_future,
+                lot_size_future, exp_days, kerry_buy_spread_y, kerry_sell_spread_y)
+
+    def calendar_row(self, share, near, far, ts, now):
+        """Строка для таблицы future_spreads или None, если котировок недостаточно или дальний фьючерс экспирируется"""
+        if share not in self.quotes or near not in self.quotes or far not in self.quotes:
+            return None
+        bid_share, offer_share = self.quotes[share]
+        if not bid_share or not offer_share:
+            return None
+        near_bid, near_offer = self.quotes[near]
+        far_bid, far_offer = self.quotes[far]
+        lot_size_far = self.specs[far]['lot_size']
+        far_exp_days = self.exp_days(far, now)
+        if self.exp_days(near, now) <= 0:  # Ближний экспирируется раньше дальнего, как и в calc_rows пара не считается
+            return None
+        spread_bid, spread_offer, spread_bid_y, spread_offer_y = calc_calendar_spread(
+            near_bid, near_offer, far_bid, far_offer, bid_share * lot_size_far, offer_share * lot_size_far, far_exp_days)
+        if not (math.isfinite(spread_bid_y) and math.isfinite(spread_offer_y)):
+            return None
+        return (ts, self.specs[near]['short_name'], self.specs[far]['short_name'],
+                spread_bid, spread_offer, spread_bid_y, spread_offer_y, far_exp_days)
+
+    def missing(self, carry_pairs, calendar_pairs, rows):
+        """
+        Ключи пересчитанных пар, по которым строк нет (котировок недостаточно или фьючерс экспирируется):
+        {таблица: [(фьючерс,)] / [(ближний, дальний)]}. По ним строки убираются из топа ranking.py
+        """
+        spread_rows, future_spread_rows = rows
+        names = {row[4] for row in spread_rows}
+        pairs = {(row[1], row[2]) for row in future_spread_rows}
+        short_name = lambda dataname: self.specs[dataname]['short_name']
+        return {'spreads': [(short_name(future),) for _, future in carry_pairs if short_name(future) not in names],
+                'future_spreads': [pair for _, near, far in calendar_pairs
+                                   if (pair := (short_name(near), short_name(far))) not in pairs]}
+
+    def affected(self, dataname):
+        """Возвращает (пары акция/фьючерс, календарные пары (акция, ближний, дальний)), зависящие от инструмента"""
+        return self.dependencies.get(dataname, ([], []))
+
+    def recompute(self, carry_pairs, calendar_pairs, now=None):
+        """Пересчитывает указанные пары. Возвращает (строки spreads, строки future_spreads)"""
+        now = now or datetime.now()
+        ts = datetime_to_ms(now)
+        spread_rows = [row for share, future in carry_pairs
+                       if (row := self.carry_row(share, future, ts, now)) is not None]
+        future_spread_rows = [row for share, near, far in calendar_pairs
+                              if (row := self.calendar_row(share, near, far, ts, now)) is not None]
+        return spread_rows, future_spread_rows
+
+    def on_quote(self, dataname, bid, offer, now=None):
+        """Тик по инструменту. Возвращает пересчитанные строки, если лучшие цены изменились"""
+        if not self.update_quote(dataname, bid, offer):
+            return [], []
+        return self.recompute(*self.affected(dataname), now=now)
+
+    def recompute_all(self, now=None):
+        """Пересчитывает все пары по текущим котировкам"""
+        carry_pairs = [pair for share in self.share_futures for pair in self.dependencies[share][0]]
+        calendar_pairs = [pair for share in self.share_futures for pair in self.dependencies[share][1]]
+        return self.recompute(carry_pairs, calendar_pairs, now=now)
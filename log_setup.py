@@ -0,0 +1,174 @@
+import argparse
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from db import TZ
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'  # Формат сообщения
+DATE_FORMAT = '%d.%m.%Y %H:%M:%S'  # Формат даты
+LEVELS_ENV = 'LOG_LEVELS'  # Уровни по компонентам: spread.py=INFO,db_writer.py=DEBUG
+JSON_ENV = 'LOG_JSON'  # 1 - писать строки JSON вместо текста
+RATE_LIMITS = {'spread.py': 20}  # Сообщений в секунду на один шаблон сообщения по умолчанию для горячих компонентов
+SUPPRESSED_REPORT_INTERVAL = 60  # Как часто сообщать о подавленных сообщениях, с
+
+MSK = ZoneInfo(TZ)
+
+logger = logging.getLogger('log_setup.py')
+listener = None  # Текущий QueueListener, повторная настройка останавливает прежний
+
+
+# Время в логе по МСК независимо от часового пояса машины
+def msk_time(timestamp):
+    return datetime.fromtimestamp(timestamp, MSK).timetuple()
+
+
+class TextFormatter(logging.Formatter):
+    converter = staticmethod(msk_time)
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна компактная строка JSON на сообщение: время, уровень, компонент, текст и аргументы шаблона"""
+
+    def format(self, record):
+        data = {'ts': datetime.fromtimestamp(record.created, MSK).isoformat(timespec='milliseconds'),
+                'level': record.levelname, 'logger': record.name, 'msg': record.getMessage()}
+        if record.args and isinstance(record.args, tuple):  # Значения отдельно, чтобы по ним можно было фильтровать
+            data['args'] = [arg if isinstance(arg, (int, float, str, bool, type(None))) else str(arg) for arg in record.args]
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Передает запись в очередь без форматирования: шаблон и аргументы форматируются в потоке QueueListener.
+    Стандартный QueueHandler форматирует сообщение в вызывающем потоке.
+    Трассировка исключения форматируется сразу, т.к. объект traceback держит кадры стека
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Ограничение частоты сообщений компонента: не больше rate в секунду на каждый шаблон сообщения (ведро токенов).
+    Подавленные сообщения считаются, раз в SUPPRESSED_REPORT_INTERVAL секунд выводится их кол-во.
+    Предупреждения и ошибки не ограничиваются
+    """
+
+    def __init__(self, limits):
+        super().__init__()
+        self.limits = limits  # {имя логгера: сообщений в секунду}
+        self.buckets = {}  # {(логгер, шаблон): [токены, время последнего пополнения]}
+        self.suppressed = {}  # {логгер: подавлено сообщений}
+        self.next_report = time.monotonic() + SUPPRESSED_REPORT_INTERVAL
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        rate = self.limits.get(record.name)
+        if rate is None or record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        key = (record.name, record.msg)
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (rate, now))
+            tokens = min(rate, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            self.buckets[key] = (tokens - 1 if allowed else tokens, now)
+            if not allowed:
+                self.suppressed[record.name] = self.suppressed.get(record.name, 0) + 1
+            report = now >= self.next_report and self.suppressed
+            if report:
+                suppressed, self.suppressed = self.suppressed, {}
+                self.next_report = now + SUPPRESSED_REPORT_INTERVAL
+        if report:
+            for name, count in suppressed.items():
+                logger.info("Подавлено частых сообщений %s: %d", name, count)
+        return allowed
+
+
+# Уровни компонентов из строки вида "spread.py=INFO,db_writer.py=DEBUG"
+def parse_levels(value):
+    levels = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        name, _, level = item.partition('=')
+        name, level = name.strip(), level.strip().upper()
+        if not name or not isinstance(logging.getLevelName(level), int):
+            raise argparse.ArgumentTypeError(f"Ожидается КОМПОНЕНТ=УРОВЕНЬ с уровнем DEBUG, INFO, WARNING, ERROR "
+                                             f"или CRITICAL: {item!r}")
+        levels[name] = level
+    return levels
+
+
+def setup_logging(log_file=None, level=logging.DEBUG, console=True, json_lines=None, levels=None, rate_limits=None):
+    """
+    Общая настройка лога для всех скриптов проекта вместо logging.basicConfig.
+    Вызывающий поток только кладет запись в очередь, запись в файл и на консоль идет в фоновом потоке QueueListener.
+    log_file - файл лога (None - только консоль), level - уровень по умолчанию, json_lines - строки JSON
+    (по умолчанию из переменной LOG_JSON), levels - уровни компонентов {имя логгера: уровень} поверх LOG_LEVELS,
+    rate_limits - ограничение частоты {имя логгера: сообщений в секунду на шаблон}, по умолчанию RATE_LIMITS.
+    Возвращает QueueListener, он останавливается при выходе с записью всех накопленных сообщений.
+    Повторный вызов останавливает прежний QueueListener и закрывает его файлы
+    """
+    global listener
+    if json_lines is None:
+        json_lines = os.environ.get(JSON_ENV, '') not in ('', '0')
+    formatter = JsonFormatter() if json_lines else TextFormatter(LOG_FORMAT, DATE_FORMAT)
+
+    handlers = []
+    if log_file:
+        handlers.append(logging.FileHandler(log_file, encoding='utf-8'))  # Лог записываем в файл
+    if console:
+        handlers.append(logging.StreamHandler())  # и выводим на консоль
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()  # Без ограничения: вызывающий поток никогда не ждет
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(RATE_LIMITS if rate_limits is None else rate_limits))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:  # Повторная настройка заменяет прежнюю
+        root.removeHandler(handler)
+        handler.close()
+    stop_logging()  # Прежний поток записывает уже поставленные в очередь сообщения в прежние файлы
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    try:
+        env_levels = parse_levels(os.environ.get(LEVELS_ENV))
+    except argparse.ArgumentTypeError as e:
+        raise ValueError(f"Переменная {LEVELS_ENV}: {e}") from None
+    for name, component_level in {**env_levels, **(levels or {})}.items():
+        logging.getLogger(name).setLevel(component_level)
+
+    listener.start()
+    return listener
+
+
+# Остановка фонового потока лога с записью накопленных сообщений и закрытием файлов
+@atexit.register
+def stop_logging():
+    global listener
+    if listener is None:
+        return
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+    listener = None
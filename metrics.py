@@ -0,0 +1,291 @@
+import bisect
+import functools
+import json
+import logging
+import threading
+import time
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BUCKETS = tuple(0.00005 * 2 ** i for i in range(22))  # Границы интервалов гистограмм, с: от 50 мкс до ~100 с
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108  # Порт метрик сборщика
+FETCH_TIMEOUT = 1  # Ожидание ответа при чтении метрик другого процесса, с
+
+logger = logging.getLogger('metrics.py')
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными экспоненциальными интервалами: observe - поиск интервала и увеличение счетчика,
+    память не растет с числом наблюдений. Квантили оцениваются интерполяцией внутри интервала
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Последний - больше всех границ
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.count, self.sum, self.max
+
+    def quantile(self, q, snapshot=None):
+        counts, count, _, max_value = snapshot or self.snapshot()
+        if not count:
+            return None
+        rank = q * count
+        cumulative = 0
+        for i, bucket_count in enumerate(counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else max_value
+                return min(lower + (upper - lower) * (rank - cumulative) / bucket_count, max_value)
+            cumulative += bucket_count
+        return max_value
+
+
+class Timer:
+    """Замер времени блока with или вызова функции с записью в гистограмму"""
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()  # Локально: функцию могут вызывать несколько потоков сразу
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.histogram.observe(time.perf_counter() - start)
+        return wrapper
+
+
+class Registry:
+    """Метрики процесса: гистограммы времени, счетчики и текущие значения с метками"""
+
+    def __init__(self):
+        self.histograms = {}  # {(имя, метки): Histogram}
+        self.counters = {}  # {(имя, метки): значение}
+        self.gauges = {}  # {(имя, метки): значение}
+        self.help = {}  # {имя: описание}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def histogram(self, name, help='', **labels):
+        key = self.key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+                if help:
+                    self.help.setdefault(name, help)
+        return histogram
+
+    def observe(self, name, value, **labels):
+        self.histogram(name, **labels).observe(value)
+
+    def timed(self, name, **labels):
+        """Контекстный менеджер и декоратор: with timed('stage_seconds', stage='compute'): ..."""
+        return Timer(self.histogram(name, **labels))
+
+    def timed_function(self, name, label='function'):
+        """Декоратор с меткой по имени функции: @timed_function('dash_callback_seconds', 'callback')"""
+        def decorator(func):
+            return Timer(self.histogram(name, **{label: func.__name__}))(func)
+        return decorator
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def summary(self):
+        """Список словарей для таблицы: по гистограммам - кол-во, p50, p99, максимум, по остальным - значение"""
+        with self.lock:
+            histograms = list(self.histograms.items())
+            values = [('counter', key, value) for key, value in self.counters.items()] + \
+                     [('gauge', key, value) for key, value in self.gauges.items()]
+        rows = []
+        for (name, labels), histogram in sorted(histograms):
+            snapshot = histogram.snapshot()
+            rows.append({'name': name, 'labels': dict(labels), 'type': 'histogram', 'count': snapshot[1],
+                         'p50': histogram.quantile(0.5, snapshot), 'p99': histogram.quantile(0.99, snapshot),
+                         'max': snapshot[3], 'sum': snapshot[2]})
+        for kind, (name, labels), value in sorted(values, key=lambda item: item[1]):
+            rows.append({'name': name, 'labels': dict(labels), 'type': kind, 'value': value})
+        return rows
+
+    def render(self):
+        """Метрики в текстовом формате Prometheus"""
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), histogram in histograms:
+            describe(name, 'histogram')
+            counts, count, total, _ = histogram.snapshot()
+            cumulative = 0
+            for bound, bucket_count in zip([*histogram.buckets, float('inf')], counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else f"{bound:g}"
+                lines.append(f"{name}_bucket{format_labels(labels, le=le)} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+        for kind, items in (('counter', counters), ('gauge', gauges)):
+            for (name, labels), value in items:
+                describe(name, kind)
+                lines.append(f"{name}{format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels, **extra):
+    items = [*labels, *extra.items()]
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in items) + '}'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REGISTRY = Registry()  # Метрики процесса по умолчанию
+histogram = REGISTRY.histogram
+observe = REGISTRY.observe
+timed = REGISTRY.timed
+timed_function = REGISTRY.timed_function
+inc = REGISTRY.inc
+set_gauge = REGISTRY.set_gauge
+
+
+class TimedProxy:
+    """
+    Обертка над объектом, замеряющая время вызова заданных методов (гистограмма name с меткой method).
+    Остальные атрибуты, в том числе присваивание обработчиков событий, передаются объекту без изменений
+    """
+
+    def __init__(self, target, name, methods, registry=REGISTRY):
+        object.__setattr__(self, 'target', target)
+        object.__setattr__(self, 'wrapped', {method: Timer(registry.histogram(name, method=method))(getattr(target, method))
+                                             for method in methods if hasattr(target, method)})
+
+    def __getattr__(self, name):
+        wrapped = self.wrapped.get(name)
+        return wrapped if wrapped is not None else getattr(self.target, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.target, name, value)
+
+
+# HTTP-сервер метрик в фоновом потоке: /metrics - формат Prometheus, /metrics.json - сводка с квантилями.
+# routes - дополнительные адреса с ответом JSON: {путь: функция(параметры запроса {имя: значение})}
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST, registry=REGISTRY, routes=None):
+    routes = routes or {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            if url.path == '/metrics':
+                body, content_type = registry.render().encode('utf-8'), 'text/plain; version=0.0.4'
+            elif url.path == '/metrics.json':
+                body, content_type = json.dumps(registry.summary()).encode('utf-8'), 'application/json'
+            elif url.path in routes:
+                params = dict(urllib.parse.parse_qsl(url.query))
+                try:
+                    result = routes[url.path](params)
+                except (KeyError, ValueError) as e:
+                    self.send_error(400, str(e))
+                    return
+                body, content_type = json.dumps(result, ensure_ascii=False).encode('utf-8'), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # Запросы не пишем в лог
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+    logger.info(f"Метрики доступны на http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+# Те же адреса метрик и время запросов callback'ов (вместе с сериализацией ответа в JSON) в Flask-сервере dash
+def instrument_flask(server, registry=REGISTRY):
+    import flask
+
+    @server.route('/metrics')
+    def metrics():
+        return flask.Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+    @server.route('/metrics.json')
+    def metrics_json():
+        return flask.jsonify(registry.summary())
+
+    @server.before_request
+    def start_timer():
+        flask.g.metrics_start = time.perf_counter()
+
+    @server.after_request
+    def stop_timer(response):
+        start = flask.g.pop('metrics_start', None)
+        if start is not None and flask.request.path == '/_dash-update-component':
+            body = flask.request.get_json(silent=True) or {}
+            output = str(body.get('output', ''))
+            registry.observe('dash_request_seconds', time.perf_counter() - start, output=output[:100])
+        return response
+
+
+# Сводка метрик другого процесса (сборщика) или None, если он недоступен
+def fetch_summary(url, timeout=FETCH_TIMEOUT):
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return json.loads(response.read().decode('utf-8'))
+    except (OSError, ValueError):
+        return None
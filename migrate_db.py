@@ -0,0 +1,150 @@
+import argparse
+import logging
+import os
+import sqlite3
+from datetime import datetime
+from functools import lru_cache
+
+import pytz
+
+from db import DB_PATH, TZ, SCHEMA, create_indexes, needs_migration, table_columns, table_exists, expiration_code
+from log_setup import setup_logging
+
+logger = logging.getLogger('migrate_db.py')
+
+# Столбцы таблиц, которые переносятся без изменений
+COLUMNS = {
+    'spreads': ['id', 'name_share', 'bid_share', 'offer_share', 'name_future', 'bid_future', 'offer_future',
+                'lot_size_future', 'exp_days', 'kerry_buy_spread_y', 'kerry_sell_spread_y'],
+    'future_spreads': ['id', 'near_future', 'far_future', 'spread_bid', 'spread_offer',
+                       'spread_bid_y', 'spread_offer_y', 'far_exp_days'],
+}
+
+
+# Переход со строкового trade_time ('%d.%m.%Y %H:%M:%S' по местному времени) на ts в миллисекундах UTC
+def migrate_timestamps(conn, tz=TZ):
+    zone = pytz.timezone(tz)
+
+    @lru_cache(maxsize=65536)  # Одно и то же время повторяется во всех строках прохода сборщика
+    def trade_time_to_ms(trade_time):
+        if trade_time is None:
+            return None
+        dt = zone.localize(datetime.strptime(trade_time, '%d.%m.%Y %H:%M:%S'))
+        return int(dt.timestamp() * 1000)
+
+    conn.create_function('trade_time_to_ms', 1, trade_time_to_ms, deterministic=True)
+    with conn:  # Вся миграция одной транзакцией: при ошибке БД остается в старом формате
+        conn.execute("BEGIN")  # Явно, т.к. sqlite3 не открывает транзакцию перед ALTER/CREATE
+        for table_name, columns in COLUMNS.items():
+            column_list = ', '.join(columns)
+            conn.execute(f"ALTER TABLE {table_name} RENAME TO {table_name}_old")
+            conn.execute(SCHEMA[table_name])  # Столбцы ссылок на инструменты заполняет migrate_instruments
+            conn.execute(f'''
+                INSERT INTO {table_name} (ts, {column_list})
+                SELECT trade_time_to_ms(trade_time), {column_list}
+                FROM {table_name}_old
+                ORDER BY id
+            ''')
+            moved = conn.execute("SELECT changes()").fetchone()[0]
+            conn.execute(f"DROP TABLE {table_name}_old")
+            logger.info(f"Таблица {table_name}: перенесено {moved} строк")
+
+
+# Столбцы-ссылки на справочник инструментов: {таблица: {столбец id: столбец с именем}}
+INSTRUMENT_REFS = {
+    'spreads': {'share_id': 'name_share', 'future_id': 'name_future'},
+    'future_spreads': {'near_id': 'near_future', 'far_id': 'far_future'},
+    'spreads_latest': {'future_id': 'name_future'},
+    'future_spreads_latest': {'near_id': 'near_future', 'far_id': 'far_future'},
+}
+
+
+# Создание справочника инструментов по истории и проставление ссылок на него
+def migrate_instruments(conn):
+    """
+    Лот и дата экспирации фьючерса восстанавливаются по его последней строке в spreads (дата = время строки + exp_days - 1).
+    При следующем запуске сборщик перезапишет их точными значениями из спецификаций QUIK
+    """
+    conn.create_function('expiration_code', 1, expiration_code, deterministic=True)
+    with conn:
+        conn.execute("BEGIN")
+        conn.execute(SCHEMA['instruments'])
+        for table_name, refs in INSTRUMENT_REFS.items():
+            if not table_exists(conn.cursor(), table_name):
+                continue
+            columns = table_columns(conn.cursor(), table_name)
+            for id_column in refs:
+                if id_column not in columns:
+                    conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {id_column} INTEGER REFERENCES instruments (id)")
+
+        conn.execute('''
+            INSERT OR IGNORE INTO instruments (name, kind, underlying)
+            SELECT DISTINCT name_share, 'share', name_share FROM spreads WHERE name_share IS NOT NULL
+        ''')
+        conn.execute('''
+            INSERT OR IGNORE INTO instruments (name, kind, underlying, expiration, exp_date, lot_size)
+            SELECT s.name_future, 'future', s.name_share, expiration_code(s.name_future),
+                   CAST(strftime('%Y%m%d', s.ts / 1000, 'unixepoch', (s.exp_days - 1) || ' days') AS INTEGER),
+                   s.lot_size_future
+            FROM spreads s
+            JOIN (SELECT MAX(id) AS id FROM spreads GROUP BY name_future) m ON s.id = m.id
+            WHERE s.name_future IS NOT NULL
+        ''')
+        conn.execute('''
+            INSERT OR IGNORE INTO instruments (name, kind, expiration)
+            SELECT name, 'future', expiration_code(name)
+            FROM (SELECT near_future AS name FROM future_spreads UNION SELECT far_future FROM future_spreads)
+            WHERE name IS NOT NULL
+        ''')
+
+        for table_name, refs in INSTRUMENT_REFS.items():
+            if not table_exists(conn.cursor(), table_name):
+                continue
+            assignments = ', '.join(f"{id_column} = (SELECT id FROM instruments WHERE name = {table_name}.{name_column})"
+                                    for id_column, name_column in refs.items())
+            conn.execute(f"UPDATE {table_name} SET {assignments} WHERE {' OR '.join(f'{c} IS NULL' for c in refs)}")
+            logger.info(f"Таблица {table_name}: проставлены ссылки на инструменты")
+        create_indexes(conn.cursor())
+    count = conn.execute("SELECT COUNT(*) FROM instruments").fetchone()[0]
+    logger.info(f"Справочник инструментов: {count} записей")
+
+
+# Миграция файла БД в актуальный формат
+def migrate(db_path, tz=TZ, backup=True, vacuum=True):
+    if not os.path.exists(db_path):
+        logger.error(f"Файл {db_path} не найден.")
+        return False
+
+    with sqlite3.connect(db_path) as conn:
+        if not needs_migration(conn.cursor()):
+            logger.info(f"БД {db_path} уже в актуальном формате")
+            return True
+
+        if backup:
+            backup_path = f"{db_path}.bak"
+            with sqlite3.connect(backup_path) as backup_conn:
+                conn.backup(backup_conn)  # Копия через SQLite, учитывает и незавершенный журнал WAL
+            backup_conn.close()
+            logger.info(f"Резервная копия сохранена в {backup_path}")
+
+        if 'trade_time' in table_columns(conn.cursor(), 'spreads'):
+            migrate_timestamps(conn, tz)
+        migrate_instruments(conn)
+
+        if vacuum:
+            conn.execute("VACUUM")  # Возвращаем место от удаленных старых таблиц
+    conn.close()
+    logger.info(f"Миграция {db_path} завершена")
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Миграция БД спредов в актуальный формат')
+    parser.add_argument('db_path', nargs='?', default=DB_PATH, help=f'Путь к БД (по умолчанию {DB_PATH})')
+    parser.add_argument('--tz', default=TZ, help=f'Часовой пояс, в котором записано старое время (по умолчанию {TZ})')
+    parser.add_argument('--no-backup', action='store_true', help='Не делать резервную копию')
+    parser.add_argument('--no-vacuum', action='store_true', help='Не сжимать БД после миграции')
+    args = parser.parse_args()
+
+    setup_logging('logs.log', level=logging.INFO)  # Лог записываем в файл и выводим на консоль
+    migrate(args.db_path, args.tz, backup=not args.no_backup, vacuum=not args.no_vacuum)
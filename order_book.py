@@ -0,0 +1,181 @@
+from datetime import datetime
+
+import numpy as np
+
+from carry import calc_kerry_batch, calc_calendar_spreads_batch, calendar_pair_indices
+from db import datetime_to_ms
+
+DEPTH = 20  # Уровней стакана в каждую сторону, которые хранятся в памяти
+SIZES = (1, 10, 50)  # Объемы в лотах фьючерса, для которых считается керри по средневзвешенной цене
+
+
+class OrderBooks:
+    """
+    Стаканы инструментов в массивах numpy [стакан, уровень]: цены и объемы спроса и предложения, лучшие уровни первыми.
+    Пустые уровни - нулевой объем. Обновление переписывает строку стакана на месте, новые объекты на тик не создаются,
+    поэтому сотни стаканов занимают несколько массивов и пересчитываются векторно
+    """
+
+    def __init__(self, datanames, depth=DEPTH):
+        self.index = {dataname: i for i, dataname in enumerate(dict.fromkeys(datanames))}
+        self.depth = depth
+        shape = (len(self.index), depth)
+        self.bid_price, self.bid_qty = np.zeros(shape), np.zeros(shape)
+        self.offer_price, self.offer_qty = np.zeros(shape), np.zeros(shape)
+        self.levels = np.zeros((2, depth))  # Буфер разбора одной стороны: цены и объемы
+
+    def update(self, dataname, quote):
+        """
+        Стакан из OnQuote / get_quote_level2: спрос по возрастанию цены (лучший в конце), предложение по возрастанию.
+        Возвращает True, если стакан изменился
+        """
+        i = self.index.get(dataname)
+        if i is None:
+            return False
+        bids = quote.get('bid') or []
+        changed = self.fill(self.bid_price[i], self.bid_qty[i], bids[::-1])
+        return self.fill(self.offer_price[i], self.offer_qty[i], quote.get('offer') or []) or changed
+
+    def fill(self, prices, quantities, levels):
+        """Записывает уровни одной стороны в строку массивов. True, если значения изменились"""
+        buffer = self.levels
+        buffer.fill(0.0)
+        for n, level in enumerate(levels[:self.depth]):
+            buffer[0, n] = float(level['price'])
+            buffer[1, n] = float(level['quantity'])
+        if np.array_equal(buffer[0], prices) and np.array_equal(buffer[1], quantities):
+            return False
+        prices[:] = buffer[0]
+        quantities[:] = buffer[1]
+        return True
+
+    def best(self, rows):
+        """Лучшие (спрос, предложение) стаканов rows, nan - сторона пуста"""
+        bid = np.where(self.bid_qty[rows, 0] > 0, self.bid_price[rows, 0], np.nan)
+        offer = np.where(self.offer_qty[rows, 0] > 0, self.offer_price[rows, 0], np.nan)
+        return bid, offer
+
+    def vwap(self, rows, quantity):
+        """
+        Средневзвешенные цены (продажи по спросу, покупки по предложению) объема quantity для стаканов rows.
+        quantity - массив той же длины, что rows, в единицах стакана. nan - объема стакана не хватает
+        """
+        return (vwap(self.bid_price[rows], self.bid_qty[rows], quantity),
+                vwap(self.offer_price[rows], self.offer_qty[rows], quantity))
+
+
+def vwap(prices, quantities, quantity):
+    """Средняя цена исполнения объема quantity по уровням (строки - стаканы, лучшие уровни первыми)"""
+    before = np.cumsum(quantities, axis=1) - quantities  # Объем на лучших уровнях перед каждым
+    taken = np.clip(quantity[:, None] - before, 0.0, quantities)
+    filled = taken.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = (taken * prices).sum(axis=1) / filled
+    result[filled < quantity] = np.nan
+    return result
+
+
+class DepthCarry:
+    """
+    Керри акция/фьючерс и календарные спреды по средневзвешенным ценам стаканов для заданных объемов.
+    Объем задается в лотах фьючерса: по фьючерсу это size контрактов, по акции - size * лот фьючерса акций
+    (в стакане акции объем в лотах акции). Формулы - calc_kerry_batch и calc_calendar_spreads_batch
+    """
+
+    def __init__(self, list_datanames, specs, sizes=SIZES, depth=DEPTH):
+        legs = [(share, future) for datanames in list_datanames for share, futures in datanames.items()
+                if share in specs for future in futures if future in specs]
+        self.books = OrderBooks([name for leg in legs for name in leg], depth)
+        self.sizes = np.array(sizes, dtype=float)
+        self.share_rows = np.array([self.books.index[share] for share, _ in legs], dtype=np.intp)
+        self.future_rows = np.array([self.books.index[future] for _, future in legs], dtype=np.intp)
+        self.lot_size = np.array([float(specs[future]['lot_size']) for _, future in legs])
+        self.share_lot = np.array([float(specs[share]['lot_size'] or 1) for share, _ in legs])
+        self.exp_dates = [datetime.strptime(str(specs[future]['exp_date']), "%Y%m%d") for _, future in legs]
+        self.names = [(specs[share]['short_name'], specs[future]['short_name']) for share, future in legs]
+
+        # Календарные пары внутри акции в том же порядке, что и в calc_rows
+        near, far = calendar_pair_indices(self.share_rows, np.array([exp_date.toordinal() for exp_date in self.exp_dates]))
+        self.near, self.far = near, far
+
+        # Индексы зависимостей: {инструмент: номера ног}, {нога: номера пар}
+        self.legs_by_name = {}
+        for n, (share, future) in enumerate(legs):
+            self.legs_by_name.setdefault(share, []).append(n)
+            self.legs_by_name.setdefault(future, []).append(n)
+        self.pairs_by_leg = {}
+        for n, (i, j) in enumerate(zip(near.tolist(), far.tolist())):
+            self.pairs_by_leg.setdefault(i, []).append(n)
+            self.pairs_by_leg.setdefault(j, []).append(n)
+
+    def update(self, dataname, quote):
+        return self.books.update(dataname, quote)
+
+    def affected(self, datanames):
+        """Номера ног и календарных пар, зависящих от инструментов datanames"""
+        legs = sorted({leg for dataname in datanames for leg in self.legs_by_name.get(dataname, [])})
+        pairs = sorted({pair for leg in legs for pair in self.pairs_by_leg.get(leg, [])})
+        return legs, pairs
+
+    def all(self):
+        return list(range(len(self.names))), list(range(len(self.near)))
+
+    def leg_prices(self, legs, now):
+        """
+        Цены ног legs для всех объемов: массивы длины len(legs) * len(sizes) (нога за ногой, внутри - объемы).
+        Возвращает (bid_share, offer_share, bid_future, offer_future, lot_size, exp_days)
+        """
+        m = len(self.sizes)
+        legs = np.asarray(legs, dtype=np.intp)
+        quantity = np.tile(self.sizes, len(legs))
+        lot_size = np.repeat(self.lot_size[legs], m)
+        bid_future, offer_future = self.books.vwap(np.repeat(self.future_rows[legs], m), quantity)
+        bid_share, offer_share = self.books.vwap(np.repeat(self.share_rows[legs], m),
+                                                 quantity * lot_size / np.repeat(self.share_lot[legs], m))
+        exp_days = np.repeat(np.array([(self.exp_dates[leg] - now).days + 1 for leg in legs.tolist()], dtype=float), m)
+        return bid_share, offer_share, bid_future, offer_future, lot_size, exp_days
+
+    def compute(self, legs, pairs, now=None):
+        """
+        Строки spreads_depth по ногам legs и future_spreads_depth по парам pairs для всех объемов.
+        Если объема в стакане не хватает, цены и доходности - None
+        """
+        now = now or datetime.now()
+        ts = datetime_to_ms(now)
+        m = len(self.sizes)
+        sizes = self.sizes.astype(int).tolist()
+        spread_rows = []
+        if legs:
+            bid_share, offer_share, bid_future, offer_future, lot_size, exp_days = self.leg_prices(legs, now)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                buy, sell = calc_kerry_batch(bid_share, offer_share, bid_future, offer_future, lot_size, exp_days)
+            values = zip(bid_share.tolist(), offer_share.tolist(), bid_future.tolist(), offer_future.tolist(),
+                         buy.tolist(), sell.tolist())
+            for n, (bid_s, offer_s, bid_f, offer_f, buy_y, sell_y) in enumerate(values):
+                name_share, name_future = self.names[legs[n // m]]
+                spread_rows.append((ts, name_share, name_future, sizes[n % m], finite(bid_s), finite(offer_s),
+                                    finite(bid_f), finite(offer_f), finite(buy_y, 2), finite(sell_y, 2)))
+
+        future_spread_rows = []
+        if pairs:
+            near, far = self.near[pairs], self.far[pairs]
+            pair_legs, inverse = np.unique(np.concatenate((near, far)), return_inverse=True)
+            bid_share, offer_share, bid_future, offer_future, lot_size, exp_days = self.leg_prices(pair_legs, now)
+            offsets = np.arange(m)
+            near_idx = (inverse[:len(pairs), None] * m + offsets).ravel()  # Ближняя нога пары для каждого объема
+            far_idx = (inverse[len(pairs):, None] * m + offsets).ravel()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                spreads = calc_calendar_spreads_batch(bid_future, offer_future, bid_share * lot_size,
+                                                      offer_share * lot_size, exp_days, near_idx, far_idx)
+            for n, (bid, offer, bid_y, offer_y) in enumerate(zip(*(array.tolist() for array in spreads))):
+                pair = pairs[n // m]
+                future_spread_rows.append((ts, self.names[self.near[pair]][1], self.names[self.far[pair]][1], sizes[n % m],
+                                           finite(bid), finite(offer), finite(bid_y, 2), finite(offer_y, 2)))
+        return spread_rows, future_spread_rows
+
+
+def finite(value, digits=None):
+    """Значение для записи: None вместо nan/inf (объема в стакане не хватает), доходности округляются"""
+    if not np.isfinite(value):
+        return None
+    return round(value, digits) if digits is not None else value
@@ -0,0 +1,478 @@
+import argparse
+import csv
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+import zlib
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+from db import TZ
+from log_setup import setup_logging
+
+SEED = 0  # Зерно генератора: одинаковое зерно дает одинаковую последовательность тиков
+TICK_RATE = 1000  # Изменений стаканов в секунду по всем инструментам
+STEP = 0.05  # Шаг модельного времени, с. За шаг генерируется в среднем TICK_RATE * STEP изменений
+LATENCY = 0.0  # Задержка ответа на запрос, с (имитация обмена с QUIK# через сокет)
+DEPTH = 5  # Уровней стакана в каждую сторону
+VOLATILITY = 0.0005  # Ст. отклонение относительного изменения цены акции за тик
+BASIS_VOLATILITY = 0.0002  # Ст. отклонение изменения отклонения цены фьючерса от справедливой за тик
+CARRY_RATE = 0.16  # Годовая ставка, заложенная в цену фьючерса относительно акции
+FUTURE_LOT_SIZE = 100  # Лот фьючерса по умолчанию (акций в контракте)
+SHARE_CLASS = 'TQBR'
+FUTURE_CLASS = 'SPBFUT'
+FUTURE_MONTHS = 'FGHJKMNQUVXZ'  # Коды месяцев экспирации фьючерсов
+FUTURE_CODE = re.compile(rf'^\w{{2}}([{FUTURE_MONTHS}])(\d)$')  # Короткий код: SiU4, SRZ6
+FUTURE_NAME = re.compile(r'^.+-(\d{1,2})\.(\d{2})$')  # Короткое имя: GAZR-12.26
+CLASS_SEC = re.compile(r'^(\w+)\.(.+)$')  # Название с кодом режима торгов: TQBR.SBER
+RECORDING_COLUMNS = ['ts', 'class_code', 'sec_code', 'bid', 'offer']
+
+logger = logging.getLogger('quik_sim.py')
+
+
+# Третий четверг месяца - день экспирации фьючерсов в модели
+def third_thursday(year, month):
+    first = date(year, month, 1)
+    return first + timedelta(days=(3 - first.weekday()) % 7 + 14)
+
+
+# Дата экспирации фьючерса по коду в формате 20261217 или None, если код не похож на фьючерс
+def future_exp_date(sec_code, today=None):
+    today = today or date.today()
+    match = FUTURE_CODE.match(sec_code)
+    if match:
+        month = FUTURE_MONTHS.index(match.group(1)) + 1
+        year = today.year - today.year % 10 + int(match.group(2))
+        if third_thursday(year, month) < today:  # Последняя цифра года - ближайший год не в прошлом
+            year += 10
+        return int(third_thursday(year, month).strftime('%Y%m%d'))
+    match = FUTURE_NAME.match(sec_code)
+    if match and 1 <= int(match.group(1)) <= 12:
+        return int(third_thursday(2000 + int(match.group(2)), int(match.group(1))).strftime('%Y%m%d'))
+    return None
+
+
+# Записанный поток котировок: строки (ts в мс, class_code, sec_code, bid, offer) по возрастанию времени
+def read_recording(path):
+    with open(path, mode='r', encoding='utf-8') as f:
+        rows = [(int(row['ts']), row['class_code'], row['sec_code'], float(row['bid']), float(row['offer']))
+                for row in csv.DictReader(f, delimiter=';')]
+    rows.sort(key=lambda row: row[0])
+    return rows
+
+
+class QuoteRecorder:
+    """
+    Запись котировок, полученных от QUIK, в CSV для последующего воспроизведения в SimMarket.
+    Формат: ts;class_code;sec_code;bid;offer, время - мс от эпохи
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, mode='a', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.file, delimiter=';')
+        if is_new:
+            self.writer.writerow(RECORDING_COLUMNS)
+        self.lock = threading.Lock()  # Пишут поток опроса и поток обратного вызова
+        self.rows = 0
+
+    def write(self, specs, quotes, ts=None):
+        """Снимок котировок {dataname: (bid, offer)}, specs - {dataname: спецификация}"""
+        ts = ts or int(time.time() * 1000)
+        with self.lock:
+            for dataname, (bid, offer) in quotes.items():
+                spec = specs[dataname]
+                self.writer.writerow([ts, spec['class_code'], spec['sec_code'], bid, offer])
+            self.rows += len(quotes)
+
+    def write_tick(self, class_code, sec_code, bid, offer, ts=None):
+        with self.lock:
+            self.writer.writerow([ts or int(time.time() * 1000), class_code, sec_code, bid, offer])
+            self.rows += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+        logger.info(f"Записано котировок: {self.rows} в {self.path}")
+
+
+class Event:
+    """Событие с подписчиками, как on_quote и другие события QuikPy"""
+
+    def __init__(self):
+        self.handlers = []
+
+    def subscribe(self, handler):
+        self.handlers.append(handler)
+
+    def unsubscribe(self, handler):
+        self.handlers.remove(handler)
+
+    def trigger(self, data):
+        for handler in self.handlers:
+            handler(data)
+
+
+class SimMarket:
+    """
+    Модель рынка для QuikSim: цены всех инструментов в массивах NumPy и поток, который с шагом STEP
+    изменяет стаканы и рассылает подписанным подключениям события on_quote.
+    Синтетический режим: цена акции - случайное блуждание, цена фьючерса - цена акции с учетом лота и ставки CARRY_RATE
+    плюс свое блуждание отклонения. Режим записи: котировки берутся из файла QuoteRecorder с исходными паузами.
+    Последовательность тиков определяется зерном и номером шага и не зависит от скорости машины. Начальные цены
+    и изменения цены инструмента берутся из его собственного генератора (зерно и код инструмента): добавление
+    других инструментов и порядок их добавления не меняют его ряд
+    """
+
+    def __init__(self, seed=SEED, tick_rate=TICK_RATE, recording=None, speed=1.0, latency=LATENCY, step=STEP,
+                 specs_path=None):
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)  # Какие инструменты изменяются на шаге
+        self.rngs = []  # Генераторы инструментов по номерам
+        self.tick_rate = tick_rate
+        self.speed = speed  # Ускорение модельного времени относительно реального
+        self.latency = latency
+        self.step_seconds = step
+        self.lock = threading.Lock()
+        self.index = {}  # {(class_code, sec_code): номер инструмента}
+        self.codes = []  # [(class_code, sec_code)] по номерам
+        self.specs = {}  # {номер: спецификация для get_symbol_info}
+        self.known_specs = {}  # {(class_code, sec_code): спецификация} из кэша спецификаций реального QUIK
+        if specs_path is not None:
+            with open(specs_path, mode='r', encoding='utf-8') as f:
+                self.known_specs = {(spec['class_code'], spec['sec_code']): spec for spec in json.load(f).values()}
+        self.mid = np.empty(0)  # Середина спреда
+        self.basis = np.empty(0)  # Отклонение фьючерса от справедливой цены, доля
+        self.underlying = np.empty(0, dtype=np.intp)  # Номер акции фьючерса, -1 - независимое блуждание
+        self.fair_factor = np.empty(0)  # Лот * (1 + ставка * дней / 365) для фьючерсов
+        self.price_step = np.empty(0)
+        self.spread_steps = np.empty(0)  # Ширина спреда в шагах цены
+        self.bid = np.empty(0)
+        self.offer = np.empty(0)
+        self.connections = []
+        self.clock = 0  # Модельное время, мс
+        self.steps = 0
+        self.ticks = 0  # Сгенерировано изменений стаканов
+        self.thread = None
+        self.stopping = threading.Event()
+        self.recording = None
+        self.recording_pos = 0
+        self.finished = threading.Event()  # Запись воспроизведена до конца
+        if recording is not None:
+            self.load_recording(recording)
+
+    def load_recording(self, path):
+        self.recording = read_recording(path)
+        for _, class_code, sec_code, _, _ in self.recording:
+            if (class_code, sec_code) not in self.index:
+                self.add(class_code, sec_code)
+        self.clock = self.recording[0][0] if self.recording else 0
+        logger.info(f"Загружено котировок: {len(self.recording)} по {len(self.codes)} инструментам из {path}")
+
+    def add(self, class_code, sec_code):
+        """Добавляет инструмент в модель, возвращает его номер"""
+        with self.lock:
+            n = self.index.get((class_code, sec_code))
+            if n is not None:
+                return n
+            n = len(self.codes)
+            self.index[(class_code, sec_code)] = n
+            self.codes.append((class_code, sec_code))
+            exp_date = future_exp_date(sec_code) if class_code == FUTURE_CLASS else None
+            lot_size = FUTURE_LOT_SIZE if exp_date else 1
+            self.specs[n] = {'class_code': class_code, 'code': sec_code, 'sec_code': sec_code,
+                             'name': sec_code, 'short_name': sec_code, 'lot_size': lot_size,
+                             'exp_date': exp_date or 0, 'face_unit': 'SUR'}
+            known = self.known_specs.get((class_code, sec_code))
+            if known is not None:
+                self.specs[n].update({key: known[key] for key in ('short_name', 'lot_size', 'exp_date', 'face_unit')})
+                lot_size = known['lot_size']
+            rng = np.random.default_rng([self.seed, zlib.crc32(f"{class_code}.{sec_code}".encode())])
+            self.rngs.append(rng)
+            share_price = float(np.round(rng.uniform(10, 1000), 2))
+            price_step = 1.0 if exp_date else 0.01
+            mid = share_price * lot_size
+            self.mid = np.append(self.mid, mid)
+            self.basis = np.append(self.basis, 0.0)
+            self.underlying = np.append(self.underlying, -1)
+            self.fair_factor = np.append(self.fair_factor, lot_size)
+            self.price_step = np.append(self.price_step, price_step)
+            self.spread_steps = np.append(self.spread_steps, float(rng.integers(1, 4)))
+            self.bid = np.append(self.bid, np.nan)
+            self.offer = np.append(self.offer, np.nan)
+            if self.recording is None:
+                self.update_quotes(np.array([n]))
+            for connection in self.connections:
+                connection.subscribed = np.append(connection.subscribed, False)
+            return n
+
+    def link(self, list_datanames, today=None):
+        """Связывает фьючерсы из файла настроек с акциями, чтобы керри было правдоподобным"""
+        if self.recording is not None:  # Цены записи согласованы сами по себе
+            return
+        today = today or date.today()
+        for datanames in list_datanames:
+            for share, futures in datanames.items():
+                share_n = self.add(*dataname_to_codes(share))
+                for future in futures:
+                    n = self.add(*dataname_to_codes(future))
+                    exp_date = self.specs[n]['exp_date']
+                    if not exp_date:
+                        continue
+                    days = max((datetime.strptime(str(exp_date), '%Y%m%d').date() - today).days, 0)
+                    with self.lock:
+                        self.underlying[n] = share_n
+                        self.fair_factor[n] = self.specs[n]['lot_size'] * (1 + CARRY_RATE * days / 365)
+                        self.mid[n] = self.mid[share_n] * self.fair_factor[n]
+                        if self.recording is None:
+                            self.update_quotes(np.array([n]))
+
+    def update_quotes(self, n):
+        """Лучшие цены по середине спреда с округлением до шага цены"""
+        half = self.spread_steps[n] * self.price_step[n] / 2
+        self.bid[n] = np.maximum(np.floor((self.mid[n] - half) / self.price_step[n]), 1) * self.price_step[n]
+        self.offer[n] = self.bid[n] + self.spread_steps[n] * self.price_step[n]
+
+    def step(self):
+        """Один шаг модельного времени. Возвращает номера инструментов, стаканы которых изменились"""
+        with self.lock:
+            self.steps += 1
+            if self.recording is not None:
+                changed = self.replay_step()
+            elif self.codes:
+                changed = self.synthetic_step()
+            else:
+                changed = np.empty(0, dtype=np.intp)
+            self.ticks += len(changed)
+            return changed
+
+    def synthetic_step(self):
+        self.clock += int(self.step_seconds * 1000)
+        k = self.rng.poisson(self.tick_rate * self.step_seconds)
+        ticks = self.rng.integers(0, len(self.codes), k)
+        changed, counts = np.unique(ticks, return_counts=True)
+        # Сумма изменений за тики шага из генератора инструмента
+        shocks = np.array([self.rngs[n].standard_normal(count).sum() for n, count in zip(changed, counts)])
+        linked = self.underlying[changed] >= 0
+
+        walk = changed[~linked]  # Акции и фьючерсы без акции - случайное блуждание цены
+        self.mid[walk] *= np.exp(VOLATILITY * shocks[~linked])
+        futures = changed[linked]  # Фьючерсы - от цены акции на конец шага
+        self.basis[futures] += BASIS_VOLATILITY * shocks[linked]
+        np.clip(self.basis, -0.05, 0.05, out=self.basis)
+        self.mid[futures] = self.mid[self.underlying[futures]] * self.fair_factor[futures] * (1 + self.basis[futures])
+
+        self.update_quotes(changed)
+        return changed
+
+    def replay_step(self):
+        self.clock += int(self.step_seconds * 1000)
+        changed = []
+        while self.recording_pos < len(self.recording) and self.recording[self.recording_pos][0] <= self.clock:
+            _, class_code, sec_code, bid, offer = self.recording[self.recording_pos]
+            n = self.index[(class_code, sec_code)]
+            self.bid[n], self.offer[n] = bid, offer
+            changed.append(n)
+            self.recording_pos += 1
+        if self.recording_pos >= len(self.recording) and not self.finished.is_set():
+            logger.info("Запись котировок воспроизведена до конца")
+            self.finished.set()
+        return np.unique(np.array(changed, dtype=np.intp))
+
+    def level2(self, n):
+        """Стакан в формате QUIK: спрос по возрастанию цены (лучший в конце), предложение по возрастанию (лучшее в начале)"""
+        price_step = self.price_step[n]
+        bid, offer = self.bid[n], self.offer[n]
+        class_code, sec_code = self.codes[n]
+        return {'class_code': class_code, 'sec_code': sec_code, 'bid_count': str(DEPTH), 'offer_count': str(DEPTH),
+                'bid': [{'price': str(round(bid - i * price_step, 6)), 'quantity': str(10 * (i + 1))}
+                        for i in reversed(range(DEPTH))],
+                'offer': [{'price': str(round(offer + i * price_step, 6)), 'quantity': str(10 * (i + 1))}
+                          for i in range(DEPTH)]}
+
+    def run(self):
+        interval = self.step_seconds / self.speed
+        next_run = time.monotonic()
+        while not self.stopping.is_set():
+            changed = self.step()
+            with self.lock:
+                connections = list(self.connections)
+                events = [(connection, [self.level2(n) for n in changed[connection.subscribed[changed]]])
+                          for connection in connections]
+            for connection, quotes in events:
+                for quote in quotes:
+                    try:
+                        connection.on_quote.trigger({'cmd': 'OnQuote', 'data': quote})
+                    except Exception as e:
+                        logger.error(f"Ошибка в обработчике on_quote: {e}", exc_info=True)
+            next_run += interval
+            delay = next_run - time.monotonic()
+            if delay > 0:
+                self.stopping.wait(delay)
+            else:
+                next_run = time.monotonic()  # Не успеваем за заданной частотой - не навёрстываем
+
+    def connect(self, connection):
+        with self.lock:
+            connection.subscribed = np.zeros(len(self.codes), dtype=bool)
+            self.connections.append(connection)
+            if self.thread is None:
+                self.stopping.clear()
+                self.thread = threading.Thread(target=self.run, name='SimMarket', daemon=True)
+                self.thread.start()
+
+    def disconnect(self, connection):
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+            thread = self.thread if not self.connections else None
+            if thread is not None:
+                self.thread = None
+        if thread is not None:
+            self.stopping.set()
+            thread.join()
+
+
+# Код режима торгов и тикер по названию инструмента (как в QuikPy: CLASS.SEC или только тикер)
+def dataname_to_codes(dataname):
+    match = CLASS_SEC.match(dataname)
+    if match:
+        return match.group(1), match.group(2)
+    return (FUTURE_CLASS if future_exp_date(dataname) else SHARE_CLASS), dataname
+
+
+class QuikSim:
+    """
+    Подключение к SimMarket с методами QuikPy, которые использует spread.py.
+    Несколько подключений к одной модели видят одни и те же цены (как несколько скриптов QUIK# в одном терминале).
+    Запросы через одно подключение выполняются по одному с задержкой latency модели
+    """
+
+    tz_msk = ZoneInfo(TZ)
+
+    def __init__(self, market=None, **kwargs):  # host, requests_port, callbacks_port QuikPy не используются
+        self.market = market if market is not None else SimMarket()
+        self.socket_lock = threading.Lock()  # Сокет QuikPy обслуживает один запрос за раз
+        self.on_quote = Event()
+        self.subscribed = None  # Маска подписки на стаканы по номерам инструментов, задается в connect
+        self.market.connect(self)
+
+    def request(self):
+        if self.market.latency:
+            time.sleep(self.market.latency)
+
+    def dataname_to_class_sec_codes(self, dataname):
+        with self.socket_lock:
+            self.request()
+            class_code, sec_code = dataname_to_codes(dataname)
+            if self.market.recording is None:
+                self.market.add(class_code, sec_code)
+            return class_code, sec_code
+
+    def get_symbol_info(self, class_code, sec_code):
+        with self.socket_lock:
+            self.request()
+            n = self.market.index.get((class_code, sec_code))
+            return dict(self.market.specs[n]) if n is not None else None
+
+    def get_param_ex(self, class_code, sec_code, param_name):
+        with self.socket_lock:
+            self.request()
+            n = self.market.index.get((class_code, sec_code))
+            value = math.nan  # Нет инструмента или котировок - как в QUIK, значение 0 и признак ошибки
+            if n is not None and param_name.lower() in ('bid', 'offer'):
+                with self.market.lock:
+                    value = float((self.market.bid if param_name.lower() == 'bid' else self.market.offer)[n])
+            if math.isnan(value):
+                return {'data': {'param_type': '1', 'param_value': '0', 'param_image': '', 'result': '0'}}
+            image = str(round(value, 6))
+            return {'data': {'param_type': '1', 'param_value': image, 'param_image': image, 'result': '1'}}
+
+    def get_quote_level2(self, class_code, sec_code, trans_id=0):
+        with self.socket_lock:
+            self.request()
+            n = self.market.index.get((class_code, sec_code))
+            if n is None:
+                return {'data': {'class_code': class_code, 'sec_code': sec_code, 'bid_count': '0', 'offer_count': '0'}}
+            with self.market.lock:
+                return {'data': self.market.level2(n)}
+
+    def subscribe_level2_quotes(self, class_code, sec_code):
+        n = self.market.index.get((class_code, sec_code))
+        if n is None:
+            n = self.market.add(class_code, sec_code)
+        with self.market.lock:
+            self.subscribed[n] = True
+        return {'data': True}
+
+    def unsubscribe_level2_quotes(self, class_code, sec_code):
+        n = self.market.index.get((class_code, sec_code))
+        if n is not None:
+            with self.market.lock:
+                self.subscribed[n] = False
+        return {'data': True}
+
+    def close_connection_and_thread(self):
+        self.market.disconnect(self)
+
+
+# Ближайшие квартальные экспирации в формате кода из имени фьючерса: ['12.26', '3.27', ...]
+def quarterly_expirations(count, today=None):
+    today = today or date.today()
+    expirations = []
+    year, month = today.year, today.month + (-today.month) % 3
+    while len(expirations) < count:
+        if month > 12:
+            year, month = year + 1, month - 12
+        if third_thursday(year, month) >= today:
+            expirations.append(f"{month}.{year % 100:02d}")
+        month += 3
+    return expirations
+
+
+# Файл настроек spread.py с заданным кол-вом акций и фьючерсов для нагрузочной проверки
+def write_watchlist(path, shares, futures_per_share, today=None):
+    expirations = quarterly_expirations(futures_per_share, today)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, mode='w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, delimiter=';')
+        writer.writerow(['share', *[f'future{i + 1}' for i in range(futures_per_share)]])
+        for i in range(shares):
+            share = f"S{i:04d}"
+            writer.writerow([share, *[f"{share}-{expiration}" for expiration in expirations]])
+    logger.info(f"Записан файл настроек {path}: акций {shares}, фьючерсов {shares * futures_per_share}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Модель QUIK для проверки spread.py без терминала')
+    parser.add_argument('--watchlist', metavar='PATH', help='Записать файл настроек с синтетическими инструментами')
+    parser.add_argument('--shares', type=int, default=1000, help='Акций в файле настроек')
+    parser.add_argument('--futures', type=int, default=2, help='Фьючерсов на акцию в файле настроек')
+    parser.add_argument('--rate', type=float, default=TICK_RATE, help='Изменений стаканов в секунду')
+    parser.add_argument('--seed', type=int, default=SEED, help='Зерно генератора')
+    parser.add_argument('--seconds', type=float, default=10, help='Длительность проверки скорости модели, с')
+    args = parser.parse_args()
+
+    setup_logging(level=logging.INFO)
+    if args.watchlist:
+        write_watchlist(args.watchlist, args.shares, args.futures)
+    else:  # Проверка скорости: сколько событий on_quote модель выдает подписчику
+        market = SimMarket(seed=args.seed, tick_rate=args.rate)
+        provider = QuikSim(market)
+        received = [0]
+        provider.on_quote.subscribe(lambda data: received.__setitem__(0, received[0] + 1))
+        for i in range(args.shares):
+            share = provider.dataname_to_class_sec_codes(f"S{i:04d}")
+            provider.subscribe_level2_quotes(*share)
+        time.sleep(args.seconds)
+        provider.close_connection_and_thread()
+        logger.info(f"Инструментов: {len(market.codes)}, шагов: {market.steps}, изменений стаканов: {market.ticks}, "
+                    f"событий on_quote: {received[0]} ({received[0] / args.seconds:.0f}/с)")
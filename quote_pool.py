@@ -0,0 +1,94 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+HOST = '127.0.0.1'
+REQUESTS_PORT = 34130  # Порты первого скрипта QUIK#. Каждый следующий скрипт слушает на 2 порта дальше
+CALLBACKS_PORT = 34131
+
+logger = logging.getLogger('quote_pool.py')
+
+
+# Лучшие цены спроса и предложения через заданное подключение: один запрос стакана вместо двух get_param_ex
+def fetch_quote(provider, class_code, sec_code):
+    """Спрос по возрастанию цены (лучший в конце), предложение по возрастанию (лучшее в начале). 0 - сторона пуста"""
+    quote = provider.get_quote_level2(class_code, sec_code)['data'] or {}
+    bids, offers = quote.get('bid') or [], quote.get('offer') or []
+    bid = float(bids[-1]['price']) if bids else 0.0
+    offer = float(offers[0]['price']) if offers else 0.0
+    return bid, offer
+
+
+# Подписка на стаканы всего списка один раз: QUIK отдает стакан по getQuoteLevel2, только если он заказан
+def subscribe_quotes(provider, specs):
+    for dataname, spec in specs.items():
+        try:
+            provider.subscribe_level2_quotes(spec['class_code'], spec['sec_code'])
+        except Exception as e:
+            logger.error(f"Не удалось подписаться на стакан {dataname}. Ошибка: {e}")
+
+
+def unsubscribe_quotes(provider, specs):
+    for dataname, spec in specs.items():
+        try:
+            provider.unsubscribe_level2_quotes(spec['class_code'], spec['sec_code'])
+        except Exception as e:
+            logger.error(f"Не удалось отменить подписку на стакан {dataname}. Ошибка: {e}")
+
+
+# Порты подключения номер n (0 - основное)
+def connection_ports(n):
+    return REQUESTS_PORT + 2 * n, CALLBACKS_PORT + 2 * n
+
+
+class QuotePool:
+    """
+    Параллельный запрос котировок через несколько подключений к QUIK.
+    Список инструментов делится между подключениями, каждое опрашивается своим потоком,
+    результаты объединяются в один снимок. Подключение не используется двумя потоками одновременно.
+    Для N подключений в QUIK должно быть запущено N скриптов QUIK# на портах из connection_ports
+    """
+
+    def __init__(self, providers, own_from=0):
+        self.providers = list(providers)
+        self.own_from = own_from  # Подключения начиная с этого номера открыты пулом и закрываются им
+        self.executor = ThreadPoolExecutor(max_workers=len(self.providers), thread_name_prefix='QuotePool')
+
+    @classmethod
+    def connect(cls, provider_class, connections, main_provider=None, host=HOST):
+        """
+        Создает пул из connections подключений. main_provider - уже открытое основное подключение (порты 0-го скрипта),
+        оно используется первым, остальные открываются здесь
+        """
+        providers = [main_provider] if main_provider is not None else []
+        for n in range(len(providers), connections):
+            requests_port, callbacks_port = connection_ports(n)
+            providers.append(provider_class(host=host, requests_port=requests_port, callbacks_port=callbacks_port))
+            logger.info(f"Открыто подключение к QUIK #{n} (порты {requests_port}, {callbacks_port})")
+        return cls(providers, own_from=1 if main_provider is not None else 0)
+
+    def get_quotes(self, specs):
+        """specs - {dataname: спецификация из SpecCache}. Возвращает {dataname: (bid, offer)} в порядке specs"""
+        items = list(specs.items())
+        n = len(self.providers)
+        shards = [items[i::n] for i in range(n)]  # Поровну между подключениями
+        results = self.executor.map(self.fetch_shard, self.providers, shards)
+        merged = {}
+        for shard_quotes in results:
+            merged.update(shard_quotes)
+        return {dataname: merged[dataname] for dataname, _ in items if dataname in merged}
+
+    @staticmethod
+    def fetch_shard(provider, items):
+        quotes = {}
+        for dataname, spec in items:
+            try:
+                quotes[dataname] = fetch_quote(provider, spec['class_code'], spec['sec_code'])
+            except Exception as e:
+                logger.error(f"Не удалось получить котировки по {dataname}. Ошибка: {e}")
+        return quotes
+
+    def close(self):
+        """Останавливает потоки и закрывает открытые пулом подключения"""
+        self.executor.shutdown()
+        for provider in self.providers[self.own_from:]:
+            provider.close_connection_and_thread()
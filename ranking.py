@@ -0,0 +1,94 @@
+import bisect
+import threading
+
+from change_filter import KEY_COLUMNS
+from db import ROW_COLUMNS
+
+TOP_K = 5  # Строк в топе по умолчанию
+
+# Доходности, по которым строки ранжируются, по таблицам
+RANKED_COLUMNS = {
+    'spreads': ('kerry_buy_spread_y', 'kerry_sell_spread_y'),
+    'future_spreads': ('spread_bid_y', 'spread_offer_y'),
+}
+
+
+class SortedRanking:
+    """
+    Ключи, упорядоченные по убыванию значения: отсортированный список (-значение, ключ) и словарь {ключ: значение}.
+    Обновление - двоичный поиск и сдвиг списка, первые k ключей берутся срезом без сортировки
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.order = []
+
+    def __len__(self):
+        return len(self.order)
+
+    def update(self, key, value):
+        """Новое значение ключа, None - убрать ключ из рейтинга"""
+        old = self.values.get(key)
+        if old == value:
+            return
+        if old is not None:
+            del self.order[bisect.bisect_left(self.order, (-old, key))]
+            del self.values[key]
+        if value is not None:
+            bisect.insort(self.order, (-value, key))
+            self.values[key] = value
+
+    def top(self, k):
+        """[(ключ, значение)] первых k ключей"""
+        return [(key, -value) for value, key in self.order[:k]]
+
+
+class Ranking:
+    """
+    Текущий топ строк сборщика по доходностям RANKED_COLUMNS по всем фьючерсам и парам фьючерсов.
+    Обновляется каждой пачкой пересчитанных строк, топ отдается за O(K) без запросов к таблицам истории.
+    Читается из других потоков (сервер метрик), поэтому изменения и чтение идут под блокировкой
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = {table_name: {} for table_name in RANKED_COLUMNS}  # {таблица: {ключ: последняя строка}}
+        self.rankings = {(table_name, column): SortedRanking()
+                         for table_name, columns in RANKED_COLUMNS.items() for column in columns}
+        self.indices = {table_name: ([ROW_COLUMNS[table_name].index(column) for column in KEY_COLUMNS[table_name]],
+                                     {column: ROW_COLUMNS[table_name].index(column) for column in columns})
+                        for table_name, columns in RANKED_COLUMNS.items()}
+
+    def update(self, table_name, rows, removed=None):
+        """
+        Строки таблицы table_name в формате ROW_COLUMNS. removed - ключи (значения KEY_COLUMNS), строки которых
+        больше не считаются: нет котировок, фьючерс экспирируется или доходность не определена.
+        removed=None - rows содержат все строки прохода, ключи, которых в них нет, убираются из топа
+        """
+        key_indices, value_indices = self.indices[table_name]
+        latest = self.rows[table_name]
+        with self.lock:
+            keys = set()
+            for row in rows:
+                key = tuple(row[i] for i in key_indices)
+                keys.add(key)
+                latest[key] = row
+                for column, i in value_indices.items():
+                    value = row[i]
+                    self.rankings[table_name, column].update(key, value if value == value else None)  # nan - как None
+            for key in (latest.keys() - keys) if removed is None else removed:
+                if latest.pop(key, None) is not None:
+                    for column in value_indices:
+                        self.rankings[table_name, column].update(key, None)
+
+    def top(self, table_name, column, k=TOP_K):
+        """Первые k строк таблицы table_name по убыванию column: [{столбец: значение}]"""
+        columns = ROW_COLUMNS[table_name]
+        latest = self.rows[table_name]
+        with self.lock:
+            return [dict(zip(columns, latest[key])) for key, _ in self.rankings[table_name, column].top(k)]
+
+    def snapshot(self, k=TOP_K):
+        """Топы по всем таблицам и доходностям: {таблица: {столбец: [строки]}}"""
+        return {table_name: {column: self.top(table_name, column, k) for column in columns}
+                for table_name, columns in RANKED_COLUMNS.items()}
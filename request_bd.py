@@ -1,72 +1,94 @@
+import argparse
 import sqlite3
 import logging
+import urllib.parse
+from datetime import datetime
+
+from log_setup import setup_logging
+from metrics import METRICS_HOST, METRICS_PORT, fetch_summary
 
 logger = logging.getLogger('request.py')
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',  # Формат сообщения
-                    datefmt='%d.%m.%Y %H:%M:%S',  # Формат даты
-                    level=logging.DEBUG,  # Уровень логируемых событий NOTSET/DEBUG/INFO/WARNING/ERROR/CRITICAL
-                    handlers=[logging.FileHandler('logs.log', encoding='utf-8'),
-                              logging.StreamHandler()])  # Лог записываем в файл и выводим на консоль
 
-conn = sqlite3.connect('data/futures_spreads.db')
-cursor = conn.cursor()
+DB_PATH = 'data/futures_spreads.db'
+COLLECTOR_TOP_URL = f"http://{METRICS_HOST}:{METRICS_PORT}/top.json"  # Текущий топ сборщика (spread.py в постоянном режиме)
+
+# Столбцы топов в том же порядке, что и в запросах к БД
+TOP_SPREADS_COLUMNS = ('name_share', 'name_future', 'kerry_buy_spread_y', 'kerry_sell_spread_y')
+TOP_FUTURE_SPREADS_COLUMNS = ('near_future', 'far_future', 'spread_bid_y', 'spread_offer_y')
 
 # SQL-запроса получения Топ-5 спредов между акцией и фьючерсом по kerry_sell_spread_y
-cursor.execute(
-    '''
-        SELECT trade_time, name_share, name_future, kerry_buy_spread_y, kerry_sell_spread_y
-        FROM spreads
-        WHERE (name_share, trade_time) IN (
-            SELECT name_share, MAX(trade_time)
-            FROM spreads
-            GROUP BY name_share
-        )
-        ORDER BY kerry_buy_spread_y DESC
-        LIMIT 5;
-    '''
-)
-
-# Заголовки из запроса
-headers = [description[0] for description in cursor.description]
-
-# Полученные данные
-rows = cursor.fetchall()
-
-if rows:
-    logging.info("Вывод спреда между акцией и фьючерсом.")
-    logging.info(headers)
-    for row in rows:
-        logging.info(row)
-else:
-    logging.info("Нет записей")
+TOP_SPREADS_SQL = '''
+    SELECT strftime('%d.%m.%Y %H:%M:%S', ts / 1000, 'unixepoch', 'localtime') AS trade_time,
+           name_share, name_future, kerry_buy_spread_y, kerry_sell_spread_y
+    FROM spreads_latest
+    ORDER BY kerry_buy_spread_y DESC
+    LIMIT 5;
+'''
 
 # SQL-запроса получения Топ-5 спредов фьючерсами по spread
-cursor.execute(
-    '''
-        SELECT trade_time, near_future, far_future, spread_bid_y, spread_offer_y
-        FROM future_spreads
-        WHERE (far_future, trade_time) IN (
-            SELECT far_future, MAX(trade_time)
-            FROM future_spreads
-            GROUP BY far_future
-        )
-        ORDER BY spread_bid_y DESC
-        LIMIT 5;
-    '''
-)
-
-# Заголовки из запроса
-headers = [description[0] for description in cursor.description]
-
-# Полученные данные
-rows = cursor.fetchall()
-
-if rows:
-    logging.info("Вывод спреда между фьючерсами.")
-    logging.info(headers)
-    for row in rows:
-        logging.info(row)
-else:
-    logging.info("Нет записей")
-
-conn.close()
+TOP_FUTURE_SPREADS_SQL = '''
+    SELECT strftime('%d.%m.%Y %H:%M:%S', ts / 1000, 'unixepoch', 'localtime') AS trade_time,
+           near_future, far_future, spread_bid_y, spread_offer_y
+    FROM future_spreads_latest
+    ORDER BY spread_bid_y DESC
+    LIMIT 5;
+'''
+
+
+# Выполнение запроса. Возвращает (заголовки, строки)
+def fetch(cursor, sql):
+    cursor.execute(sql)
+    headers = [description[0] for description in cursor.description]  # Заголовки из запроса
+    return headers, cursor.fetchall()  # Полученные данные
+
+
+def get_top_spreads(cursor):
+    return fetch(cursor, TOP_SPREADS_SQL)
+
+
+def get_top_future_spreads(cursor):
+    return fetch(cursor, TOP_FUTURE_SPREADS_SQL)
+
+
+# Топ из памяти сборщика без запроса к БД. Возвращает (заголовки, строки) или None, если сборщик недоступен
+def fetch_collector_top(table_name, order_column, columns, url=COLLECTOR_TOP_URL, k=5):
+    query = urllib.parse.urlencode({'table': table_name, 'column': order_column, 'k': k})
+    rows = fetch_summary(f"{url}?{query}")
+    if rows is None:
+        return None
+    headers = ['trade_time', *columns]
+    return headers, [(datetime.fromtimestamp(row['ts'] / 1000).strftime('%d.%m.%Y %H:%M:%S'),
+                      *(row[column] for column in columns)) for row in rows]
+
+
+def log_rows(title, headers, rows):
+    if rows:
+        logging.info(title)
+        logging.info(headers)
+        for row in rows:
+            logging.info(row)
+    else:
+        logging.info("Нет записей")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Топ-5 спредов между акцией и фьючерсом и между фьючерсами')
+    parser.add_argument('--collector', nargs='?', const=COLLECTOR_TOP_URL, metavar='URL',
+                        help=f'Брать топ из памяти работающего сборщика (по умолчанию {COLLECTOR_TOP_URL}), '
+                             f'при недоступности - из БД')
+    args = parser.parse_args()
+
+    setup_logging('logs.log')  # Лог записываем в файл и выводим на консоль
+
+    top_spreads = top_future_spreads = None
+    if args.collector:
+        top_spreads = fetch_collector_top('spreads', 'kerry_buy_spread_y', TOP_SPREADS_COLUMNS, args.collector)
+        top_future_spreads = fetch_collector_top('future_spreads', 'spread_bid_y', TOP_FUTURE_SPREADS_COLUMNS, args.collector)
+        if top_spreads is None or top_future_spreads is None:
+            logger.warning(f"Сборщик недоступен по адресу {args.collector}, топ берется из БД")
+
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    log_rows("Вывод спреда между акцией и фьючерсом.", *(top_spreads or get_top_spreads(cursor)))
+    log_rows("Вывод спреда между фьючерсами.", *(top_future_spreads or get_top_future_spreads(cursor)))
+    conn.close()
@@ -0,0 +1,221 @@
+import argparse
+import logging
+import os
+import shutil
+import threading
+import time
+
+from archive import ARCHIVE_COLUMNS, ARCHIVE_DIR, DAY_MS, partitions
+from db import DB_PATH, connect, init_db, now_ms
+from log_setup import setup_logging
+from rollup import ROLLUPS, update_rollups
+
+# Уровни, для которых задается срок хранения в днях: сырые строки в SQLite, разделы архива archive.py и агрегаты.
+# Срок хранения не задан по умолчанию: удаляется только то, что явно указано (--retention raw=7,1m=90)
+RETENTION_LEVELS = ('raw', 'archive', '1m', '1h', '1d')
+RETENTION_EXAMPLE = 'raw=7,archive=7,1m=90,1h=90'
+BATCH_SIZE = 5000  # Строк в одной транзакции удаления
+BATCH_PAUSE = 0.05  # Пауза между транзакциями, с: сборщик и app.py успевают получить блокировку
+VACUUM_PAGES = 1000  # Страниц, возвращаемых файловой системе за один шаг incremental_vacuum
+RETENTION_INTERVAL = 3600  # Интервал очистки в фоне, с
+
+logger = logging.getLogger('retention.py')
+
+
+def pause(stop_event):
+    """Пауза между пакетами. True - пора остановиться"""
+    if stop_event is not None:
+        return stop_event.wait(BATCH_PAUSE)
+    time.sleep(BATCH_PAUSE)
+    return False
+
+
+def cutoff_ms(days):
+    return int(now_ms() - days * DAY_MS)
+
+
+def delete_raw(conn, table_name, cutoff, batch_size=BATCH_SIZE, stop_event=None):
+    """
+    Удаляет сырые строки старше cutoff пакетами по batch_size, каждый пакет - отдельная короткая транзакция.
+    Удаляются только строки, уже учтенные в агрегатах (id не больше rollup_state.last_id)
+    """
+    row = conn.execute("SELECT last_id FROM rollup_state WHERE table_name = ?", (table_name,)).fetchone()
+    max_id = row[0] if row else 0
+    total = 0
+    while True:
+        with conn:
+            deleted = conn.execute(f"DELETE FROM {table_name} WHERE id IN "
+                                   f"(SELECT id FROM {table_name} WHERE ts < ? AND id <= ? LIMIT ?)",
+                                   (cutoff, max_id, batch_size)).rowcount
+        total += deleted
+        if deleted < batch_size or pause(stop_event):
+            return total
+
+
+def delete_rollup(conn, table_name, resolution, cutoff, batch_size=BATCH_SIZE, stop_event=None):
+    """
+    Удаляет агрегаты разрешения resolution с началом интервала раньше cutoff. Удаление идет по каждому
+    инструменту (паре) по первичному ключу (resolution, ключи, bucket_ts) пакетами по batch_size
+    """
+    rollup_table, keys, _ = ROLLUPS[table_name]
+    key_condition = ' AND '.join(f"{key} = ?" for key in keys)
+    key_rows = conn.execute(f"SELECT DISTINCT {', '.join(keys)} FROM {rollup_table} "
+                            f"WHERE resolution = ? AND bucket_ts < ?", (resolution, cutoff)).fetchall()
+    total = 0
+    for key_values in key_rows:
+        while True:
+            with conn:
+                deleted = conn.execute(
+                    f"DELETE FROM {rollup_table} WHERE resolution = ? AND {key_condition} AND bucket_ts IN "
+                    f"(SELECT bucket_ts FROM {rollup_table} WHERE resolution = ? AND {key_condition} AND bucket_ts < ? "
+                    f"ORDER BY bucket_ts LIMIT ?)",
+                    (resolution, *key_values, resolution, *key_values, cutoff, batch_size)).rowcount
+            total += deleted
+            if deleted < batch_size:
+                break
+            if pause(stop_event):
+                return total
+    return total
+
+
+def delete_archive(table_name, cutoff, archive_dir=ARCHIVE_DIR):
+    """Удаляет разделы архива, все строки которых старше cutoff. Возвращает кол-во разделов"""
+    keep = set(partitions(table_name, cutoff, archive_dir=archive_dir))
+    paths = [path for path in partitions(table_name, archive_dir=archive_dir) if path not in keep]
+    for path in paths:
+        shutil.rmtree(path)
+        logger.info(f"Удален раздел архива {path}")
+    return len(paths)
+
+
+def incremental_vacuum(conn, pages=VACUUM_PAGES, stop_event=None):
+    """
+    Возвращает свободные страницы файловой системе по pages за шаг, файл БД уменьшается.
+    Работает, если в БД включен auto_vacuum=INCREMENTAL. Возвращает кол-во освобожденных страниц
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        logger.warning("В БД не включен auto_vacuum=INCREMENTAL, файл не уменьшается. "
+                       "Выполните один раз: python retention.py --enable-incremental-vacuum")
+        return 0
+    total = 0
+    while True:
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if not free:
+            return total
+        conn.executescript(f"PRAGMA incremental_vacuum({min(free, pages)});")  # execute освобождает только часть страниц
+        released = free - conn.execute("PRAGMA freelist_count").fetchone()[0]
+        total += released
+        if released <= 0:  # Страницы заняты читателями или другой записью, продолжим в следующий раз
+            return total
+        if pause(stop_event):
+            return total
+
+
+def apply_retention(conn, retention, batch_size=BATCH_SIZE, archive_dir=ARCHIVE_DIR, stop_event=None):
+    """
+    Удаляет устаревшие сырые строки, разделы архива и агрегаты по политике retention
+    ({уровень из RETENTION_LEVELS: дней}, уровни без срока хранятся бессрочно) и возвращает место файловой системе.
+    Возвращает {уровень: удалено строк или разделов архива}
+    """
+    update_rollups(conn, stop_event=stop_event)  # Сырые строки удаляются только после агрегации
+    result = {}
+    if retention.get('raw') is not None:
+        cutoff = cutoff_ms(retention['raw'])
+        for table_name in ROLLUPS:
+            result[table_name] = delete_raw(conn, table_name, cutoff, batch_size, stop_event)
+    if retention.get('archive') is not None:  # Архив удаляется только по явно заданному сроку
+        cutoff = cutoff_ms(retention['archive'])
+        for table_name in ARCHIVE_COLUMNS:
+            result[f"{table_name}_archive"] = delete_archive(table_name, cutoff, archive_dir)
+    for resolution, days in retention.items():
+        if resolution in ('raw', 'archive') or days is None:
+            continue
+        for table_name in ROLLUPS:
+            result[f"{ROLLUPS[table_name][0]}_{resolution}"] = delete_rollup(
+                conn, table_name, resolution, cutoff_ms(days), batch_size, stop_event)
+    pages = incremental_vacuum(conn, stop_event=stop_event)
+    if any(result.values()) or pages:
+        logger.info(f"Очистка по сроку хранения: {result}, освобождено страниц: {pages}")
+    return result
+
+
+# Фоновая очистка для постоянных режимов сборщика
+def start_retention_thread(retention, db_path=DB_PATH, interval=RETENTION_INTERVAL, archive_dir=ARCHIVE_DIR, stop_event=None):
+    stop_event = stop_event or threading.Event()
+
+    def run():
+        conn = connect(db_path)  # Свое подключение для фонового потока
+        try:
+            while not stop_event.is_set():
+                try:
+                    apply_retention(conn, retention, archive_dir=archive_dir, stop_event=stop_event)
+                except Exception as e:
+                    logger.error(f"Ошибка при очистке по сроку хранения: {e}", exc_info=True)
+                stop_event.wait(interval)
+        finally:
+            conn.close()
+
+    thread = threading.Thread(target=run, name='Retention', daemon=True)
+    thread.start()
+    return thread
+
+
+# Включение auto_vacuum=INCREMENTAL в существующей БД: нужен полный VACUUM с блокировкой на все время
+def enable_incremental_vacuum(db_path):
+    conn = connect(db_path)
+    try:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        size = os.path.getsize(db_path)
+        conn.execute("VACUUM")
+        logger.info(f"auto_vacuum=INCREMENTAL включен, размер БД {size / 2 ** 20:.1f} -> "
+                    f"{os.path.getsize(db_path) / 2 ** 20:.1f} МБ")
+    finally:
+        conn.close()
+
+
+# Срок хранения по уровням из строки вида "raw=7,archive=7,1m=90": {уровень: дней}
+def parse_retention(value):
+    retention = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        level, _, days = item.partition('=')
+        level = level.strip()
+        if level not in RETENTION_LEVELS:
+            raise argparse.ArgumentTypeError(f"Неизвестный уровень {level!r}, допустимы: {', '.join(RETENTION_LEVELS)}")
+        try:
+            retention[level] = float(days)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Срок хранения {level} должен быть числом дней: {item!r}")
+        if retention[level] <= 0:
+            raise argparse.ArgumentTypeError(f"Срок хранения {level} должен быть больше 0: {item!r}")
+    return retention
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Удаление устаревших данных по сроку хранения и уменьшение файла БД')
+    parser.add_argument('db_path', nargs='?', default=DB_PATH, help=f'Путь к БД (по умолчанию {DB_PATH})')
+    parser.add_argument('--retention', type=parse_retention, default={}, metavar='LEVEL=DAYS,...',
+                        help=f"Сроки хранения в днях по уровням {', '.join(RETENTION_LEVELS)}, например {RETENTION_EXAMPLE}. "
+                             f"Уровни без срока не удаляются, по умолчанию ничего не удаляется")
+    parser.add_argument('--archive-dir', default=ARCHIVE_DIR, help=f'Каталог архива (по умолчанию {ARCHIVE_DIR})')
+    parser.add_argument('--loop', type=float, default=None, help='Очищать постоянно с заданным интервалом, с')
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help='Один раз включить auto_vacuum=INCREMENTAL в существующей БД (полный VACUUM)')
+    args = parser.parse_args()
+
+    setup_logging('logs.log', level=logging.INFO)  # Лог записываем в файл и выводим на консоль
+    init_db(args.db_path)
+    if args.enable_incremental_vacuum:
+        enable_incremental_vacuum(args.db_path)
+    if not args.retention:
+        logger.info("Сроки хранения не заданы (--retention), данные не удаляются")
+    conn = connect(args.db_path)
+    try:
+        while True:
+            apply_retention(conn, args.retention, archive_dir=args.archive_dir)
+            if args.loop is None:
+                break
+            time.sleep(args.loop)
+    finally:
+        conn.close()
@@ -0,0 +1,241 @@
+import argparse
+import logging
+import threading
+import time
+
+import pandas as pd
+
+from db import DB_PATH, connect, init_db, ms_to_datetime, msk_to_ms, now_ms
+from log_setup import setup_logging
+
+# Разрешения агрегатов: {имя: длина интервала в мс}, от мелкого к крупному
+RESOLUTIONS = {'1m': 60_000, '1h': 3_600_000, '1d': 86_400_000}
+RAW_INTERVAL = 5_000  # Примерный шаг сырых данных сборщика, мс
+MAX_CHART_POINTS = 2000  # Максимум точек на график, по нему выбирается разрешение
+POINTS_PER_BUCKET = 2  # Точек графика на интервал агрегата: минимум и максимум
+BATCH_SIZE = 50000  # Строк истории за один шаг агрегации
+ROLLUP_INTERVAL = 60  # Интервал обновления агрегатов в фоне, с
+MSK_OFFSET = 3 * 3_600_000  # Сдвиг МСК от UTC, мс. Дневные интервалы начинаются в полночь по МСК
+
+logger = logging.getLogger('rollup.py')
+
+# Описание агрегации: таблица истории -> (таблица агрегатов, ключи, {префикс: столбец значения})
+ROLLUPS = {
+    'spreads': ('spreads_rollup', ['future_id'],
+                {'buy': 'kerry_buy_spread_y', 'sell': 'kerry_sell_spread_y'}),
+    'future_spreads': ('future_spreads_rollup', ['near_id', 'far_id'],
+                       {'bid': 'spread_bid_y', 'offer': 'spread_offer_y'}),
+}
+
+STATS = ('open', 'high', 'low', 'close', 'sum')
+
+
+# SQL досчета агрегата: новые строки объединяются с уже накопленными по интервалу
+def upsert_sql(rollup_table, keys, prefixes):
+    value_columns = [f"{prefix}_{stat}" for prefix in prefixes for stat in STATS]
+    columns = ['resolution', *keys, 'bucket_ts', *value_columns, 'count', 'close_ts']
+    updates = []
+    for prefix in prefixes:
+        updates += [f"{prefix}_high = MAX({prefix}_high, excluded.{prefix}_high)",
+                    f"{prefix}_low = MIN({prefix}_low, excluded.{prefix}_low)",
+                    f"{prefix}_close = CASE WHEN excluded.close_ts >= close_ts "
+                    f"THEN excluded.{prefix}_close ELSE {prefix}_close END",
+                    f"{prefix}_sum = {prefix}_sum + excluded.{prefix}_sum"]
+    updates += ["count = count + excluded.count", "close_ts = MAX(close_ts, excluded.close_ts)"]
+    return f'''
+        INSERT INTO {rollup_table} ({', '.join(columns)})
+        VALUES ({', '.join('?' * len(columns))})
+        ON CONFLICT (resolution, {', '.join(keys)}, bucket_ts) DO UPDATE SET
+            {', '.join(updates)}
+    '''
+
+
+# Агрегация очередной порции истории одной таблицы
+def rollup_batch(conn, table_name, batch_size=BATCH_SIZE):
+    """Возвращает кол-во обработанных строк истории. 0 - агрегаты актуальны"""
+    rollup_table, keys, prefixes = ROLLUPS[table_name]
+    row = conn.execute("SELECT last_id FROM rollup_state WHERE table_name = ?", (table_name,)).fetchone()
+    last_id = row[0] if row else 0
+
+    df = pd.read_sql_query(
+        f"SELECT id, ts, {', '.join(keys)}, {', '.join(prefixes.values())} FROM {table_name} "
+        f"WHERE id > ? ORDER BY id LIMIT ?", conn, params=[last_id, batch_size])
+    if df.empty:
+        return 0
+    new_last_id = int(df['id'].iloc[-1])
+    df = df.dropna(subset=keys)  # Строки без ссылок на инструменты не агрегируются
+
+    sql = upsert_sql(rollup_table, keys, prefixes)
+    with conn:  # Порция агрегатов и отметка last_id пишутся одной транзакцией
+        # Агрегаты досчитывают несколько потоков и процессов (rollup, retention.py, archive.py):
+        # если порцию уже учел другой, она пропускается
+        conn.execute("BEGIN IMMEDIATE")
+        if conn.execute("SELECT last_id FROM rollup_state WHERE table_name = ?", (table_name,)).fetchone() != row:
+            return 0
+        for resolution, bucket_ms in RESOLUTIONS.items():
+            df['bucket_ts'] = (df['ts'] + MSK_OFFSET) // bucket_ms * bucket_ms - MSK_OFFSET
+            grouped = df.groupby([*keys, 'bucket_ts'], sort=False)  # Внутри группы строки идут по возрастанию id
+            aggregated = grouped.agg(**{f"{prefix}_{stat}": (column, func)
+                                        for prefix, column in prefixes.items()
+                                        for stat, func in zip(STATS, ('first', 'max', 'min', 'last', 'sum'))},
+                                     count=('ts', 'size'), close_ts=('ts', 'max')).reset_index()
+            aggregated.insert(0, 'resolution', resolution)
+            conn.executemany(sql, aggregated.itertuples(index=False, name=None))
+        conn.execute("INSERT OR REPLACE INTO rollup_state (table_name, last_id) VALUES (?, ?)",
+                     (table_name, new_last_id))
+    return new_last_id - last_id
+
+
+# Досчет агрегатов по всем таблицам до текущего конца истории
+def update_rollups(conn, batch_size=BATCH_SIZE, stop_event=None):
+    total = 0
+    for table_name in ROLLUPS:
+        while stop_event is None or not stop_event.is_set():
+            processed = rollup_batch(conn, table_name, batch_size)
+            if not processed:
+                break
+            total += processed
+    if total:
+        logger.info(f"Агрегаты обновлены, обработано строк истории: {total}")
+    return total
+
+
+# Фоновое обновление агрегатов для режимов демона и событий сборщика
+def start_rollup_thread(db_path=DB_PATH, interval=ROLLUP_INTERVAL, stop_event=None):
+    stop_event = stop_event or threading.Event()
+
+    def run():
+        conn = connect(db_path)  # Свое подключение для фонового потока
+        try:
+            while not stop_event.is_set():
+                try:
+                    update_rollups(conn, stop_event=stop_event)
+                except Exception as e:
+                    logger.error(f"Ошибка при обновлении агрегатов: {e}", exc_info=True)
+                stop_event.wait(interval)
+        finally:
+            conn.close()
+
+    thread = threading.Thread(target=run, name='Rollup', daemon=True)
+    thread.start()
+    return thread
+
+
+# Выбор разрешения для графика
+def choose_resolution(start_ms, end_ms, max_points=MAX_CHART_POINTS):
+    """
+    Возвращает самое мелкое разрешение, при котором на видимом периоде получается не больше max_points точек:
+    None - сырые данные, иначе ключ RESOLUTIONS. Чем длиннее период, тем крупнее разрешение
+    """
+    span = max(0, end_ms - start_ms)
+    if span / RAW_INTERVAL <= max_points:
+        return None
+    for resolution, bucket_ms in RESOLUTIONS.items():
+        if span / bucket_ms * POINTS_PER_BUCKET <= max_points:
+            return resolution
+    return list(RESOLUTIONS)[-1]
+
+
+# Границы видимого периода: заданные явно или вся история по дневным агрегатам
+def visible_range(conn, rollup_table, start=None, end=None):
+    """start, end - время по МСК или None. Пока агрегатов нет, период считается пустым, и график строится по сырым данным"""
+    start_ms = msk_to_ms(start) if start is not None else None
+    end_ms = msk_to_ms(end) if end is not None else None
+    if start_ms is None or end_ms is None:
+        first_ts, last_ts = conn.execute(
+            f"SELECT MIN(bucket_ts), MAX(close_ts) FROM {rollup_table} WHERE resolution = '1d'").fetchone()
+        if end_ms is None:
+            end_ms = last_ts if last_ts is not None else now_ms()
+        if start_ms is None:
+            start_ms = first_ts if first_ts is not None else end_ms
+    return start_ms, end_ms
+
+
+# Столбцы OHLC агрегата по интервалу
+def ohlc_columns(prefix):
+    return ', '.join(f"r.{prefix}_{name}" for name in ('open', 'high', 'low', 'close'))
+
+
+# Две точки графика на интервал: минимум и максимум, всплески керри внутри интервала не усредняются
+def bucket_extremes(df, columns):
+    """
+    df - агрегаты с bucket_ts, close_ts и OHLC, columns - {столбец графика: префикс OHLC}.
+    Первая точка - в начале интервала, вторая - во время последней строки интервала. Если за интервал значение
+    выросло (close >= open), первым считается минимум, иначе максимум, как при прореживании downsample.minmax
+    """
+    first, second = df.copy(), df.copy()
+    first['ts'], second['ts'] = df['bucket_ts'], df['close_ts']
+    for column, prefix in columns.items():
+        rising = df[f'{prefix}_close'] >= df[f'{prefix}_open']
+        first[column] = df[f'{prefix}_low'].where(rising, df[f'{prefix}_high'])
+        second[column] = df[f'{prefix}_high'].where(rising, df[f'{prefix}_low'])
+    result = pd.concat([first, second], ignore_index=True).sort_values('ts', kind='stable')
+    return result.drop(columns=[column for column in df.columns if column not in ('name_future', 'near_future', 'far_future')])
+
+
+# Загрузка агрегатов для графиков в формате сырых данных: минимум и максимум каждого интервала (bucket_extremes)
+def load_spreads_rollup(conn, resolution, expiration_list=None, futures=None, start_ms=None, end_ms=None):
+    query = f'''
+        SELECT r.bucket_ts, r.close_ts, i.name AS name_future, {ohlc_columns('buy')}, {ohlc_columns('sell')}
+        FROM spreads_rollup r JOIN instruments i ON i.id = r.future_id
+        WHERE r.resolution = ?
+    '''
+    params = [resolution]
+    query, params = add_rollup_filters(query, params, 'i', expiration_list, futures, start_ms, end_ms)
+    df = pd.read_sql_query(query + " ORDER BY r.bucket_ts", conn, params=params)
+    df = bucket_extremes(df, {'kerry_buy_spread_y': 'buy', 'kerry_sell_spread_y': 'sell'}).reset_index(drop=True)
+    df.insert(0, 'trade_time', ms_to_datetime(df.pop('ts')))
+    return df
+
+
+def load_future_spreads_rollup(conn, resolution, expiration_list=None, start_ms=None, end_ms=None):
+    query = f'''
+        SELECT r.bucket_ts, r.close_ts, n.name AS near_future, f.name AS far_future,
+               {ohlc_columns('bid')}, {ohlc_columns('offer')}
+        FROM future_spreads_rollup r
+        JOIN instruments n ON n.id = r.near_id
+        JOIN instruments f ON f.id = r.far_id
+        WHERE r.resolution = ?
+    '''
+    params = [resolution]
+    query, params = add_rollup_filters(query, params, 'f', expiration_list, None, start_ms, end_ms)
+    df = pd.read_sql_query(query + " ORDER BY r.bucket_ts", conn, params=params)
+    df = bucket_extremes(df, {'spread_bid_y': 'bid', 'spread_offer_y': 'offer'}).reset_index(drop=True)
+    df.insert(1, 'trade_time', ms_to_datetime(df.pop('ts')))
+    return df
+
+
+# Фильтры по экспирации и имени фьючерса (alias - таблица instruments в запросе) и по периоду
+def add_rollup_filters(query, params, alias, expiration_list, futures, start_ms, end_ms):
+    if expiration_list:
+        query += f" AND {alias}.expiration IN ({', '.join('?' * len(expiration_list))})"
+        params.extend(expiration_list)
+    if futures:
+        query += f" AND {alias}.name IN ({', '.join('?' * len(futures))})"
+        params.extend(futures)
+    if start_ms is not None:
+        query += " AND r.bucket_ts >= ?"
+        params.append(start_ms)
+    if end_ms is not None:
+        query += " AND r.bucket_ts <= ?"
+        params.append(end_ms)
+    return query, params
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Обновление агрегатов спредов по интервалам 1m/1h/1d')
+    parser.add_argument('db_path', nargs='?', default=DB_PATH, help=f'Путь к БД (по умолчанию {DB_PATH})')
+    parser.add_argument('--loop', type=float, default=None, help='Обновлять постоянно с заданным интервалом, с')
+    args = parser.parse_args()
+
+    setup_logging('logs.log', level=logging.INFO)  # Лог записываем в файл и выводим на консоль
+    init_db(args.db_path)  # Создает таблицы агрегатов в существующей БД
+    conn = connect(args.db_path)
+    try:
+        while True:
+            update_rollups(conn)
+            if args.loop is None:
+                break
+            time.sleep(args.loop)
+    finally:
+        conn.close()
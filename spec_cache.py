@@ -0,0 +1,107 @@
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+SPEC_CACHE_PATH = "data/specs_cache.json"
+SPEC_TTL = 24 * 60 * 60  # Время жизни спецификации в кэше, секунд
+
+logger = logging.getLogger('spec_cache.py')
+
+
+class SpecCache:
+    """
+    Постоянный кэш спецификаций инструментов QUIK.
+    Хранит код режима торгов, тикер, короткое имя, лот и дату экспирации,
+    которые почти не меняются, чтобы не запрашивать их у терминала на каждом проходе.
+    """
+
+    def __init__(self, path=SPEC_CACHE_PATH, ttl=SPEC_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.specs = {}  # {dataname: {..., 'loaded_at': время загрузки}}
+        self.dirty = False  # Есть несохраненные изменения
+        self.load()
+
+    def load(self):
+        """Загружает кэш из файла, если он есть"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, mode='r', encoding='utf-8') as f:
+                self.specs = json.load(f)
+            logger.info(f"Загружено {len(self.specs)} спецификаций из {self.path}")
+        except Exception as e:
+            logger.error(f"Не удалось прочитать кэш спецификаций {self.path}. Ошибка: {e}")
+            self.specs = {}
+
+    def save(self):
+        """Сохраняет кэш в файл, если были изменения"""
+        if not self.dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, mode='w', encoding='utf-8') as f:
+                json.dump(self.specs, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)  # Атомарная замена, чтобы не оставить битый файл
+            self.dirty = False
+        except Exception as e:
+            logger.error(f"Не удалось сохранить кэш спецификаций {self.path}. Ошибка: {e}")
+
+    def is_valid(self, spec):
+        """Спецификация не устарела по TTL и инструмент еще не экспирировался"""
+        if time.time() - spec.get('loaded_at', 0) > self.ttl:
+            return False
+        exp_date = spec.get('exp_date')
+        if exp_date and str(exp_date) != '0':
+            try:
+                if datetime.strptime(str(exp_date), "%Y%m%d").date() < datetime.now().date():
+                    return False
+            except ValueError:
+                return False
+        return True
+
+    def get(self, dataname):
+        """Возвращает спецификацию из кэша или None, если ее нет или она устарела"""
+        spec = self.specs.get(dataname)
+        if spec is None or not self.is_valid(spec):
+            return None
+        return spec
+
+    def put(self, dataname, spec):
+        self.specs[dataname] = dict(spec, loaded_at=time.time())
+        self.dirty = True
+
+    def invalidate(self, dataname=None):
+        """Сбрасывает спецификацию одного инструмента или весь кэш"""
+        if dataname is None:
+            self.specs.clear()
+        else:
+            self.specs.pop(dataname, None)
+        self.dirty = True
+
+    def get_or_load(self, provider, dataname):
+        """Возвращает спецификацию из кэша, при отсутствии запрашивает ее у QUIK"""
+        spec = self.get(dataname)
+        if spec is not None:
+            return spec
+
+        class_code, sec_code = provider.dataname_to_class_sec_codes(dataname)  # Код режима торгов и тикер
+        si = provider.get_symbol_info(class_code, sec_code)  # Спецификация тикера
+        logger.debug(f'Ответ от сервера: {si}')
+        if not si:
+            raise ValueError(f"Нет спецификации для {dataname}")
+        spec = {
+            'class_code': class_code,
+            'sec_code': sec_code,
+            'short_name': si['short_name'],
+            'lot_size': si['lot_size'],
+            'exp_date': si['exp_date'],
+            'face_unit': si.get('face_unit'),
+        }
+        logger.info(f'Информация о тикере {class_code}.{sec_code} ({spec["short_name"]}, {spec["exp_date"]}), '
+                    f'валюта: {spec["face_unit"]}, лот: {spec["lot_size"]}')
+        self.put(dataname, spec)
+        return self.specs[dataname]
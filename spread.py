@@ -1,71 +1,58 @@
+import argparse
+import asyncio
 import logging
+import math
 import os
 import csv
+import functools
+import queue
+import signal
 import sqlite3
+import threading
+import time
 from datetime import datetime  # Дата и время
+import numpy as np
 from QuikPy import QuikPy  # Работа с QUIK из Python через LUA скрипты QUIK#
+from spec_cache import SpecCache
+from db import DB_PATH, init_db, datetime_to_ms, register_instruments
+from db_writer import BatchWriter
+from log_setup import parse_levels, setup_logging
+from rollup import start_rollup_thread
+from retention import RETENTION_EXAMPLE, RETENTION_LEVELS, parse_retention, start_retention_thread
+from stream import StreamPublisher
+from quote_pool import QuotePool, fetch_quote, subscribe_quotes, unsubscribe_quotes
+from async_provider import AsyncProvider, SyncProvider, put_latest
+from metrics import METRICS_PORT, TimedProxy, inc, observe, set_gauge, start_metrics_server, timed
+from quik_sim import SEED, TICK_RATE, LATENCY, SimMarket, QuikSim, QuoteRecorder
+from incremental import IncrementalSpreads
+from change_filter import EPSILON, HEARTBEAT, ChangeFilter
+from order_book import SIZES, DepthCarry
+from ranking import TOP_K, Ranking
+from carry import calc_exp_days, calc_kerry_batch, calendar_pair_indices, calc_calendar_spreads_batch
 
 FILE_PATH = "data/stocks_futures.csv"
-DB_PATH = "data/futures_spreads.db"
 
-DAYS_YEAR = 365 # дней в году
+SIM_SPEC_CACHE_PATH = "data/sim_specs_cache.json"  # Кэш спецификаций модели QUIK отдельно от настоящего
 
-# функция для создания бд
-def init_db(db_path):
-    with sqlite3.connect(db_path) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS spreads (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            trade_time TEXT,
-            name_share TEXT,
-            bid_share REAL,
-            offer_share REAL,
-            name_future TEXT,
-            bid_future REAL,
-            offer_future REAL,
-            lot_size_future REAL,
-            exp_days INTEGER,
-            kerry_buy_spread_y REAL,
-            kerry_sell_spread_y REAL
-        )
-        ''')
-
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS future_spreads (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            trade_time TEXT,
-            near_future TEXT,
-            far_future TEXT,
-            spread_bid REAL,
-            spread_offer REAL,
-            spread_bid_y REAL,
-            spread_offer_y REAL,
-            far_exp_days INTEGER
-        )
-        ''')
-        conn.commit()
+INTERVAL = 5  # Интервал пересчета спредов в режиме демона, с
+TOP_PATH = '/top.json'  # Адрес текущего топа на сервере метрик
+QUIK_METHODS = ('dataname_to_class_sec_codes', 'get_symbol_info', 'get_param_ex', 'get_quote_level2',
+                'subscribe_level2_quotes', 'unsubscribe_level2_quotes')  # Запросы к QUIK, время которых замеряется
+ASYNC_QUEUE_SIZE = 10  # Пересчитанных снимков в очереди записи/рассылки асинхронного режима
 
+stop_event = threading.Event()  # Флаг остановки режима демона
+stream_publisher = None  # Рассылка строк в поток для app.py (--stream)
+quote_pool = None  # Параллельный запрос котировок через несколько подключений (--connections)
+quote_recorder = None  # Запись полученных котировок для воспроизведения в quik_sim.py (--record)
+change_filter = None  # Пропуск записи неизменившихся строк (--epsilon, --heartbeat)
+ranking = Ranking()  # Текущий топ спредов по доходностям среди всех пересчитанных строк
 
-# Функция для сохранения данных в БД
-def save_to_db(cursor, table_name, data):
-    if table_name == 'spreads':
-        cursor.execute('''
-        INSERT INTO spreads (
-            trade_time, name_share, bid_share, offer_share,
-            name_future, bid_future, offer_future,
-            lot_size_future, exp_days, kerry_buy_spread_y, kerry_sell_spread_y
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', data)
-    elif table_name == 'future_spreads':
-        cursor.execute('''
-        INSERT INTO future_spreads (
-            trade_time, near_future, far_future, spread_bid, 
-            spread_offer, spread_bid_y, spread_offer_y, far_exp_days
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', data)
-    else:
-        raise ValueError(f"Неизвестная таблица: {table_name}")
+# Топ для сервера метрик: /top.json?k=5 - все таблицы и доходности, /top.json?table=spreads&column=kerry_sell_spread_y - один топ
+def top_route(params):
+    k = int(params.get('k', TOP_K))
+    if 'table' in params:
+        return ranking.top(params['table'], params['column'], k)
+    return ranking.snapshot(k)
 
 
 # Функция получения Топ-5 по доходности продажи спреда
@@ -73,16 +60,11 @@ def get_top_by_kerry_sell(db_path):
     with sqlite3.connect(db_path) as conn:
         cursor = conn.cursor()
 
-        # Получаем самые свежие записи для каждой акции
+        # Последние значения по каждому фьючерсу берем из таблицы последних значений
         cursor.execute(
             '''
-                SELECT trade_time, name_share, name_future, kerry_buy_spread_y, kerry_sell_spread_y 
-                FROM spreads
-                WHERE (name_share, trade_time) IN (
-                    SELECT name_share, MAX(trade_time)
-                    FROM spreads
-                    GROUP BY name_share
-                )
+                SELECT ts, name_share, name_future, kerry_buy_spread_y, kerry_sell_spread_y
+                FROM spreads_latest
                 ORDER BY kerry_sell_spread_y DESC
                 LIMIT 5;
             '''
@@ -139,42 +121,471 @@ def read_stock_futures_csv(file_path, has_header=True):
         return None
 
 
+# Получение лучших цен спроса и предложения по тикеру
+def get_quote(class_code, sec_code):
+    return fetch_quote(qp_provider, class_code, sec_code)
+
+
+# Пакетное получение котировок по всему списку инструментов за один проход
+def get_quotes(datanames):
+    """
+    Возвращает словарь {dataname: (bid, offer)}.
+    Каждый инструмент запрашивается один раз, даже если встречается в списке несколько раз.
+    Спецификации берутся из кэша, последняя цена сделки не запрашивается, т.к. в расчете не участвует.
+    При заданном quote_pool котировки запрашиваются параллельно через несколько подключений
+    """
+    specs = load_specs(datanames)
+    if quote_pool is not None:
+        quotes = quote_pool.get_quotes(specs)
+    else:
+        quotes = {}
+        for dataname, spec in specs.items():
+            try:
+                quotes[dataname] = get_quote(spec['class_code'], spec['sec_code'])
+            except Exception as e:
+                logging.error(f"Не удалось получить котировки по {dataname}. Ошибка: {e}")
+    logger.info("Получены котировки по %d инструментам", len(quotes))
+    if quote_recorder is not None:
+        quote_recorder.write(specs, quotes)
+    return quotes
+
+
+# Спецификации уникальных инструментов списка {dataname: спецификация} из кэша или QUIK
+def load_specs(datanames):
+    specs = {}
+    for dataname in dict.fromkeys(datanames):  # Уникальные с сохранением порядка
+        try:
+            specs[dataname] = spec_cache.get_or_load(qp_provider, dataname)
+        except Exception as e:
+            logging.error(f"Не удалось получить спецификацию {dataname}. Ошибка: {e}")
+    spec_cache.save()
+    return specs
+
+
 # Получение данных по инструменту
-def get_info(dataname):
+def get_info(dataname, quotes=None):
+    """
+    Возвращает (short_name, lot_size, exp_date, bid, offer).
+    quotes - котировки, заранее полученные get_quotes. Если инструмента в них нет, котировки запрашиваются отдельно
+    """
     try:
-        class_code, sec_code = qp_provider.dataname_to_class_sec_codes(dataname)  # Код режима торгов и тикер
-        si = qp_provider.get_symbol_info(class_code, sec_code)  # Спецификация тикера
-        logger.debug(f'Ответ от сервера: {si}')
-        logger.info(
-            f'Информация о тикере {si["class_code"]}.{si["sec_code"]} ({si["short_name"]}, {si["exp_date"]}):')  # Короткое наименование инструмента
-        logger.info(f'- Валюта: {si["face_unit"]}')
-        lot_size = si['lot_size']  # Лот
-        logger.info(f'- Лот: {lot_size}')
-        last_price = float(
-            qp_provider.get_param_ex(class_code, sec_code, 'LAST')['data']['param_value'])  # Последняя цена сделки
-        logger.info(f'- Последняя цена сделки: {last_price}')
-
-        bid = float(qp_provider.get_param_ex(class_code, sec_code, "bid")['data']['param_value'])
-        offer = float(qp_provider.get_param_ex(class_code, sec_code, "offer")['data']['param_value'])
-        logger.info(f'- Лучшая цена спроса: {bid}')
-        logger.info(f'- Лучшая цена предложения: {offer}')
-        # logger.info(f'- Спред: {offer - bid}')
-        return si["short_name"], lot_size, si["exp_date"], bid, offer
+        spec = spec_cache.get_or_load(qp_provider, dataname)
+        if quotes is not None and dataname in quotes:
+            bid, offer = quotes[dataname]
+        else:
+            bid, offer = get_quote(spec['class_code'], spec['sec_code'])
+        logger.debug('%s: лучшая цена спроса %s, лучшая цена предложения %s', spec['short_name'], bid, offer)
+        return spec["short_name"], spec['lot_size'], spec["exp_date"], bid, offer
 
     except Exception as e:
         logging.error(f"Не удалось получить информацию по {dataname}. Ошибка: {e}")
         return None
 
 
+# Запись инструментов из файла настроек в справочник БД
+def register_watchlist(db_path, list_datanames):
+    instruments = []
+    for datanames in list_datanames:
+        for share, futures in datanames.items():
+            try:
+                share_spec = spec_cache.get_or_load(qp_provider, share)
+            except Exception as e:
+                logging.error(f"Не удалось получить спецификацию {share}. Ошибка: {e}")
+                continue
+            for dataname in [share, *futures]:
+                try:
+                    spec = spec_cache.get_or_load(qp_provider, dataname)
+                except Exception as e:
+                    logging.error(f"Не удалось получить спецификацию {dataname}. Ошибка: {e}")
+                    continue
+                instruments.append({
+                    'name': spec['short_name'],
+                    'kind': 'share' if dataname == share else 'future',
+                    'underlying': share_spec['short_name'],
+                    'exp_date': int(spec['exp_date']) if spec['exp_date'] else None,
+                    'lot_size': spec['lot_size'],
+                    'class_code': spec['class_code'],
+                    'sec_code': spec['sec_code'],
+                })
+    spec_cache.save()
+
+    with sqlite3.connect(db_path) as conn:
+        register_instruments(conn.cursor(), instruments)
+        conn.commit()
+    logger.info(f"В справочник инструментов записано {len(instruments)} инструментов")
+
+
+# Один проход расчета спредов по всему списку инструментов
+def run_cycle(writer, list_datanames):
+    # Котировки по всему списку инструментов запрашиваем одним проходом
+    all_datanames = [name for datanames in list_datanames for share, futures in datanames.items() for name in [share, *futures]]
+    with timed('spread_stage_seconds', stage='quotes'):
+        quotes = get_quotes(all_datanames)
+    now = datetime.now()  # Единое время снимка для всех строк прохода
+    with timed('spread_stage_seconds', stage='compute'):
+        rows = calc_rows(build_legs(list_datanames, quotes, now), datetime_to_ms(now))
+    with timed('spread_stage_seconds', stage='save'):
+        save_rows(writer, *rows)
+
+
+# Сборка по одной записи на каждый фьючерс вместе с данными его акции по снимку котировок
+def build_legs(list_datanames, quotes, now):
+    legs = []
+    for share_id, datanames in enumerate(list_datanames):
+        for share, futures in datanames.items():
+            # получение данных для акции
+            info_share = get_info(share, quotes)
+            if not info_share:
+                break
+            name_share, _, _, bid_share, offer_share = info_share
+
+            for future in futures:
+                # получение данных для фчс
+                info_future = get_info(future, quotes)
+                if not info_future:
+                    break
+                name_future, lot_size_future, exp_date, bid_future, offer_future = info_future
+                exp_days = calc_exp_days(exp_date, now)
+                legs.append((share_id, name_share, bid_share, offer_share,
+                             name_future, bid_future, offer_future, lot_size_future, exp_days))
+    return legs
+
+
+# Расчет строк spreads и future_spreads за один пакетный проход по массивам
+def calc_rows(legs, ts):
+    """
+    legs - список (share_id, name_share, bid_share, offer_share, name_future, bid_future, offer_future, lot_size_future, exp_days).
+    Возвращает (строки spreads, строки future_spreads) для save_to_db.
+    Фьючерсы в день экспирации и истекшие (еще в кэше спецификаций) пропускаются вместе с их календарными парами,
+    как в IncrementalSpreads режима событий
+    """
+    legs = [leg for leg in legs if leg[8] > 0]
+    if not legs:
+        return [], []
+    columns = list(zip(*legs))
+    share_ids = np.array(columns[0])
+    bid_share, offer_share, bid_future, offer_future, lot_size_future, exp_days = (
+        np.array(columns[i], dtype=float) for i in (2, 3, 5, 6, 7, 8))
+
+    with np.errstate(divide='ignore', invalid='ignore'):  # Нулевые цены дают inf/nan, такие строки отбрасываем ниже
+        kerry_buy_spread_y, kerry_sell_spread_y = calc_kerry_batch(bid_share, offer_share, bid_future, offer_future,
+                                                                   lot_size_future, exp_days)
+        near_idx, far_idx = calendar_pair_indices(share_ids, exp_days)
+        spread_bid, spread_offer, spread_bid_y, spread_offer_y = calc_calendar_spreads_batch(
+            bid_future, offer_future, bid_share * lot_size_future, offer_share * lot_size_future, exp_days, near_idx, far_idx)
+
+    spread_rows = []
+    log_legs = logger.isEnabledFor(logging.DEBUG)  # Проверка один раз, а не на каждую ногу
+    for leg, buy, sell in zip(legs, kerry_buy_spread_y.tolist(), kerry_sell_spread_y.tolist()):
+        if not (math.isfinite(buy) and math.isfinite(sell)):
+            logger.warning("Пропуск %s/%s: некорректные котировки", leg[1], leg[4])
+            continue
+        if log_legs:  # Аргументы форматируются в потоке записи лога
+            logger.debug("%s/%s: дней до экспирации %s, керри продажи спреда %.2f, керри покупки спреда %.2f %% годовых",
+                         leg[1], leg[4], leg[8], buy, sell)
+        spread_rows.append((ts, *leg[1:], round(buy, 2), round(sell, 2)))
+
+    future_spread_rows = []
+    for near, far, bid, offer, bid_y, offer_y in zip(near_idx.tolist(), far_idx.tolist(), spread_bid.tolist(),
+                                                   spread_offer.tolist(), spread_bid_y.tolist(), spread_offer_y.tolist()):
+        if not (math.isfinite(bid_y) and math.isfinite(offer_y)):
+            continue
+        future_spread_rows.append((ts, legs[near][4], legs[far][4], bid, offer,
+                                   round(bid_y, 2), round(offer_y, 2), legs[far][8]))
+    return spread_rows, future_spread_rows
+
+
+# Режим демона: пересчет спредов с фиксированным интервалом на одном подключении к QUIK и БД
+def run_daemon(writer, list_datanames, interval):
+    """
+    Запускает run_cycle каждые interval секунд по сетке от момента старта.
+    Если проход занял больше интервала, пропущенные такты не навёрстываются,
+    а следующий проход начинается по ближайшему такту сетки.
+    """
+    next_run = time.monotonic()
+    while not stop_event.is_set():
+        cycle_start = time.monotonic()
+        set_gauge('spread_cycle_lag_seconds', max(cycle_start - next_run, 0.0))  # Опоздание прохода относительно сетки
+        try:
+            run_cycle(writer, list_datanames)
+            writer.flush()
+        except Exception as e:
+            logger.error(f"Ошибка при расчете спредов: {e}", exc_info=True)
+        elapsed = time.monotonic() - cycle_start
+        observe('spread_cycle_seconds', elapsed)
+        logger.info("Проход выполнен за %.3f с", elapsed)
+
+        next_run += interval
+        now = time.monotonic()
+        if now > next_run:  # Проход не уложился в интервал
+            skipped = int((now - next_run) // interval) + 1
+            inc('spread_skipped_cycles_total', skipped)
+            logger.warning(f"Проход длился {elapsed:.3f} с при интервале {interval} с. Пропущено тактов: {skipped}")
+            next_run += skipped * interval
+        stop_event.wait(next_run - time.monotonic())  # Ожидание следующего такта с возможностью досрочной остановки
+
+
+# Подписка на событие QuikPy. Поддерживаются как события с subscribe, так и простые атрибуты-обработчики
+def subscribe_callback(provider, name, handler):
+    event = getattr(provider, name)
+    if hasattr(event, 'subscribe'):
+        event.subscribe(handler)
+    else:
+        setattr(provider, name, handler)
+
+
+# Режим событий: пересчет только тех строк, которые зависят от изменившегося стакана
+def run_events(writer, list_datanames, sizes=SIZES):
+    """
+    Подписывается на изменения стаканов по всем инструментам и держит последние bid/offer в памяти.
+    Тики из потока обратного вызова QuikPy передаются через очередь, накопившиеся тики обрабатываются пачкой:
+    каждая затронутая строка пересчитывается один раз.
+    Если заданы объемы sizes, стаканы целиком хранятся в DepthCarry и по затронутым строкам считаются
+    керри и календарные спреды по средневзвешенным ценам этих объемов (таблицы spreads_depth, future_spreads_depth).
+    """
+    all_datanames = [name for datanames in list_datanames for share, futures in datanames.items() for name in [share, *futures]]
+    specs = load_specs(all_datanames)
+
+    engine = IncrementalSpreads(list_datanames, specs)
+    depth = DepthCarry(list_datanames, specs, sizes) if sizes else None
+    datanames_by_codes = {(spec['class_code'], spec['sec_code']): dataname for dataname, spec in specs.items()}
+    ticks = queue.Queue()
+
+    def on_quote(data):  # Выполняется в потоке обратного вызова QuikPy
+        quote = data['data']
+        dataname = datanames_by_codes.get((quote.get('class_code'), quote.get('sec_code')))
+        bids, offers = quote.get('bid'), quote.get('offer')
+        if dataname is None or not bids or not offers:
+            return
+        bid, offer = float(bids[-1]['price']), float(offers[0]['price'])  # Лучший спрос в конце списка, лучшее предложение в начале
+        ticks.put((dataname, bid, offer, time.monotonic(), quote))
+        if quote_recorder is not None:
+            quote_recorder.write_tick(quote['class_code'], quote['sec_code'], bid, offer)
+
+    subscribe_callback(qp_provider, 'on_quote', on_quote)  # Стаканы всего списка заказаны в __main__
+
+    # Начальный снимок по всем инструментам
+    for dataname, (bid, offer) in get_quotes(list(specs)).items():
+        engine.update_quote(dataname, bid, offer)
+    save_rows(writer, *engine.recompute_all())
+    if depth is not None:
+        for dataname, spec in specs.items():
+            depth.update(dataname, qp_provider.get_quote_level2(spec['class_code'], spec['sec_code'])['data'])
+        write_depth_rows(writer, *depth.compute(*depth.all()))
+
+    while not stop_event.is_set():
+        try:
+            tick = ticks.get(timeout=1)
+        except queue.Empty:
+            continue
+        batch_start = time.monotonic()
+        received = tick[3]  # Время получения первого тика пачки
+        carry_pairs, calendar_pairs = {}, {}  # Словари как упорядоченные множества
+        depth_changed = {}  # Инструменты, стакан которых изменился
+        while tick is not None:
+            dataname, bid, offer, _, quote = tick
+            if depth is not None and depth.update(dataname, quote):
+                depth_changed[dataname] = None
+            if engine.update_quote(dataname, bid, offer):
+                affected_carry, affected_calendar = engine.affected(dataname)
+                carry_pairs.update(dict.fromkeys(affected_carry))
+                calendar_pairs.update(dict.fromkeys(affected_calendar))
+            try:
+                tick = ticks.get_nowait()
+            except queue.Empty:
+                tick = None
+        if carry_pairs or calendar_pairs:
+            with timed('spread_stage_seconds', stage='compute'):
+                rows = engine.recompute(carry_pairs, calendar_pairs)
+            with timed('spread_stage_seconds', stage='save'):
+                save_rows(writer, *rows, removed=engine.missing(carry_pairs, calendar_pairs, rows))
+        if depth_changed:
+            with timed('spread_stage_seconds', stage='depth'):
+                rows = depth.compute(*depth.affected(depth_changed))
+            write_depth_rows(writer, *rows)
+        now = time.monotonic()
+        observe('spread_cycle_seconds', now - batch_start)
+        set_gauge('spread_cycle_lag_seconds', now - received)  # От получения тика до передачи строк на запись
+        set_gauge('spread_tick_backlog', ticks.qsize())
+
+
+# Подключение к QUIK с замером времени запросов по их типам
+def timed_provider_class(provider_class):
+    def connect(**kwargs):
+        return TimedProxy(provider_class(**kwargs), 'quik_request_seconds', QUIK_METHODS)
+    return connect
+
+
+# Асинхронный режим: получение котировок, расчет, запись в БД и рассылка - отдельные стадии с ограниченными очередями
+def run_async(writer, list_datanames, interval):
+    """
+    Котировки запрашиваются с фиксированным интервалом через AsyncProvider (все запросы прохода ставятся сразу),
+    расчет, запись и рассылка идут параллельно со следующим запросом. Медленная запись в БД не задерживает
+    получение котировок, а если не успевает расчет, устаревший снимок заменяется новым
+    """
+    asyncio.run(async_pipeline(writer, list_datanames, interval))
+
+
+async def async_pipeline(writer, list_datanames, interval):
+    global qp_provider
+    loop = asyncio.get_running_loop()
+    providers = quote_pool.providers if quote_pool is not None else [qp_provider]
+    async_provider = AsyncProvider(providers, own_from=len(providers))  # Подключения закрываются в __main__
+    main_provider = qp_provider
+    qp_provider = SyncProvider(async_provider, loop)  # get_info и кэш спецификаций работают через асинхронный интерфейс
+
+    all_datanames = [name for datanames in list_datanames for share, futures in datanames.items() for name in [share, *futures]]
+    snapshots = asyncio.Queue(maxsize=1)  # Последний снимок котировок
+    sinks = [write_rows]
+    if stream_publisher is not None:
+        sinks.append(publish_rows)
+    outputs = [asyncio.Queue(maxsize=ASYNC_QUEUE_SIZE) for _ in sinks]
+
+    async def fetch():
+        next_run = loop.time()
+        while not stop_event.is_set():
+            start = loop.time()
+            set_gauge('spread_cycle_lag_seconds', max(start - next_run, 0.0))
+            try:
+                specs = await loop.run_in_executor(None, load_specs, all_datanames)
+                quotes = await async_provider.get_quotes(specs)
+                observe('spread_stage_seconds', loop.time() - start, stage='quotes')
+                if quote_recorder is not None:
+                    quote_recorder.write(specs, quotes)
+                if put_latest(snapshots, (datetime.now(), quotes)):
+                    logger.warning("Расчет не успевает за получением котировок, снимок пропущен")
+                logger.info("Получены котировки по %d инструментам за %.3f с", len(quotes), loop.time() - start)
+            except Exception as e:
+                logger.error(f"Ошибка при получении котировок: {e}", exc_info=True)
+            next_run += interval
+            if loop.time() > next_run:  # Не уложились в интервал, пропущенные такты не навёрстываем
+                next_run += (int((loop.time() - next_run) // interval) + 1) * interval
+            while not stop_event.is_set() and loop.time() < next_run:  # Ожидание с проверкой флага остановки
+                await asyncio.sleep(min(0.2, next_run - loop.time()))
+        await snapshots.put(None)
+
+    async def compute():
+        while True:
+            snapshot = await snapshots.get()
+            if snapshot is None:
+                break
+            now, quotes = snapshot
+            start = loop.time()
+            try:
+                rows = await loop.run_in_executor(
+                    None, lambda: calc_rows(build_legs(list_datanames, quotes, now), datetime_to_ms(now)))
+                observe('spread_stage_seconds', loop.time() - start, stage='compute')
+            except Exception as e:
+                logger.error(f"Ошибка при расчете спредов: {e}", exc_info=True)
+                continue
+            for output in outputs:
+                await output.put(rows)  # Очереди ограничены: при медленной стадии расчет ждет ее
+        for output in outputs:
+            await output.put(None)
+
+    async def sink(output, func):
+        while True:
+            rows = await output.get()
+            if rows is None:
+                break
+            start = loop.time()
+            try:
+                await loop.run_in_executor(None, func, writer, *rows)
+                observe('spread_stage_seconds', loop.time() - start, stage=func.__name__)
+            except Exception as e:
+                logger.error(f"Ошибка в стадии {func.__name__}: {e}", exc_info=True)
+
+    try:
+        await asyncio.gather(fetch(), compute(), *(sink(output, func) for output, func in zip(outputs, sinks)))
+    finally:
+        qp_provider = main_provider
+        async_provider.close()
+
+
+# Передача пересчитанных строк на запись в БД и в поток
+def save_rows(writer, spread_rows, future_spread_rows, removed=None):
+    write_rows(writer, spread_rows, future_spread_rows, removed)
+    publish_rows(writer, spread_rows, future_spread_rows)
+
+
+def write_rows(writer, spread_rows, future_spread_rows, removed=None):
+    """removed - {таблица: ключи} пар, выпавших из пересчета в режиме событий, None - строки полного прохода"""
+    for table_name, rows in (('spreads', spread_rows), ('future_spreads', future_spread_rows)):
+        # Топ по всем строкам, до фильтра изменений. Строки, которых больше нет, убираются из топа
+        ranking.update(table_name, rows, None if removed is None else removed[table_name])
+        if change_filter is not None:  # В БД только изменившиеся строки и строки по истечении heartbeat
+            changed = change_filter.filter(table_name, rows)
+            inc('spread_rows_unchanged_total', len(rows) - len(changed), table=table_name)
+            rows = changed
+        writer.write(table_name, rows)
+
+
+# Керри по средневзвешенным ценам объемов: только последние значения, без фильтра изменений и рассылки
+def write_depth_rows(writer, spread_rows, future_spread_rows):
+    writer.write('spreads_depth', spread_rows)
+    writer.write('future_spreads_depth', future_spread_rows)
+
+
+def publish_rows(writer, spread_rows, future_spread_rows):
+    if stream_publisher is not None:  # Те же строки сразу уходят подписчикам, не дожидаясь записи в БД
+        stream_publisher.publish('spreads', spread_rows)
+        stream_publisher.publish('future_spreads', future_spread_rows)
+
+
+# Обработчик сигналов остановки
+def stop(signum, frame):
+    logger.info(f"Получен сигнал {signum}. Завершение работы")
+    stop_event.set()
+
+
 if __name__ == '__main__':  # Точка входа при запуске этого скрипта
+    parser = argparse.ArgumentParser(description='Сбор спредов между акциями и фьючерсами')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--daemon', action='store_true', help='Работать постоянно, пересчитывая спреды с заданным интервалом')
+    mode.add_argument('--events', action='store_true', help='Работать постоянно, пересчитывая спреды по изменениям стаканов')
+    mode.add_argument('--async', dest='async_mode', action='store_true',
+                      help='Работать постоянно: получение котировок, расчет и запись выполняются параллельно')
+    parser.add_argument('--interval', type=float, default=INTERVAL, help=f'Интервал пересчета в режиме демона и асинхронном, с (по умолчанию {INTERVAL})')
+    parser.add_argument('--stream', action='store_true', help='Рассылать пересчитанные спреды в поток для app.py')
+    parser.add_argument('--connections', type=int, default=1,
+                        help='Подключений к QUIK для параллельного запроса котировок (нужно столько же скриптов QUIK#)')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help=f'Порт метрик для постоянных режимов (по умолчанию {METRICS_PORT}, 0 - не запускать)')
+    parser.add_argument('--watchlist', default=FILE_PATH, help=f'Файл настроек с акциями и фьючерсами (по умолчанию {FILE_PATH})')
+    parser.add_argument('--simulate', metavar='RECORDING', nargs='?', const='',
+                        help='Работать с моделью QUIK из quik_sim.py: синтетические котировки или запись из файла')
+    parser.add_argument('--sim-rate', type=float, default=TICK_RATE, help=f'Изменений стаканов в секунду в модели (по умолчанию {TICK_RATE})')
+    parser.add_argument('--sim-latency', type=float, default=LATENCY, help='Задержка ответа модели на запрос, с')
+    parser.add_argument('--seed', type=int, default=SEED, help='Зерно генератора модели')
+    parser.add_argument('--record', metavar='PATH', help='Записывать полученные котировки в CSV для воспроизведения в модели')
+    parser.add_argument('--epsilon', type=float, default=EPSILON,
+                        help=f'Относительное изменение цены, с которого строка записывается в БД (по умолчанию {EPSILON} - любое)')
+    parser.add_argument('--heartbeat', type=float, default=HEARTBEAT,
+                        help=f'Запись неизменившейся строки не реже чем раз в столько секунд (по умолчанию {HEARTBEAT}, 0 - записывать все)')
+    parser.add_argument('--sizes', type=int, nargs='*', default=list(SIZES),
+                        help=f"Объемы в лотах фьючерса для керри по стаканам в режиме событий (по умолчанию {' '.join(map(str, SIZES))}, без значений - не считать)")
+    parser.add_argument('--retention', type=parse_retention, default={}, metavar='LEVEL=DAYS,...',
+                        help=f"Удалять в фоне данные старше срока в днях по уровням {', '.join(RETENTION_LEVELS)}, "
+                             f"например {RETENTION_EXAMPLE} (по умолчанию ничего не удаляется)")
+    parser.add_argument('--log-json', action='store_true', help='Писать лог строками JSON (также переменная LOG_JSON=1)')
+    parser.add_argument('--log-levels', type=parse_levels, default={}, metavar='NAME=LEVEL,...',
+                        help='Уровни лога по компонентам, например spread.py=INFO,db_writer.py=DEBUG (также переменная LOG_LEVELS)')
+    args = parser.parse_args()
+
     logger = logging.getLogger('spread.py')  # Будем вести лог
-    qp_provider = QuikPy()  # Подключение к локальному запущенному терминалу QUIK
 
-    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',  # Формат сообщения
-                        datefmt='%d.%m.%Y %H:%M:%S',  # Формат даты
-                        level=logging.DEBUG,  # Уровень логируемых событий NOTSET/DEBUG/INFO/WARNING/ERROR/CRITICAL
-                        handlers=[logging.FileHandler('logs.log', encoding='utf-8'), logging.StreamHandler()])  # Лог записываем в файл и выводим на консоль
-    logging.Formatter.converter = lambda *args: datetime.now(tz=qp_provider.tz_msk).timetuple()  # В логе время указываем по МСК
+    setup_logging('logs.log', json_lines=args.log_json or None, levels=args.log_levels)  # Лог записываем в файл и выводим на консоль, время по МСК
+
+    if args.simulate is not None:  # Модель QUIK для проверки и нагрузочных тестов без терминала
+        sim_market = SimMarket(seed=args.seed, tick_rate=args.sim_rate, recording=args.simulate or None, latency=args.sim_latency)
+        provider_class = functools.partial(QuikSim, sim_market)
+        spec_cache = SpecCache(SIM_SPEC_CACHE_PATH)
+    else:
+        sim_market = None
+        provider_class = QuikPy
+        spec_cache = SpecCache()  # Кэш спецификаций инструментов
+    provider_class = timed_provider_class(provider_class)
+    qp_provider = provider_class()  # Подключение к локальному запущенному терминалу QUIK
 
     # Проверяем, существует ли файл базы данных. Если нет, то создаем
     # if not os.path.exists(DB_PATH):
@@ -183,112 +594,56 @@ if __name__ == '__main__':  # Точка входа при запуске это
         logger.info(f'База данных создана в {DB_PATH}')
     except Exception as e:
         logger.error(f'Не удалось создать базу данных в {DB_PATH}. Ошибка: {e}')
+        qp_provider.close_connection_and_thread()
+        raise SystemExit(1)
 
     # Формат короткого имени для фьючерсов: <Код тикера><Месяц экспирации: 3-H, 6-M, 9-U, 12-Z><Последняя цифра года>. Пример: SiU4, RIU4
-    list_datanames = read_stock_futures_csv(FILE_PATH)
-
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        for datanames in list_datanames:
-            for share, futures in datanames.items():
-                # получение данных для акции
-                info_share = get_info(share)
-                if not info_share:
-                    break
-                name_share, _, _, bid_share, offer_share = info_share
-
-                # Список для данных по фчс
-                futures_data = []
-
-                for future in futures:
-                    # получение данных для фчс
-                    info_future = get_info(future)
-                    if not info_future:
-                        break
-                    name_future, lot_size_future, exp_date, bid_future, offer_future = info_future
-                    # Конвертация даты экспирации из формата "20250620" в дату.
-                    converted_date = datetime.strptime(str(exp_date), "%Y%m%d")
-                    exp_days = (converted_date - datetime.now()).days + 1
-                    logger.info(f"Кол-во дней до экспирации: {exp_days}")
-
-                    # Продажа спреда
-                    diff_buy_spread = bid_future - offer_share * lot_size_future
-                    kerry_buy_spread = round((diff_buy_spread / (offer_share * lot_size_future)) * 100, 2)
-                    kerry_buy_spread_y = round(diff_buy_spread / (offer_share * lot_size_future) / exp_days * 365 * 100, 2)
-
-                    logger.info(f"Разница между покупкой акции {name_share} и продажей фьючерса {name_future} составляет {diff_buy_spread}")
-                    logger.info(f"Керри продажи спреда межуду {name_share} и фьючерса {name_future} составляет {kerry_buy_spread }")
-                    logger.info(f"Годовой Керри продажи спреда межуду {name_share} и фьючерса {name_future} составляет {kerry_buy_spread_y}")
-
-                    # Покупка спреда
-                    diff_sell_spread = offer_future - bid_share * lot_size_future
-                    kerry_sell_spread = round((diff_sell_spread / (bid_share * lot_size_future)) * 100, 2)
-                    kerry_sell_spread_y = round(diff_sell_spread / (bid_share * lot_size_future) / exp_days * 365 * 100, 2)
-
-                    logger.info(f"Разница между продажей акции {name_share} и покупкой фьючерса {name_future} составляет {diff_sell_spread}")
-                    logger.info(f"Керри покупки спреда между {name_share} и фьючерса {name_future} составляет {kerry_sell_spread }")
-                    logger.info(f"Годовой Керри покупки спреда между {name_share} и фьючерса {name_future} составляет {kerry_sell_spread_y}")
-
-                    # Добавляем в список для дальнейшего использования
-                    futures_data.append({
-                        'name_future': name_future,
-                        'exp_days': exp_days,
-                        'bid_future': bid_future,
-                        'offer_future': offer_future,
-                        'bid_share': bid_share * lot_size_future,
-                        'offer_share': offer_share * lot_size_future,
-                    })
-
-                    # Сохранение в таблицу spreads
-                    data_to_save = (
-                        datetime.now().strftime('%d.%m.%Y %H:%M:%S'),
-                        name_share,
-                        bid_share,
-                        offer_share,
-                        name_future,
-                        bid_future,
-                        offer_future,
-                        lot_size_future,
-                        exp_days,
-                        kerry_buy_spread_y,
-                        kerry_sell_spread_y
-                    )
-                    save_to_db(cursor, 'spreads', data_to_save)
-
-                # Обрабатываем пары фьючерсов
-                if len(futures_data) >= 2:
-                    sorted_futures = sorted(futures_data, key=lambda x: x['exp_days'])
-
-                    # Перебираем все возможные пары: ближний vs дальний
-                    for i in range(len(sorted_futures)):
-                        for j in range(i + 1, len(sorted_futures)):
-                            near = sorted_futures[i]
-                            far = sorted_futures[j]
-
-                            # Расчет спроса для спреда (по какой "цене" продать КС)
-                            spread_bid = far['bid_future'] - near['offer_future']
-                            # Пересчет в годовую доходность по формуле:
-                            # Доходность годовых = (спред / предложение акции с учетом лота) / кол-во дней до эксп дальнего фчс * кол-во дней * 100%
-                            spread_bid_y = (spread_bid / far['offer_share']) / far['exp_days'] * DAYS_YEAR * 100
-
-                            # Расчет предложения для спреда (по какой "цене" купить КС)
-                            spread_offer = far['offer_future'] - near['bid_future']
-                            # Доходность годовых = (спред / спрос акции с учетом лота) / кол-во дней до эксп дальнего фчс * кол-во дней * 100%
-                            spread_offer_y = (spread_offer / far['bid_share']) / far['exp_days'] * DAYS_YEAR * 100
-
-                            future_spread_data = (
-                                datetime.now().strftime('%d.%m.%Y %H:%M:%S'),
-                                near['name_future'],
-                                far['name_future'],
-                                spread_bid,
-                                spread_offer,
-                                round(spread_bid_y, 2),
-                                round(spread_offer_y, 2),
-                                far['exp_days']
-                            )
-
-                            save_to_db(cursor, 'future_spreads', future_spread_data)
+    list_datanames = read_stock_futures_csv(args.watchlist)
+    if sim_market is not None:
+        sim_market.link(list_datanames)  # Цены фьючерсов модели следуют за ценами акций
+    register_watchlist(DB_PATH, list_datanames)  # id инструментов нужны до первой записи спредов
+    if args.connections > 1:
+        quote_pool = QuotePool.connect(provider_class, args.connections, main_provider=qp_provider)
+    # Стаканы всего списка заказываются один раз, дальше котировки инструмента - один запрос get_quote_level2
+    quik_provider = qp_provider  # В асинхронном режиме qp_provider подменяется адаптером
+    watchlist_specs = load_specs([name for datanames in list_datanames for share, futures in datanames.items()
+                                  for name in [share, *futures]])
+    subscribe_quotes(quik_provider, watchlist_specs)
 
-        conn.commit()
-
-    qp_provider.close_connection_and_thread()  # Перед выходом закрываем соединение для запросов и поток обработки функций обратного вызова
+    try:
+        with BatchWriter(DB_PATH) as writer:  # Запись в БД в фоновом потоке, при выходе сбрасывает все строки
+            if args.daemon or args.events or args.async_mode:
+                signal.signal(signal.SIGINT, stop)
+                signal.signal(signal.SIGTERM, stop)
+                start_rollup_thread(DB_PATH, stop_event=stop_event)  # Агрегаты 1m/1h/1d для графиков за длинный период
+                if args.retention:  # Удаление устаревших строк и агрегатов небольшими пакетами, только по явно заданным срокам
+                    start_retention_thread(args.retention, DB_PATH, stop_event=stop_event)
+                if args.metrics_port:
+                    try:
+                        # Задержки по стадиям для вкладки Health в app.py и текущий топ спредов
+                        start_metrics_server(args.metrics_port, routes={TOP_PATH: top_route})
+                    except OSError as e:
+                        logger.error(f"Не удалось запустить сервер метрик на порту {args.metrics_port}. Ошибка: {e}")
+            if args.stream:
+                stream_publisher = StreamPublisher().start()
+            if args.record:
+                quote_recorder = QuoteRecorder(args.record)
+            if args.heartbeat:
+                change_filter = ChangeFilter(args.epsilon, args.heartbeat)
+            if args.daemon:
+                run_daemon(writer, list_datanames, args.interval)
+            elif args.events:
+                run_events(writer, list_datanames, args.sizes)
+            elif args.async_mode:
+                run_async(writer, list_datanames, args.interval)
+            else:
+                run_cycle(writer, list_datanames)
+    finally:
+        if quote_recorder is not None:
+            quote_recorder.close()
+        if stream_publisher is not None:
+            stream_publisher.close()
+        unsubscribe_quotes(quik_provider, watchlist_specs)
+        if quote_pool is not None:
+            quote_pool.close()
+        qp_provider.close_connection_and_thread()  # Перед выходом закрываем соединение для запросов и поток обработки функций обратного вызова
@@ -0,0 +1,243 @@
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import queue
+import socket
+import threading
+import time
+from collections import deque
+
+from db import DB_PATH, ROW_COLUMNS, connect
+from log_setup import setup_logging
+
+STREAM_HOST = '127.0.0.1'  # Только локальные подключения
+STREAM_PORT = 8765
+CLIENT_QUEUE_SIZE = 10000  # Сообщений в очереди подписчика. Медленный подписчик отключается, сборщик его не ждет
+BUFFER_SIZE = 10000  # Последних сообщений в буфере подписчика
+RECONNECT_DELAY = 2  # Пауза перед повторным подключением подписчика, с
+MAX_REPLAY_GAP = 5  # Максимальная пауза между тактами при воспроизведении, с
+
+logger = logging.getLogger('stream.py')
+
+
+# Сообщение потока: одна строка JSON на пакет строк одной таблицы
+def encode_message(table_name, rows):
+    return (json.dumps({'table': table_name, 'rows': [list(row) for row in rows]}, default=float) + '\n').encode('utf-8')
+
+
+class StreamPublisher:
+    """
+    Рассылка пересчитанных строк спредов подписчикам по TCP на localhost (строки JSON).
+    У каждого подписчика своя очередь и поток отправки: publish не блокируется, подписчик,
+    который не успевает читать, отключается
+    """
+
+    def __init__(self, host=STREAM_HOST, port=STREAM_PORT, queue_size=CLIENT_QUEUE_SIZE):
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self.clients = {}  # {сокет: очередь сообщений}
+        self.lock = threading.Lock()
+        self.server = None
+        self.published = 0  # Отправлено сообщений
+
+    def start(self):
+        self.server = socket.create_server((self.host, self.port))
+        self.port = self.server.getsockname()[1]  # Для port=0 - выбранный системой порт
+        threading.Thread(target=self.accept, name='StreamAccept', daemon=True).start()
+        logger.info(f"Поток спредов доступен на {self.host}:{self.port}")
+        return self
+
+    def accept(self):
+        while True:
+            try:
+                conn, address = self.server.accept()
+            except OSError:  # Сервер закрыт
+                break
+            messages = queue.Queue(maxsize=self.queue_size)
+            with self.lock:
+                self.clients[conn] = messages
+            threading.Thread(target=self.send, args=(conn, messages), name='StreamSend', daemon=True).start()
+            logger.info(f"Подписчик подключен: {address}")
+
+    def send(self, conn, messages):
+        try:
+            while True:
+                message = messages.get()
+                if message is None:
+                    break
+                conn.sendall(message)
+        except OSError as e:
+            logger.info(f"Подписчик отключен: {e}")
+        finally:
+            self.drop(conn)
+
+    def drop(self, conn):
+        with self.lock:
+            messages = self.clients.pop(conn, None)
+        if messages is not None:
+            try:
+                messages.put_nowait(None)  # Останавливаем поток отправки
+            except queue.Full:
+                pass
+        conn.close()
+
+    def wait_for_subscriber(self, timeout=None):
+        """Ждет первого подписчика. Возвращает True, если подписчик есть"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.clients:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def publish(self, table_name, rows):
+        """Отправляет строки всем подписчикам. Строки в том же формате, что и для BatchWriter.write"""
+        rows = list(rows)
+        if not rows:
+            return
+        with self.lock:
+            clients = list(self.clients.items())
+        if not clients:
+            return
+        message = encode_message(table_name, rows)
+        for conn, messages in clients:
+            try:
+                messages.put_nowait(message)
+            except queue.Full:
+                logger.warning("Подписчик не успевает читать поток и будет отключен")
+                self.drop(conn)
+        self.published += 1
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        with self.lock:
+            conns = list(self.clients)
+        for conn in conns:
+            self.drop(conn)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class StreamSubscriber:
+    """
+    Подписка на поток спредов в фоновом потоке с переподключением.
+    Пакеты строк складываются в буфер с порядковыми номерами: каждый читатель (сессия dash)
+    забирает через since только то, что появилось после его последнего номера
+    """
+
+    def __init__(self, host=STREAM_HOST, port=STREAM_PORT, buffer_size=BUFFER_SIZE):
+        self.host = host
+        self.port = port
+        self.buffer = deque(maxlen=buffer_size)  # (номер, таблица, строки)
+        self.last_seq = 0
+        self.lock = threading.Lock()
+        self.connected = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='StreamSubscriber', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.stopping.set()
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                with socket.create_connection((self.host, self.port), timeout=RECONNECT_DELAY) as conn:
+                    conn.settimeout(None)
+                    self.connected.set()
+                    logger.info(f"Подключено к потоку спредов {self.host}:{self.port}")
+                    for line in conn.makefile('r', encoding='utf-8'):
+                        if self.stopping.is_set():
+                            break
+                        message = json.loads(line)
+                        self.add(message['table'], message['rows'])
+            except OSError as e:
+                logger.debug(f"Поток спредов недоступен: {e}")
+            finally:
+                if self.connected.is_set():
+                    logger.info("Поток спредов отключен")
+                self.connected.clear()
+            self.stopping.wait(RECONNECT_DELAY)
+
+    def add(self, table_name, rows):
+        with self.lock:
+            self.last_seq += 1
+            self.buffer.append((self.last_seq, table_name, rows))
+
+    def since(self, seq, table_name):
+        """Возвращает (последний номер, строки таблицы с номером больше seq в порядке поступления)"""
+        with self.lock:
+            rows = [row for item_seq, item_table, item_rows in self.buffer
+                    if item_seq > seq and item_table == table_name for row in item_rows]
+            return self.last_seq, rows
+
+
+# Строки таблицы по возрастанию времени в виде (ts, таблица, строка)
+def table_rows(conn, table_name, columns, start_ms):
+    cursor = conn.execute(f"SELECT {', '.join(columns)} FROM {table_name} WHERE ts >= ? ORDER BY ts", (start_ms,))
+    for row in cursor:
+        yield row[0], table_name, row
+
+
+# Воспроизведение истории из БД в поток с исходными паузами между тактами (для проверки без QUIK)
+def replay(db_path, publisher, speed=1.0, start_ms=None, stop_event=None):
+    """speed - ускорение воспроизведения, start_ms - начало истории (мс). Возвращает кол-во отправленных тактов"""
+    conn = connect(db_path)
+    try:
+        cursors = [table_rows(conn, table_name, columns, start_ms or 0) for table_name, columns in ROW_COLUMNS.items()]
+
+        ticks = 0
+        prev_ts = None
+        for ts, items in itertools.groupby(heapq.merge(*cursors, key=lambda item: item[0]), key=lambda item: item[0]):
+            if stop_event is not None and stop_event.is_set():
+                break
+            if prev_ts is not None:
+                time.sleep(min((ts - prev_ts) / 1000 / speed, MAX_REPLAY_GAP))
+            prev_ts = ts
+            for table_name, table_items in itertools.groupby(items, key=lambda item: item[1]):
+                publisher.publish(table_name, [item[2] for item in table_items])
+            ticks += 1
+        return ticks
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Поток спредов: воспроизведение истории из БД или просмотр потока')
+    parser.add_argument('--replay', metavar='DB_PATH', nargs='?', const=DB_PATH, help='Воспроизвести историю из БД')
+    parser.add_argument('--speed', type=float, default=1.0, help='Ускорение воспроизведения')
+    parser.add_argument('--listen', action='store_true', help='Выводить поступающие строки на консоль')
+    parser.add_argument('--port', type=int, default=STREAM_PORT, help=f'Порт (по умолчанию {STREAM_PORT})')
+    args = parser.parse_args()
+
+    setup_logging(level=logging.INFO)
+    if args.replay:
+        with StreamPublisher(port=args.port) as publisher:
+            logger.info("Ожидание подписчика")
+            publisher.wait_for_subscriber()
+            logger.info(f"Воспроизведено тактов: {replay(args.replay, publisher, args.speed)}")
+    elif args.listen:
+        subscriber = StreamSubscriber(port=args.port).start()
+        seq = {table_name: 0 for table_name in ROW_COLUMNS}
+        try:
+            while True:
+                time.sleep(1)
+                for table_name in ROW_COLUMNS:
+                    seq[table_name], rows = subscriber.since(seq[table_name], table_name)
+                    for row in rows:
+                        print(table_name, row)
+        except KeyboardInterrupt:
+            subscriber.close()
+    else:
+        parser.print_help()
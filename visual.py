@@ -1,15 +1,18 @@
 import sqlite3
-import pandas as pd
 import logging
 import plotly.graph_objs as go
+from archive import load_history
+from db import ms_to_datetime
+from log_setup import setup_logging
 
 
 def visualize_kerry_year_interactive(shortname="GAZR-9.25"):
     conn = sqlite3.connect("data/futures_spreads.db")
-    df = pd.read_sql_query("SELECT trade_time, name_future, kerry_buy_spread_y, kerry_sell_spread_y "
-                           "FROM spreads WHERE name_future = ?", conn,
-                           params=[shortname])
+    # История фьючерса из SQLite и архива закрытых дней (archive.py)
+    df = load_history(conn, 'spreads', ['name_future', 'kerry_buy_spread_y', 'kerry_sell_spread_y'], names=[shortname])
     conn.close()
+    df.pop('id')
+    df.insert(0, 'trade_time', ms_to_datetime(df.pop('ts')))
 
     if df.empty:
         logging.info(f"Нет данных для {shortname}")
@@ -22,13 +25,13 @@ def visualize_kerry_year_interactive(shortname="GAZR-9.25"):
             x=df["trade_time"],
             y=df["kerry_sell_spread_y"],
             name='offer',
-            line=dict(color='red'),
+            line=dict(color='red', shape='hv'),
     ))
     fig.add_trace(go.Scatter(
         x=df["trade_time"],
         y=df["kerry_buy_spread_y"],
         name='bid',
-        line=dict(color='green'),
+        line=dict(color='green', shape='hv'),
     ))
 
     # Обновляем макет
@@ -52,9 +55,5 @@ def visualize_kerry_year_interactive(shortname="GAZR-9.25"):
 
 if __name__ == '__main__':
     logger = logging.getLogger('spread.py')  # Будем вести лог
-    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',  # Формат сообщения
-                        datefmt='%d.%m.%Y %H:%M:%S',  # Формат даты
-                        level=logging.DEBUG,  # Уровень логируемых событий NOTSET/DEBUG/INFO/WARNING/ERROR/CRITICAL
-                        handlers=[logging.FileHandler('logs.log', encoding='utf-8'),
-                                  logging.StreamHandler()])  # Лог записываем в файл и выводим на консоль
+    setup_logging('logs.log')  # Лог записываем в файл и выводим на консоль
     visualize_kerry_year_interactive()
\ No newline at end of file